@@ -0,0 +1,136 @@
+import os
+from os import path
+import json
+import hashlib
+import cPickle as pickle
+
+import context
+from helpers import utils
+
+
+# bump whenever the cached analysis results change meaning
+CACHE_FORMAT = 2
+
+CACHE_DIR = 'analysis_cache'
+
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+class AnalysisCache(object):
+    """Analysis results of the tunnel logs in a data directory, stored in
+    analysis_cache/ next to pantheon_metadata.json.
+
+    The results of each log are kept in one file, together with the size,
+    mtime and SHA-1 of the log they were computed from; they are dropped as
+    soon as the log changes. Within that file, results are keyed by the kind
+    of analysis and its parameters, e.g. ms_per_bin and flow_info.
+
+    Series to redraw graphs from, e.g. per-packet delays, are much larger
+    than the results and kept in a second file, so that reading the results
+    does not unpickle them.
+    """
+
+    def __init__(self, data_dir):
+        self.cache_dir = path.join(path.abspath(data_dir), CACHE_DIR)
+
+    def cache_path(self, log_path):
+        return path.join(self.cache_dir, path.basename(log_path) + '.pkl')
+
+    def series_path(self, log_path):
+        return path.join(self.cache_dir,
+                         path.basename(log_path) + '.series.pkl')
+
+    def read(self, cache_path):
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception:
+            return None
+
+    def write(self, cache_path, cached):
+        utils.make_sure_dir_exists(self.cache_dir)
+
+        # write atomically, as several processes may analyze the same data
+        tmp_path = '%s.%s.tmp' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(cached, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+
+    def load(self, log_path):
+        stat = os.stat(log_path)
+
+        cached = self.read(self.cache_path(log_path))
+        if (cached and cached['format'] == CACHE_FORMAT and
+                cached['size'] == stat.st_size):
+            if cached['mtime'] == stat.st_mtime:
+                return cached
+
+            # e.g. the log was copied; compare contents before trusting it,
+            # which is only possible if they were hashed when it was read
+            if (cached['sha1'] is not None and
+                    cached['sha1'] == file_sha1(log_path)):
+                cached['mtime'] = stat.st_mtime
+                self.write(self.cache_path(log_path), cached)
+                return cached
+
+        # series stored along with other versions of the log are ignored
+        return {'format': CACHE_FORMAT,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': None,
+                'series_id': os.urandom(8).encode('hex'),
+                'results': {}}
+
+    def key(self, kind, params):
+        return (kind, json.dumps(params, sort_keys=True))
+
+    def get(self, log_path, kind, params):
+        """Return the cached results of analysis kind with params on
+        log_path, or None."""
+        return self.load(log_path)['results'].get(self.key(kind, params))
+
+    def get_series(self, log_path, kind, params):
+        """Return the series cached along with the results of analysis kind
+        with params on log_path, or None."""
+        cached = self.load(log_path)
+        if self.key(kind, params) not in cached['results']:
+            return None
+
+        series = self.read(self.series_path(log_path))
+        if not series or series['series_id'] != cached['series_id']:
+            return None
+
+        return series['series'].get(self.key(kind, params))
+
+    def put(self, log_path, kind, params, results, series=None, sha1=None):
+        """Cache the results, and optionally the series, of analysis kind
+        with params on log_path. sha1 is the hex digest of the log they were
+        computed from, if it is known without reading the log again, e.g.
+        ParsedTunnelLog.sha1."""
+        cached = self.load(log_path)
+        if cached['sha1'] is None:
+            cached['sha1'] = sha1
+
+        key = self.key(kind, params)
+        if series is not None:
+            series_path = self.series_path(log_path)
+            cached_series = self.read(series_path)
+            if (not cached_series or
+                    cached_series['series_id'] != cached['series_id']):
+                cached_series = {'series_id': cached['series_id'],
+                                 'series': {}}
+            cached_series['series'][key] = series
+            self.write(series_path, cached_series)
+
+        cached['results'][key] = results
+        self.write(self.cache_path(log_path), cached)
@@ -52,6 +52,10 @@ def parse_analyze_shared(parser):
         default=path.join(context.src_dir, 'experiments', 'data'),
         help='directory that contains logs and metadata '
         'of pantheon tests (default pantheon/experiments/data)')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='analyze tunnel logs again instead of reading results from '
+        'analysis_cache in the data directory')
 
 
 def parse_plot():
@@ -67,6 +71,10 @@ def parse_plot():
 
     parser.add_argument(
         '--custom-test', action='store_true', help='ignore cc name check for use with multi cc tests')
+    parser.add_argument(
+        '--jobs', metavar='N', type=int,
+        help='number of processes to analyze runs in parallel '
+        '(default: number of CPUs)')
 
     args = parser.parse_args()
     if args.schemes is not None and not args.custom_test:
@@ -97,6 +105,11 @@ def parse_analyze():
     parse_analyze_shared(parser)
     parser.add_argument('--include-acklink', action='store_true',
                         help='include acklink analysis')
+    parser.add_argument(
+        '--jobs', metavar='N', type=int,
+        help='number of processes to analyze runs in parallel '
+        '(default: number of CPUs)')
+    parser.set_defaults(no_graphs=False, custom_test=False)
 
     args = parser.parse_args()
     if args.schemes is not None:
@@ -1,42 +1,53 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import os
 from numpy.linalg import lstsq
 import numpy as np
 from arg_parser import parse_benchmark_analysis
 import context
+from helpers.results_store import load_results
 
 class BenchmarkAnalysis():
 	def __init__(self, data_dir):
 		self.data_dir = data_dir
-		self.csv_path = os.path.join(self.data_dir, 'results.csv')
-		self.data = pd.read_csv(self.csv_path)
+		self.data = load_results(self.data_dir)
 
 	def run(self):
-		solo = self.data.query('scheme_a==scheme_b')
+		#runs over different bottleneck traces are plotted separately, as e.g. outages shift loss and delay at every queue size;
+		#results stored before traces were swept ran over the constant trace
+		if 'trace' not in self.data: self.data['trace'] = None
+		traces = self.data['trace'].fillna('constant')
+		for trace in sorted(traces.unique()):
+			self.plot_trace(trace, self.data[traces == trace])
+			plt.close('all')
+
+	def plot_trace(self, trace, data):
+		"""plot the results of the runs over trace, into files named like benchmark experiments (suffixed by the trace unless constant)"""
+		suffix = '' if trace == 'constant' else '_%s' % trace
+		trace_str = '' if trace == 'constant' else ', %s trace' % trace
+		solo = data.query('scheme_a==scheme_b')
 		scheme_a = solo['scheme_a'].values[0]
 		scheme_b = solo['scheme_b'].values[0]
-		scheme_str = "\n6x%s competing"%(scheme_a)
-		self.plot_loss(			'Lossrate vs Queue Capacity' + scheme_str,							'loss.pdf', 			solo)
-		self.plot_variance(		'Relative Standard Deviation vs Queue Capacity' + scheme_str,		'rsd.pdf', 				solo)
-		self.plot_fair(			'Jain Fairness vs RTT Unfairness' + scheme_str, 					'fairness.pdf', 		solo)
-		self.plot_fair_total(	'Jain Fairness (total) vs RTT Unfairness' + scheme_str, 			'fairness_total.pdf',	solo)
-		self.plot_time_to_convergence('Convergence Time vs Fairness after Convergence' + scheme_str,'convergence.pdf',		solo)
-		self.plot_queueing_delay('Queuing Delay vs Queue Capacity' + scheme_str,					'delay.pdf',			solo)
-		self.plot_throughput(	'Throughput vs Queue Capacity' + scheme_str,						'throughput.pdf',		solo)
+		scheme_str = "\n6x%s competing%s"%(scheme_a, trace_str)
+		self.plot_loss(			'Lossrate vs Queue Capacity' + scheme_str,							'loss%s.pdf' % suffix, 			solo)
+		self.plot_variance(		'Relative Standard Deviation vs Queue Capacity' + scheme_str,		'rsd%s.pdf' % suffix, 				solo)
+		self.plot_fair(			'Jain Fairness vs RTT Unfairness' + scheme_str, 					'fairness%s.pdf' % suffix, 		solo)
+		self.plot_fair_total(	'Jain Fairness (total) vs RTT Unfairness' + scheme_str, 			'fairness_total%s.pdf' % suffix,	solo)
+		self.plot_time_to_convergence('Convergence Time vs Fairness after Convergence' + scheme_str,'convergence%s.pdf' % suffix,		solo)
+		self.plot_queueing_delay('Queuing Delay vs Queue Capacity' + scheme_str,					'delay%s.pdf' % suffix,			solo)
+		self.plot_throughput(	'Throughput vs Queue Capacity' + scheme_str,						'throughput%s.pdf' % suffix,		solo)
 
-		mixed = self.data.query('scheme_a!=scheme_b')
+		mixed = data.query('scheme_a!=scheme_b')
 		if len(mixed)==0: return #in case of cubic
 		scheme_a = mixed['scheme_a'].values[0]
 		scheme_b = mixed['scheme_b'].values[0]
-		scheme_str = "\n3x%s 3x%s competing"%(scheme_a, scheme_b)
-		self.plot_loss(			'Lossrate vs Queue Capacity' + scheme_str,							'loss_mixed.pdf',			mixed)
-		self.plot_variance(		'Relative Standard Deviation vs Queue Capacity' + scheme_str,	 	'rsd_mixed.pdf',			mixed)
-		self.plot_fair(			'Jain Fairness vs RTT Unfairness' + scheme_str, 					'fairness_mixed.pdf',		mixed)
-		self.plot_fair_total(	'Jain Fairness (total) vs RTT Unfairness' + scheme_str, 			'fairness_total_mixed.pdf',	mixed)
-		self.plot_time_to_convergence('Convergence Time vs Fairness after Convergence' + scheme_str,'convergence_mixed.pdf',	mixed)
-		self.plot_queueing_delay('Queuing Delay vs Queue Capacity' + scheme_str,			 		'delay_mixed.pdf',			mixed)
-		self.plot_throughput_mixed(	'Throughput vs Queue Capacity' + scheme_str,					'throughput_mixed.pdf',		mixed)
+		scheme_str = "\n3x%s 3x%s competing%s"%(scheme_a, scheme_b, trace_str)
+		self.plot_loss(			'Lossrate vs Queue Capacity' + scheme_str,							'loss_mixed%s.pdf' % suffix,			mixed)
+		self.plot_variance(		'Relative Standard Deviation vs Queue Capacity' + scheme_str,	 	'rsd_mixed%s.pdf' % suffix,			mixed)
+		self.plot_fair(			'Jain Fairness vs RTT Unfairness' + scheme_str, 					'fairness_mixed%s.pdf' % suffix,		mixed)
+		self.plot_fair_total(	'Jain Fairness (total) vs RTT Unfairness' + scheme_str, 			'fairness_total_mixed%s.pdf' % suffix,	mixed)
+		self.plot_time_to_convergence('Convergence Time vs Fairness after Convergence' + scheme_str,'convergence_mixed%s.pdf' % suffix,	mixed)
+		self.plot_queueing_delay('Queuing Delay vs Queue Capacity' + scheme_str,			 		'delay_mixed%s.pdf' % suffix,			mixed)
+		self.plot_throughput_mixed(	'Throughput vs Queue Capacity' + scheme_str,					'throughput_mixed%s.pdf' % suffix,		mixed)
 	
 	def plot_loss(self, title, filename, data):
 		fig, ax = plt.subplots()
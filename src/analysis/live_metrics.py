@@ -0,0 +1,505 @@
+import os
+from os import path
+import json
+import math
+from collections import OrderedDict
+import numpy as np
+
+import context
+from helpers.tunnel_log import (
+    TunnelLog, ARRIVAL, DEPARTURE, ms_to_us, text_init_ts)
+from analysis_cache import AnalysisCache
+from parsed_log import ParsedTunnelLog
+from tunnel_graph import TunnelGraph
+
+
+# relative accuracy of the delay percentiles of a DelaySketch
+SKETCH_ACCURACY = 0.01
+
+# delays are counted from 1 us on, as the log resolution is 1 us
+MIN_DELAY = 0.001
+
+# a run has converged once, over a window of bins, the relative standard
+# deviation of the total throughput and the range of the Jain fairness of
+# the flows stay below these
+CONVERGED_TPUT_RSD = 0.1
+CONVERGED_FAIRNESS_RANGE = 0.05
+
+
+def live_status_path(data_dir, cc, run_id):
+    return path.join(data_dir, '%s_live_run%s.json' % (cc, run_id))
+
+
+def quantize(ms):
+    # round to the resolution of tunnel logs
+    return ms_to_us(ms) / 1000.0
+
+
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+class DelaySketch(object):
+    """Delays counted in logarithmic buckets, whose percentiles are within
+    SKETCH_ACCURACY of the exact ones.
+
+    Sketches of several flows merge by adding up their counts, so that
+    percentiles of all flows need neither the delays nor a sort of them.
+    """
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, delays):
+        delays = np.asarray(delays, dtype=np.float64)
+        if not len(delays):
+            return
+
+        buckets = np.ceil(np.log(np.maximum(delays, MIN_DELAY)) /
+                          self.log_gamma).astype(np.int64)
+        for bucket, count in zip(*np.unique(buckets, return_counts=True)):
+            bucket = int(bucket)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + int(count)
+        self.count += len(delays)
+        self.total += float(delays.sum())
+
+    def merge(self, other):
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, percentile):
+        """percentile of the delays (nearest rank), or None without delays"""
+        if not self.count:
+            return None
+
+        rank = int(round(percentile / 100.0 * (self.count - 1)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return 2.0 * self.gamma ** bucket / (self.gamma + 1.0)
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class BinnedBits(object):
+    """Bits per bin of ms_per_bin ms, growing as events arrive"""
+
+    def __init__(self, ms_per_bin):
+        self.ms_per_bin = ms_per_bin
+        self.bits = np.zeros(0)
+
+    def add(self, ts, bits):
+        if not len(ts):
+            return
+
+        bins = np.maximum(np.asarray(ts) / self.ms_per_bin, 0).astype(np.int64)
+        num_bins = max(len(self.bits), int(bins.max()) + 1)
+        if num_bins > len(self.bits):
+            grown = np.zeros(max(num_bins, 2 * len(self.bits)))
+            grown[:len(self.bits)] = self.bits
+            self.bits = grown
+        self.bits[:num_bins] += np.bincount(bins, weights=bits,
+                                            minlength=num_bins)
+
+
+class LogFollower(object):
+    """Reads the lines appended to an ingress or egress log of a tunnel since
+    the last read, while the tunnel is still writing it."""
+
+    def __init__(self, log_path, clock_offset=None):
+        self.log_path = log_path
+        self.clock_offset = clock_offset
+        self.log = None
+        self.partial = ''
+        self.init_ts = None
+
+    def read_lines(self):
+        if self.log is None:
+            if not path.isfile(self.log_path):
+                return []
+            self.log = open(self.log_path)
+
+        lines = (self.partial + self.log.read()).split('\n')
+        self.partial = lines.pop()
+
+        if self.init_ts is None and lines:
+            # the first line holds the initial timestamp
+            self.init_ts = float(lines.pop(0).rsplit(':', 1)[-1])
+            if self.clock_offset is not None:
+                self.init_ts += self.clock_offset
+
+        return lines
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+class LiveFlow(object):
+    """Arrivals and departures of the packets of one tunnel, paired as
+    merge_tunnel_logs.single_merge pairs them."""
+
+    def __init__(self, flow_id, ingress_log, egress_log, i_clock_offset=None,
+                 e_clock_offset=None, ms_per_bin=500, max_delay=None):
+        self.flow_id = flow_id
+        self.max_delay = max_delay
+
+        # as in single_merge, the egress log holds the packets coming into
+        # the tunnel and the ingress log those leaving it
+        self.arrival_log = LogFollower(egress_log, e_clock_offset)
+        self.departure_log = LogFollower(ingress_log, i_clock_offset)
+        self.arrival_lines = []
+        self.departure_lines = []
+
+        # packets in the tunnel by uid, in the order they came in
+        self.in_flight = OrderedDict()
+        # departures whose arrival has not been read yet
+        self.unpaired = []
+        # timestamps are kept in ms since the initial timestamp of the
+        # tunnel, as single_merge calibrates them; shift is the initial
+        # timestamp of the tunnel in ms since that of all tunnels
+        self.init_ts = None
+        self.shift = None
+        self.last_arrival_ts = None
+        self.last_departure_ts = None
+        self.unmatched = 0
+
+        self.arrivals = []  # arrays of (ts, size) per update
+        self.departures = []  # arrays of (ts, size, delay) per update
+        self.arrival_bits = BinnedBits(ms_per_bin)
+        self.departure_bits = BinnedBits(ms_per_bin)
+        self.total_arrival_bits = 0
+        self.total_departure_bits = 0
+        self.sketch = DelaySketch()
+
+    def read_init_ts(self):
+        """read the headers of both logs, and return their initial
+        timestamps or None if a log has none yet"""
+        self.arrival_lines += self.arrival_log.read_lines()
+        self.departure_lines += self.departure_log.read_lines()
+        if self.arrival_log.init_ts is None:
+            return None
+        if self.departure_log.init_ts is None:
+            return None
+
+        self.init_ts = min(self.arrival_log.init_ts,
+                           self.departure_log.init_ts)
+        return self.init_ts
+
+    def merged_ts(self, ts):
+        """Timestamp in the merged log of a timestamp of the tunnel. Like
+        merge_links, it is rounded to the log resolution relative to the
+        tunnel and rounded again once shifted, so that the results are
+        exactly those of an analysis of the merged log."""
+        return quantize(quantize(ts) + self.shift)
+
+    def update(self, base_ts):
+        """pair the lines written since the last update, with timestamps in
+        ms since base_ts"""
+        arrival_lines = self.arrival_lines + self.arrival_log.read_lines()
+        departure_lines = (self.departure_lines +
+                           self.departure_log.read_lines())
+        self.arrival_lines = []
+        self.departure_lines = []
+
+        arrival_cal = self.arrival_log.init_ts - self.init_ts
+        departure_cal = self.departure_log.init_ts - self.init_ts
+        self.shift = text_init_ts(self.init_ts) - base_ts
+
+        arrivals = []
+        for line in arrival_lines:
+            if not line or line.startswith('#'):
+                continue
+            (ts, uid, size) = line.split('-')
+            ts = float(ts) + arrival_cal
+            self.in_flight[int(uid)] = (ts, int(size))
+            arrivals.append((self.merged_ts(ts), int(size)))
+            self.last_arrival_ts = ts
+
+        pending = self.unpaired
+        for line in departure_lines:
+            if not line or line.startswith('#'):
+                continue
+            (ts, uid, size) = line.split('-')
+            pending.append((float(ts) + departure_cal, int(uid), int(size)))
+
+        departures = []
+        self.unpaired = []
+        for ts, uid, size in pending:
+            paired = self.in_flight.pop(uid, None)
+            if paired is None:
+                # the packet may only be logged in the next update
+                if (self.max_delay is None or self.last_arrival_ts is None or
+                        self.last_arrival_ts < ts + self.max_delay):
+                    self.unpaired.append((ts, uid, size))
+                else:
+                    self.unmatched += 1
+                continue
+
+            (arrival_ts, arrival_size) = paired
+            if arrival_size != size:
+                # merging the logs fails on such packets
+                self.unmatched += 1
+                continue
+
+            departures.append((self.merged_ts(ts), size,
+                               quantize(ts - arrival_ts)))
+            self.last_departure_ts = ts
+
+        # evict packets that never left the tunnel
+        if self.max_delay is not None and self.last_departure_ts is not None:
+            while self.in_flight:
+                (uid, (ts, size)) = next(self.in_flight.iteritems())
+                if ts >= self.last_departure_ts - self.max_delay:
+                    break
+                del self.in_flight[uid]
+
+        if arrivals:
+            arrivals = np.array(arrivals)
+            self.arrivals.append(arrivals)
+            bits = arrivals[:, 1] * 8
+            self.arrival_bits.add(arrivals[:, 0], bits)
+            self.total_arrival_bits += int(bits.sum())
+
+        if departures:
+            departures = np.array(departures)
+            self.departures.append(departures)
+            bits = departures[:, 1] * 8
+            self.departure_bits.add(departures[:, 0], bits)
+            self.total_departure_bits += int(bits.sum())
+            self.sketch.add(departures[:, 2])
+
+    def close(self):
+        self.unmatched += len(self.unpaired)
+        self.unpaired = []
+        self.arrival_log.close()
+        self.departure_log.close()
+
+
+class LiveMetrics(object):
+    """Metrics of the flows on a link, computed while their tunnels write
+    their logs.
+
+    update() reads what the tunnels logged since the last update and keeps
+    running throughput per bin, delay percentiles, loss and Jain fairness,
+    which status() reports. Once the flows stopped, results() returns the
+    results of a TunnelGraph of the merged log from the events already in
+    memory, so that they are available without merging and reading the logs
+    first.
+    """
+
+    def __init__(self, tunnels, flow_info=None, ms_per_bin=500,
+                 capacity=None, max_delay=None):
+        """
+            Arguments:
+            tunnels -- one (ingress_log, egress_log, i_clock_offset,
+                       e_clock_offset) tuple per tunnel, in the order of flow
+                       ids, as passed to merge_tunnel_logs.merge_links
+
+            Keyword Arguments:
+            flow_info -- flow info of each flow id, as passed to TunnelGraph
+            ms_per_bin -- bin size in ms
+            capacity -- optional TraceCapacity of the link
+            max_delay -- ms after which packets still in a tunnel are lost
+        """
+        self.flow_info = flow_info
+        self.ms_per_bin = ms_per_bin
+        self.capacity = capacity
+        self.flows = [LiveFlow(i + 1, *tunnel, ms_per_bin=ms_per_bin,
+                               max_delay=max_delay)
+                      for i, tunnel in enumerate(tunnels)]
+        self.base_ts = None
+
+    def update(self):
+        """read the logs written since the last update, and return whether
+        all logs had their headers written"""
+        if self.base_ts is None:
+            # timestamps are relative to the earliest tunnel, as in merged
+            # logs
+            init_ts = [flow.read_init_ts() for flow in self.flows]
+            if None in init_ts:
+                return False
+            self.base_ts = min(text_init_ts(ts) for ts in init_ts)
+
+        for flow in self.flows:
+            flow.update(self.base_ts)
+        return True
+
+    def status(self):
+        """running metrics of every flow and of all flows, for the last
+        complete bin and since the start"""
+        status = {'flows': {}}
+        if self.base_ts is None:
+            return status
+
+        sketch = DelaySketch()
+        last_ts, last_bin = self.last_complete_bin()
+        status['time'] = last_ts / 1000.0
+        status['bin_time'] = last_bin * self.ms_per_bin / 1000.0
+
+        bin_tputs = []
+        for flow in self.flows:
+            sketch.merge(flow.sketch)
+            bits = flow.departure_bits.bits
+            bin_tput = None
+            if 0 <= last_bin < len(bits):
+                bin_tput = bits[last_bin] / (1000.0 * self.ms_per_bin)
+                if bin_tput > 0:
+                    bin_tputs.append(bin_tput)
+
+            status['flows'][flow.flow_id] = self.flow_status(
+                flow.total_arrival_bits, flow.total_departure_bits,
+                flow.sketch, bin_tput, last_ts)
+
+        total_arrival_bits = sum(f.total_arrival_bits for f in self.flows)
+        total_departure_bits = sum(f.total_departure_bits for f in self.flows)
+        bin_tput = sum(bin_tputs) if bin_tputs else None
+        status['all'] = self.flow_status(
+            total_arrival_bits, total_departure_bits, sketch, bin_tput,
+            last_ts)
+
+        # fairness among the flows that delivered data in the last bin
+        status['all']['bin_fairness'] = None
+        if bin_tputs:
+            status['all']['bin_fairness'] = (
+                sum(bin_tputs) ** 2 / sum(t ** 2 for t in bin_tputs) /
+                len(bin_tputs))
+
+        if self.capacity is not None:
+            status['all']['capacity'] = self.capacity.average(
+                self.base_ts, self.base_ts + last_ts)
+
+        return status
+
+    def last_complete_bin(self):
+        """return the last timestamp read and the last bin that is complete
+        up to it"""
+        last_ts = max([flow.last_arrival_ts + flow.shift for flow in self.flows
+                       if flow.last_arrival_ts is not None] or [0])
+        return last_ts, int(last_ts / self.ms_per_bin) - 1
+
+    def converged(self, window):
+        """whether all flows delivered data in each bin of the last window
+        seconds, with stable total throughput and fairness among them"""
+        if self.base_ts is None:
+            return False
+
+        _, last_bin = self.last_complete_bin()
+        first_bin = last_bin + 1 - int(math.ceil(1000.0 * window /
+                                                 self.ms_per_bin))
+        if first_bin < 0:
+            return False
+
+        bits = np.zeros((len(self.flows), last_bin + 1 - first_bin))
+        for row, flow in enumerate(self.flows):
+            flow_bits = flow.departure_bits.bits[first_bin:last_bin + 1]
+            bits[row, :len(flow_bits)] = flow_bits
+        if not (bits > 0).all():
+            return False
+
+        totals = bits.sum(axis=0)
+        fairness = totals ** 2 / (bits ** 2).sum(axis=0) / len(self.flows)
+        return (np.std(totals) / np.mean(totals) <= CONVERGED_TPUT_RSD and
+                fairness.max() - fairness.min() <= CONVERGED_FAIRNESS_RANGE)
+
+    def flow_status(self, arrival_bits, departure_bits, sketch, bin_tput,
+                    last_ts):
+        loss = None
+        if arrival_bits > 0:
+            loss = 1 - 1.0 * departure_bits / arrival_bits
+
+        tput = None
+        if last_ts > 0:
+            tput = departure_bits / (1000.0 * last_ts)
+
+        return {'bin_tput': bin_tput,
+                'tput': tput,
+                'delay': sketch.percentile(95),
+                'mean_delay': sketch.mean(),
+                'loss': loss}
+
+    def write_status(self, status_path, results=None):
+        """write status(), and the final results if given, to status_path"""
+        status = self.status()
+        if results is not None:
+            status['results'] = results
+
+        # replace the previous status atomically, as it may be read anytime
+        tmp_path = '%s.%s.tmp' % (status_path, os.getpid())
+        with open(tmp_path, 'w') as status_file:
+            json.dump(status, status_file, default=to_json)
+        os.rename(tmp_path, status_path)
+
+    def tunnel_log(self):
+        """all events read so far, as a ParsedTunnelLog of the merged log"""
+        ts = []
+        event = []
+        size = []
+        delay = []
+        flow_ids = []
+        for flow in self.flows:
+            for arrivals in flow.arrivals:
+                ts.append(arrivals[:, 0])
+                event.append(np.full(len(arrivals), ARRIVAL, dtype=np.int8))
+                size.append(arrivals[:, 1])
+                delay.append(np.full(len(arrivals), np.nan))
+                flow_ids.append(np.full(len(arrivals), flow.flow_id))
+            for departures in flow.departures:
+                ts.append(departures[:, 0])
+                event.append(np.full(len(departures), DEPARTURE,
+                                     dtype=np.int8))
+                size.append(departures[:, 1])
+                delay.append(departures[:, 2])
+                flow_ids.append(np.full(len(departures), flow.flow_id))
+
+        if not ts:
+            return None
+
+        ts = np.concatenate(ts)
+        event = np.concatenate(event)
+        flow_ids = np.concatenate(flow_ids).astype(np.int64)
+
+        # merged logs are ordered by time, then by flow, with arrivals before
+        # departures at the same time
+        order = np.lexsort((event, flow_ids, ts))
+        return ParsedTunnelLog(None, TunnelLog(
+            init_ts=self.base_ts,
+            flows=len(self.flows),
+            ts=ts[order],
+            event=event[order],
+            size=np.concatenate(size)[order].astype(np.int64),
+            delay=np.concatenate(delay)[order],
+            flow=flow_ids[order]))
+
+    def finish(self):
+        """read the rest of the logs once the flows stopped, and return a
+        TunnelGraph of them that has run, or None without any events"""
+        self.update()
+        for flow in self.flows:
+            flow.close()
+
+        tunnel_log = self.tunnel_log()
+        if tunnel_log is None:
+            return None
+
+        graph = TunnelGraph(tunnel_log, ms_per_bin=self.ms_per_bin,
+                            flow_info=self.flow_info, capacity=self.capacity)
+        graph.results = graph.run()
+        return graph
+
+    def cache_results(self, graph, log_path, data_dir):
+        """store the results of finish() as those of the merged log_path, so
+        that its analysis reuses them"""
+        graph.cache_results(AnalysisCache(data_dir), log_path, graph.results)
@@ -3,11 +3,12 @@
 
 """
 
-import pandas as pd
 import matplotlib.pyplot as plt
 import os
 import numpy as np
 import argparse
+import context
+from helpers.results_store import load_results
 
 def plot_multischeme_summary(data_dirs, output_dir):
 	plt.figure(1)
@@ -21,8 +22,7 @@ def plot_multischeme_summary(data_dirs, output_dir):
 	fig3.suptitle('Throughput')
 	colors = list('rgbcmy')
 	for scheme_id, data_dir in enumerate(data_dirs):
-		csv_path = os.path.join(data_dir, 'results.csv')
-		data = pd.read_csv(csv_path)
+		data = load_results(data_dir)
 		scheme = data['scheme_a'].values[0]
 		solo = data.query('scheme_a==scheme_b')
 		mixed = data.query('scheme_a!=scheme_b')
@@ -0,0 +1,132 @@
+import os
+from os import path
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+import context
+from helpers.tunnel_log import load_tunnel_log, DEPARTURE, CAPACITY
+
+
+# number of parsed tunnel logs kept in memory by load_parsed_log
+MAX_CACHED_LOGS = 4
+
+_parsed_logs = OrderedDict()
+
+
+class ParsedTunnelLog(object):
+    """A tunnel log read into memory once and shared by all analyses of it.
+
+    Event indices, binned series and sorted delays are computed on first use
+    and cached, so that e.g. TunnelGraph and PlotThroughputTime can bin the
+    same log at different ms_per_bin without reading it again.
+    """
+
+    def __init__(self, log_path, tunnel_log=None):
+        """tunnel_log optionally holds the TunnelLog columns of events that
+        were never written to log_path, e.g. those of a LiveMetrics."""
+        self.log_path = log_path
+
+        # SHA-1 of log_path hashed while reading it, for AnalysisCache
+        self.sha1 = None
+        if tunnel_log is None:
+            sha1 = hashlib.sha1()
+            tunnel_log = load_tunnel_log(log_path, sha1)
+            self.sha1 = sha1.hexdigest()
+        self.init_ts = tunnel_log.init_ts
+        self.ts = tunnel_log.ts
+        self.event = tunnel_log.event
+        self.delay = tunnel_log.delay
+        self.flow = tunnel_log.flow
+        self.num_bits = tunnel_log.size * 8
+
+        self.first_ts = None
+        if len(self.ts):
+            self.first_ts = float(self.ts[0])
+
+        # flows in the order of their first arrival or departure
+        not_capacity = self.event != CAPACITY
+        flow_ids, first_index = np.unique(self.flow[not_capacity],
+                                          return_index=True)
+        self.flows = [int(flow_id) for flow_id in
+                      flow_ids[np.argsort(first_index)]]
+
+        self.events_cache = {}
+        self.binned_cache = {}
+        self.sorted_delays_cache = {}
+
+    def events(self, event, flow_id=None):
+        """Indices of the events of a type, of one flow or of all flows."""
+        key = (event, flow_id)
+        if key not in self.events_cache:
+            mask = self.event == event
+            if flow_id is not None:
+                mask &= self.flow == flow_id
+            self.events_cache[key] = np.flatnonzero(mask)
+
+        return self.events_cache[key]
+
+    def binned(self, ms_per_bin, event, flow_id=None, base_ts=None):
+        """Sum the bits of the events of a type into bins of ms_per_bin ms
+        counted from base_ts (default: the first event in the log).
+
+        Returns the first occupied bin, and the bits and the number of events
+        per bin from it on, or None if there are no such events.
+        """
+        if base_ts is None:
+            base_ts = self.first_ts
+
+        key = (ms_per_bin, event, flow_id, base_ts)
+        if key not in self.binned_cache:
+            indices = self.events(event, flow_id)
+            if not len(indices):
+                self.binned_cache[key] = None
+            else:
+                bins = ((self.ts[indices] - base_ts) /
+                        ms_per_bin).astype(np.int64)
+                first_bin = bins.min()
+                offsets = bins - first_bin
+                self.binned_cache[key] = (
+                    first_bin,
+                    np.bincount(offsets, weights=self.num_bits[indices]),
+                    np.bincount(offsets))
+
+        return self.binned_cache[key]
+
+    def delays(self, flow_id=None):
+        """Per-packet one-way delays in the order they were logged."""
+        return self.delay[self.events(DEPARTURE, flow_id)]
+
+    def sorted_delays(self, flow_id=None):
+        if flow_id not in self.sorted_delays_cache:
+            self.sorted_delays_cache[flow_id] = np.sort(self.delays(flow_id))
+
+        return self.sorted_delays_cache[flow_id]
+
+    def delay_percentile(self, percentile, flow_id=None):
+        delays = self.sorted_delays(flow_id)
+        if not len(delays):
+            return None
+
+        return np.percentile(delays, percentile, interpolation='nearest')
+
+
+def load_parsed_log(log_path):
+    """Return the ParsedTunnelLog of log_path, reading the log only if it is
+    not cached yet or has changed since it was read."""
+    key = path.realpath(log_path)
+    stat = os.stat(key)
+    version = (stat.st_size, stat.st_mtime)
+
+    if key in _parsed_logs:
+        cached_version, parsed_log = _parsed_logs.pop(key)
+        if cached_version == version:
+            _parsed_logs[key] = (version, parsed_log)
+            return parsed_log
+
+    parsed_log = ParsedTunnelLog(log_path)
+    _parsed_logs[key] = (version, parsed_log)
+    while len(_parsed_logs) > MAX_CACHED_LOGS:
+        _parsed_logs.popitem(last=False)
+
+    return parsed_log
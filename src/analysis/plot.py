@@ -5,7 +5,6 @@ import sys
 import math
 import json
 import multiprocessing
-from multiprocessing.pool import ThreadPool
 import numpy as np
 import matplotlib_agg
 import matplotlib.pyplot as plt
@@ -14,10 +13,19 @@ import matplotlib.ticker as ticker
 import arg_parser
 import tunnel_graph
 import context
+from analysis_cache import AnalysisCache
 from helpers import utils
+from helpers.link_capacity import load_link_capacity
 
 from traceback import format_exc
 
+
+def parse_tunnel_log(plot, cc, run_id):
+    # runs in a worker process of Plot.eval_performance, which only receives
+    # the results dict back; graphs are rendered by the worker
+    return plot.parse_tunnel_log(cc, run_id)
+
+
 class Plot(object):
     def __init__(self, args, flow_info = None):
         #flow_info -- optional mapping int:flowid -> (str:color, str:name)
@@ -26,6 +34,11 @@ class Plot(object):
         self.no_graphs = args.no_graphs
         self.custom_test = args.custom_test
         self.flow_info = flow_info
+        self.jobs = getattr(args, 'jobs', None) or multiprocessing.cpu_count()
+
+        self.cache = None
+        if not getattr(args, 'no_cache', False):
+            self.cache = AnalysisCache(self.data_dir)
 
         metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
         meta = utils.load_test_metadata(metadata_path)
@@ -107,11 +120,16 @@ class Plot(object):
 
             sys.stderr.write('$ tunnel_graph %s\n' % log_path)
             try:
+                # runs without mm-link logs record the traces of the link
+                capacity = load_link_capacity(
+                    self.data_dir, cc, run_id, link_t)
                 tunnel_results = tunnel_graph.TunnelGraph(
                     tunnel_log=log_path,
                     throughput_graph=tput_graph_path,
                     delay_graph=delay_graph_path,
-                    flow_info = self.flow_info).run()
+                    flow_info = self.flow_info,
+                    cache=self.cache,
+                    capacity=capacity).run()
             except Exception as exception:
                 sys.stderr.write('Error: %s\n' % format_exc())
                 sys.stderr.write('Warning: "tunnel_graph %s" failed but '
@@ -125,11 +143,15 @@ class Plot(object):
                 ret = tunnel_results
                 duration = tunnel_results['duration'] / 1000.0
 
-                if duration < 0.8 * self.runtime:
+                # runs that converged were stopped before the runtime
+                runtime = self.achieved_runtime(cc, run_id)
+                ret['achieved_runtime'] = runtime
+
+                if duration < 0.8 * runtime:
                     sys.stderr.write(
                         'Warning: "tunnel_graph %s" had duration %.2f seconds '
                         'but should have been around %s seconds. Ignoring this'
-                        ' run.\n' % (log_path, duration, self.runtime))
+                        ' run.\n' % (log_path, duration, runtime))
                     error = True
 
         if error:
@@ -137,6 +159,9 @@ class Plot(object):
 
         return ret
 
+    def achieved_runtime(self, cc, run_id):
+        return utils.achieved_runtime(self.data_dir, cc, run_id, self.runtime)
+
     def update_stats_log(self, cc, run_id, stats):
         stats_log_path = path.join(
             self.data_dir, '%s_stats_run%s.log' % (cc, run_id))
@@ -151,7 +176,8 @@ class Plot(object):
         with open(stats_log_path) as stats_log:
             for line in stats_log:
                 if any([x in line for x in [
-                        'Start at:', 'End at:', 'clock offset:']]):
+                        'Start at:', 'End at:', 'Converged after:',
+                        'clock offset:']]):
                     saved_lines += line
                 else:
                     continue
@@ -174,24 +200,30 @@ class Plot(object):
             perf_data[cc] = {}
             stats[cc] = {}
 
-        cc_id = 0
-        run_id = 1
-        pool = ThreadPool(processes=multiprocessing.cpu_count())
+        # parse tunnel logs and render their graphs in worker processes, as
+        # both are CPU bound
+        jobs = min(self.jobs, len(self.cc_schemes) * self.run_times)
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(processes=jobs)
 
-        while cc_id < len(self.cc_schemes):
-            cc = self.cc_schemes[cc_id]
-            perf_data[cc][run_id] = pool.apply_async(
-                self.parse_tunnel_log, args=(cc, run_id))
+        for cc in self.cc_schemes:
+            for run_id in xrange(1, 1 + self.run_times):
+                if pool is None:
+                    perf_data[cc][run_id] = self.parse_tunnel_log(cc, run_id)
+                else:
+                    perf_data[cc][run_id] = pool.apply_async(
+                        parse_tunnel_log, args=(self, cc, run_id))
 
-            run_id += 1
-            if run_id > self.run_times:
-                run_id = 1
-                cc_id += 1
+        if pool is not None:
+            pool.close()
+            for cc in self.cc_schemes:
+                for run_id in xrange(1, 1 + self.run_times):
+                    perf_data[cc][run_id] = perf_data[cc][run_id].get()
+            pool.join()
 
         for cc in self.cc_schemes:
             for run_id in xrange(1, 1 + self.run_times):
-                perf_data[cc][run_id] = perf_data[cc][run_id].get()
-
                 if perf_data[cc][run_id] is None:
                     continue
 
@@ -7,10 +7,14 @@ import time
 import matplotlib_agg
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+import numpy as np
 
 import arg_parser
 import context
 from helpers import utils
+from helpers.tunnel_log import ARRIVAL, DEPARTURE
+from parsed_log import load_parsed_log
+from analysis_cache import AnalysisCache
 
 
 class PlotThroughputTime(object):
@@ -19,6 +23,10 @@ class PlotThroughputTime(object):
         self.ms_per_bin = args.ms_per_bin
         self.amplify = args.amplify
 
+        self.cache = None
+        if not getattr(args, 'no_cache', False):
+            self.cache = AnalysisCache(self.data_dir)
+
         metadata_path = path.join(self.data_dir, 'pantheon_metadata.json')
         meta = utils.load_test_metadata(metadata_path)
         self.cc_schemes = utils.verify_schemes_with_meta(args.schemes, meta)
@@ -26,74 +34,48 @@ class PlotThroughputTime(object):
         self.run_times = meta['run_times']
         self.flows = meta['flows']
 
-    def ms_to_bin(self, ts, flow_base_ts):
-        return int((ts - flow_base_ts) / self.ms_per_bin)
-
     def parse_tunnel_log(self, tunnel_log_path):
-        tunlog = open(tunnel_log_path)
-
-        # read init timestamp
-        init_ts = None
-        while init_ts is None:
-            line = tunlog.readline()
-            if 'init timestamp' in line:
-                init_ts = float(line.split(':')[1])
+        if self.cache:
+            cached = self.cache.get(tunnel_log_path, 'throughput_time',
+                                    [self.ms_per_bin])
+            if cached:
+                return cached
 
-        flow_base_ts = {}  # timestamp when each flow sent the first byte
-        departures = {}  # number of bits leaving the tunnel within a bin
-
-        while True:
-            line = tunlog.readline()
-            if not line:
-                break
-
-            if '#' in line:
-                continue
-
-            items = line.split()
-            ts = float(items[0])
-            event_type = items[1]
-            num_bits = int(items[2]) * 8
-
-            if event_type == '+':
-                if len(items) == 4:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                if flow_id not in flow_base_ts:
-                    flow_base_ts[flow_id] = ts
-            elif event_type == '-':
-                if len(items) == 5:
-                    flow_id = int(items[-1])
-                else:
-                    flow_id = 0
-
-                if flow_id not in departures:
-                    departures[flow_id] = {}
-                else:
-                    bin_id = self.ms_to_bin(ts, flow_base_ts[flow_id])
-                    old_value = departures[flow_id].get(bin_id, 0)
-                    departures[flow_id][bin_id] = old_value + num_bits
-
-        tunlog.close()
+        tunnel_log = load_parsed_log(tunnel_log_path)
 
         # prepare return values
         us_per_bin = 1000.0 * self.ms_per_bin
         clock_time = {}  # data for x-axis
         throughput = {}  # data for y-axis
-        for flow_id in departures:
-            start_ts = flow_base_ts[flow_id] + init_ts + self.ms_per_bin / 2.0
-            clock_time[flow_id] = []
-            throughput[flow_id] = []
-
-            max_bin_id = max(departures[flow_id].keys())
-            for bin_id in xrange(0, max_bin_id + 1):
-                time_sec = (start_ts + bin_id * self.ms_per_bin) / 1000.0
-                clock_time[flow_id].append(time_sec)
-
-                tput_mbps = departures[flow_id].get(bin_id, 0) / us_per_bin
-                throughput[flow_id].append(tput_mbps)
+        for flow_id in sorted(tunnel_log.flows):
+            flow_departures = tunnel_log.events(DEPARTURE, flow_id)
+            if not len(flow_departures):
+                continue
+
+            # timestamp when the flow sent the first byte
+            flow_arrivals = tunnel_log.events(ARRIVAL, flow_id)
+            flow_base_ts = tunnel_log.ts[flow_arrivals[0]]
+
+            # number of bits leaving the tunnel within a bin, counted from the
+            # second departure on
+            first_bin, bits, _ = tunnel_log.binned(
+                self.ms_per_bin, DEPARTURE, flow_id, flow_base_ts)
+            departures = np.zeros(1)
+            if len(flow_departures) > 1:
+                departures = np.zeros(first_bin + len(bits))
+                departures[first_bin:] = bits
+                first_bits = tunnel_log.num_bits[flow_departures[0]]
+                departures[first_bin] -= first_bits
+
+            start_ts = flow_base_ts + tunnel_log.init_ts
+            start_ts += self.ms_per_bin / 2.0
+            bin_ts = start_ts + np.arange(len(departures)) * self.ms_per_bin
+            clock_time[flow_id] = (bin_ts / 1000.0).tolist()
+            throughput[flow_id] = (departures / us_per_bin).tolist()
+
+        if self.cache:
+            self.cache.put(tunnel_log_path, 'throughput_time',
+                           [self.ms_per_bin], (clock_time, throughput))
 
         return clock_time, throughput
 
@@ -9,14 +9,22 @@ import numpy as np
 
 import arg_parser
 import context
+from analysis_cache import AnalysisCache
 from helpers import utils
 from helpers.subprocess_wrappers import check_call, check_output
 
 
 class Report(object):
-    def __init__(self, args):
+    def __init__(self, args, perf_data=None):
+        # perf_data -- optional results of Plot.eval_performance, used instead
+        # of the statistics in stats logs
         self.data_dir = path.abspath(args.data_dir)
         self.include_acklink = args.include_acklink
+        self.perf_data = perf_data
+
+        self.cache = None
+        if not getattr(args, 'no_cache', False):
+            self.cache = AnalysisCache(self.data_dir)
 
         metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
         self.meta = utils.load_test_metadata(metadata_path)
@@ -97,11 +105,13 @@ class Report(object):
                      'been applied to correct the timestamps in logs.\n\n'
                      % meta['ntp_addr'])
 
+        # metadata of older tests lacks the system info
+        sys_info = meta.get('sys_info') or utils.get_sys_info()
         desc += (
             '\\begin{verbatim}\n'
             'System info:\n'
             '%s'
-            '\\end{verbatim}\n\n' % utils.get_sys_info())
+            '\\end{verbatim}\n\n' % sys_info)
 
         desc += (
             '\\begin{verbatim}\n'
@@ -164,6 +174,47 @@ class Report(object):
 
         return table
 
+    def cached_results(self, cc, run_id):
+        if self.cache is None:
+            return None
+
+        log_prefix = cc
+        if self.flows == 0:
+            log_prefix += '_mm'
+        log_path = path.join(
+            self.data_dir, '%s_datalink_run%s.log' % (log_prefix, run_id))
+        if not path.isfile(log_path):
+            return None
+
+        # see TunnelGraph.cache_results
+        results = self.cache.get(log_path, 'flow_stats', [])
+        if results is None:
+            return None
+
+        # plot.py ignores runs that are much shorter than expected; runs that
+        # converged were stopped before the runtime
+        runtime = utils.achieved_runtime(
+            self.data_dir, cc, run_id, self.meta['runtime'])
+        if results['duration'] / 1000.0 < 0.8 * runtime:
+            return None
+
+        return results
+
+    def add_run_results(self, data, run_data):
+        for flow_id in xrange(1, self.flows + 1):
+            flow_data = run_data['flow_data'].get(flow_id)
+            if flow_data is None:
+                continue
+
+            if flow_data['tput'] is not None:
+                data[flow_id]['tput'].append(flow_data['tput'])
+            if flow_data['delay'] is not None:
+                data[flow_id]['delay'].append(flow_data['delay'])
+            if flow_data['loss'] is not None:
+                data[flow_id]['loss'].append(flow_data['loss'] * 100.0)
+
+        data['valid_runs'] += 1
+
     def summary_table(self):
         data = {}
 
@@ -187,7 +238,19 @@ class Report(object):
                 data[cc][flow_id]['delay'] = []
                 data[cc][flow_id]['loss'] = []
 
+            if self.perf_data is not None:
+                for run_id in xrange(1, 1 + self.run_times):
+                    run_data = self.perf_data[cc].get(run_id)
+                    if run_data is not None:
+                        self.add_run_results(data[cc], run_data)
+                continue
+
             for run_id in xrange(1, 1 + self.run_times):
+                run_data = self.cached_results(cc, run_id)
+                if run_data is not None:
+                    self.add_run_results(data[cc], run_data)
+                    continue
+
                 fname = '%s_stats_run%s.log' % (cc, run_id)
                 stats_log_path = path.join(self.data_dir, fname)
 
@@ -10,16 +10,22 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 import arg_parser
+import context
+from helpers.tunnel_log import ARRIVAL, DEPARTURE, CAPACITY
+from parsed_log import ParsedTunnelLog, load_parsed_log
 
 
 class TunnelGraph(object):
 	def __init__(self, tunnel_log, throughput_graph=None, delay_graph=None,
-				 ms_per_bin=500, flow_info=None):
+				 ms_per_bin=500, flow_info=None, cache=None, capacity=None):
 		self.tunnel_log = tunnel_log
 		self.throughput_graph = throughput_graph
 		self.delay_graph = delay_graph
 		self.ms_per_bin = ms_per_bin
 		self.flow_info = flow_info
+		self.cache = cache  # optional AnalysisCache
+		# optional TraceCapacity of a link that did not log its capacity
+		self.capacity = capacity
 
 	def ms_to_bin(self, ts, first_ts):
 		return int((ts - first_ts) / self.ms_per_bin)
@@ -27,137 +33,57 @@ class TunnelGraph(object):
 	def bin_to_s(self, bin_id):
 		return bin_id * self.ms_per_bin / 1000.0
 
+	def bins_to_s(self, first_bin, num_bins):
+		bin_ids = np.arange(first_bin, first_bin + num_bins)
+		return (bin_ids * self.ms_per_bin / 1000.0).tolist()
+
 	def parse_tunnel_log(self):
-		tunlog = open(self.tunnel_log)
+		if isinstance(self.tunnel_log, ParsedTunnelLog):
+			tunnel_log = self.tunnel_log
+		else:
+			tunnel_log = load_parsed_log(self.tunnel_log)
+		ts = tunnel_log.ts
+		num_bits = tunnel_log.num_bits
+		first_ts = tunnel_log.first_ts
+		us_per_bin = 1000.0 * self.ms_per_bin
 
 		self.flows = {}
-		first_ts = None
-		capacities = {}
-
-		arrivals = {}
-		departures = {}
-		self.delays_t = {}
-		self.delays = {}
-
-		first_capacity = None
-		last_capacity = None
-		first_arrival = {}
-		last_arrival = {}
-		first_departure = {}
-		last_departure = {}
-
-		total_first_departure = None
-		total_last_departure = None
-		total_arrivals = 0
-		total_departures = 0
-
-		while True:
-			line = tunlog.readline()
-			if not line:
-				break
-
-			if line.startswith('#'):
-				continue
-
-			items = line.split()
-			ts = float(items[0])
-			event_type = items[1]
-			num_bits = int(items[2]) * 8
-
-			if first_ts is None:
-				first_ts = ts
-
-			bin_id = self.ms_to_bin(ts, first_ts)
-
-			if event_type == '#':
-				capacities[bin_id] = capacities.get(bin_id, 0) + num_bits
-
-				if first_capacity is None:
-					first_capacity = ts
-
-				if last_capacity is None or ts > last_capacity:
-					last_capacity = ts
-			elif event_type == '+':
-				if len(items) == 4:
-					flow_id = int(items[-1])
-				else:
-					flow_id = 0
-
-				self.flows[flow_id] = True
-
-				if flow_id not in arrivals:
-					arrivals[flow_id] = {}
-					first_arrival[flow_id] = ts
-
-				if flow_id not in last_arrival:
-					last_arrival[flow_id] = ts
-				else:
-					if ts > last_arrival[flow_id]:
-						last_arrival[flow_id] = ts
-
-				old_value = arrivals[flow_id].get(bin_id, 0)
-				arrivals[flow_id][bin_id] = old_value + num_bits
-
-				total_arrivals += num_bits
-			elif event_type == '-':
-				if len(items) == 5:
-					flow_id = int(items[-1])
-				else:
-					flow_id = 0
-
-				self.flows[flow_id] = True
-
-				if flow_id not in departures:
-					departures[flow_id] = {}
-					first_departure[flow_id] = ts
-
-				if flow_id not in last_departure:
-					last_departure[flow_id] = ts
-				else:
-					if ts > last_departure[flow_id]:
-						last_departure[flow_id] = ts
-
-				old_value = departures[flow_id].get(bin_id, 0)
-				departures[flow_id][bin_id] = old_value + num_bits
-
-				total_departures += num_bits
-
-				# update total variables
-				if total_first_departure is None:
-					total_first_departure = ts
-				if (total_last_departure is None or
-						ts > total_last_departure):
-					total_last_departure = ts
-
-				# store delays in a list for each flow and sort later
-				delay = float(items[3])
-				if flow_id not in self.delays:
-					self.delays[flow_id] = []
-					self.delays_t[flow_id] = []
-				self.delays[flow_id].append(delay)
-				self.delays_t[flow_id].append((ts - first_ts) / 1000.0)
-
-		tunlog.close()
-
-		us_per_bin = 1000.0 * self.ms_per_bin
+		for flow_id in tunnel_log.flows:
+			self.flows[flow_id] = True
 
 		self.avg_capacity = None
 		self.link_capacity = []
 		self.link_capacity_t = []
-		if capacities:
+		capacity = tunnel_log.events(CAPACITY)
+		if len(capacity):
 			# calculate average capacity
+			capacity_ts = ts[capacity]
+			first_capacity = float(capacity_ts[0])
+			last_capacity = float(capacity_ts.max())
+
 			if last_capacity == first_capacity:
 				self.avg_capacity = 0
 			else:
 				delta = 1000.0 * (last_capacity - first_capacity)
-				self.avg_capacity = sum(capacities.values()) / delta
+				self.avg_capacity = int(num_bits[capacity].sum()) / delta
 
 			# transform capacities into a list
-			capacity_bins = capacities.keys()
-			for bin_id in xrange(min(capacity_bins), max(capacity_bins) + 1):
-				self.link_capacity.append(
-					capacities.get(bin_id, 0) / us_per_bin)
-				self.link_capacity_t.append(self.bin_to_s(bin_id))
+			first_bin, capacity_bits, _ = tunnel_log.binned(
+				self.ms_per_bin, CAPACITY)
+			self.link_capacity = (capacity_bits / us_per_bin).tolist()
+			self.link_capacity_t = self.bins_to_s(first_bin, len(capacity_bits))
+		elif self.capacity is not None and len(ts):
+			# capacity over the span of the log, derived from the link's trace
+			first_capacity = tunnel_log.init_ts + first_ts
+			last_capacity = tunnel_log.init_ts + float(ts.max())
+			self.avg_capacity = self.capacity.average(
+				first_capacity, last_capacity)
+
+			num_bins = self.ms_to_bin(float(ts.max()), first_ts) + 1
+			capacity_bits = self.capacity.binned(
+				first_capacity, self.ms_per_bin, num_bins)
+			self.link_capacity = (capacity_bits / us_per_bin).tolist()
+			self.link_capacity_t = self.bins_to_s(0, num_bins)
 
 		# calculate ingress and egress throughput for each flow
 		self.ingress_tput = {}
@@ -168,8 +94,12 @@ class TunnelGraph(object):
 		self.avg_egress = {}
 		self.percentile_delay = {}
 		self.loss_rate = {}
+		self.delays_t = {}
+		self.delays = {}
 
-		total_delays = []
+		first_departure = {}
+		last_arrival = {}
+		departure_bins = {}
 
 		for flow_id in self.flows:
 			self.ingress_tput[flow_id] = []
@@ -179,77 +109,100 @@ class TunnelGraph(object):
 			self.avg_ingress[flow_id] = 0
 			self.avg_egress[flow_id] = 0
 
-			if flow_id in arrivals:
+			flow_arrival = tunnel_log.events(ARRIVAL, flow_id)
+			flow_departure = tunnel_log.events(DEPARTURE, flow_id)
+
+			if len(flow_arrival):
 				# calculate average ingress and egress throughput
-				first_arrival_ts = first_arrival[flow_id]
-				last_arrival_ts = last_arrival[flow_id]
+				arrival_ts = ts[flow_arrival]
+				first_arrival_ts = float(arrival_ts[0])
+				last_arrival_ts = float(arrival_ts.max())
+				last_arrival[flow_id] = last_arrival_ts
+				flow_arrivals = int(num_bits[flow_arrival].sum())
 
 				if last_arrival_ts == first_arrival_ts:
 					self.avg_ingress[flow_id] = 0
 				else:
 					delta = 1000.0 * (last_arrival_ts - first_arrival_ts)
-					flow_arrivals = sum(arrivals[flow_id].values())
 					self.avg_ingress[flow_id] = flow_arrivals / delta
 
-				ingress_bins = arrivals[flow_id].keys()
-				for bin_id in xrange(min(ingress_bins), max(ingress_bins) + 1):
-					self.ingress_tput[flow_id].append(
-						arrivals[flow_id].get(bin_id, 0) / us_per_bin)
-					self.ingress_t[flow_id].append(self.bin_to_s(bin_id))
+				first_bin, arrival_bits, _ = tunnel_log.binned(
+					self.ms_per_bin, ARRIVAL, flow_id)
+				self.ingress_tput[flow_id] = (
+					arrival_bits / us_per_bin).tolist()
+				self.ingress_t[flow_id] = self.bins_to_s(
+					first_bin, len(arrival_bits))
 
-			if flow_id in departures:
-				first_departure_ts = first_departure[flow_id]
-				last_departure_ts = last_departure[flow_id]
+			if len(flow_departure):
+				departure_ts = ts[flow_departure]
+				first_departure_ts = float(departure_ts[0])
+				last_departure_ts = float(departure_ts.max())
+				first_departure[flow_id] = first_departure_ts
+				flow_departures = int(num_bits[flow_departure].sum())
 
 				if last_departure_ts == first_departure_ts:
 					self.avg_egress[flow_id] = 0
 				else:
 					delta = 1000.0 * (last_departure_ts - first_departure_ts)
-					flow_departures = sum(departures[flow_id].values())
 					self.avg_egress[flow_id] = flow_departures / delta
 
-				egress_bins = departures[flow_id].keys()
+				departure_bins[flow_id] = tunnel_log.binned(
+					self.ms_per_bin, DEPARTURE, flow_id)
+				first_bin, departure_bits, _ = departure_bins[flow_id]
 
-				self.egress_tput[flow_id].append(0.0)
-				self.egress_t[flow_id].append(self.bin_to_s(min(egress_bins)))
+				self.egress_tput[flow_id] = [0.0] + (
+					departure_bits / us_per_bin).tolist()
+				self.egress_t[flow_id] = self.bins_to_s(
+					first_bin, len(departure_bits) + 1)
 
-				for bin_id in xrange(min(egress_bins), max(egress_bins) + 1):
-					self.egress_tput[flow_id].append(
-						departures[flow_id].get(bin_id, 0) / us_per_bin)
-					self.egress_t[flow_id].append(self.bin_to_s(bin_id + 1))		  
+				# per-packet one-way delays in the order they were logged
+				self.delays[flow_id] = tunnel_log.delays(flow_id)
+				self.delays_t[flow_id] = (departure_ts - first_ts) / 1000.0
 
 			# calculate 95th percentile per-packet one-way delay
 			self.percentile_delay[flow_id] = None
 			if flow_id in self.delays:
-				self.percentile_delay[flow_id] = np.percentile(
-					self.delays[flow_id], 95, interpolation='nearest')
-				total_delays += self.delays[flow_id]
+				self.percentile_delay[flow_id] = tunnel_log.delay_percentile(
+					95, flow_id)
 
 			# calculate loss rate for each flow
-			if flow_id in arrivals and flow_id in departures:
-				flow_arrivals = sum(arrivals[flow_id].values())
-				flow_departures = sum(departures[flow_id].values())
-
+			if len(flow_arrival) and len(flow_departure):
 				self.loss_rate[flow_id] = None
 				if flow_arrivals > 0:
 					self.loss_rate[flow_id] = (
 						1 - 1.0 * flow_departures / flow_arrivals)
 
-		egress_times = [f.keys() for f in departures.values()]
+		# total egress throughput over the bins spanned by the flows
+		egress_times = []
+		for first_bin, departure_bits, departure_counts in \
+				departure_bins.values():
+			occupied = np.flatnonzero(departure_counts) + first_bin
+			egress_times.append(occupied.tolist())
 		first_egress = min(min(egress_times))
 		last_egress = max(max(egress_times))
-		self.total_egress_tput = []
-		self.total_egress_t = []
-		for bin_id in xrange(first_egress, last_egress + 1):
-			self.total_egress_tput.append(
-				sum([f.get(bin_id, 0) for f in departures.values()]) / us_per_bin)
-			self.total_egress_t.append(self.bin_to_s(bin_id + 1))  
+
+		total_first_bin, total_departure_bits, _ = tunnel_log.binned(
+			self.ms_per_bin, DEPARTURE)
+		total_departure_bits = total_departure_bits[
+			first_egress - total_first_bin:last_egress - total_first_bin + 1]
+		self.total_egress_tput = (total_departure_bits / us_per_bin).tolist()
+		self.total_egress_t = self.bins_to_s(
+			first_egress + 1, last_egress - first_egress + 1)
+
+		arrival = tunnel_log.events(ARRIVAL)
+		departure = tunnel_log.events(DEPARTURE)
+		total_arrivals = int(num_bits[arrival].sum())
+		total_departures = int(num_bits[departure].sum())
 
 		self.total_loss_rate = None
 		if total_arrivals > 0:
 			self.total_loss_rate = 1 - 1.0 * total_departures / total_arrivals
 
 		# calculate total average throughput and 95th percentile delay
+		departure_ts = ts[departure]
+		total_first_departure = float(departure_ts[0])
+		total_last_departure = float(departure_ts.max())
+
 		self.total_avg_egress = None
 		if total_last_departure == total_first_departure:
 			self.total_duration = 0
@@ -259,49 +212,93 @@ class TunnelGraph(object):
 			self.total_avg_egress = total_departures / (
 				1000.0 * self.total_duration)
 
-		self.total_percentile_delay = None
-		if total_delays:
-			self.total_percentile_delay = np.percentile(
-				total_delays, 95, interpolation='nearest')
+		total_delays = np.concatenate(
+			[self.delays[flow_id] for flow_id in self.flows
+			 if flow_id in self.delays])
+
+		self.total_percentile_delay = tunnel_log.delay_percentile(95)
 		self.mean_bottleneck_delay = np.mean(total_delays)
 
+		# departures of every flow within the fairness interval, one row per
+		# flow; bins without any departure of a flow are masked out
 		fairness_start_bin = self.ms_to_bin(max(first_departure.values()), first_ts)+1
 		fairness_end_bin = self.ms_to_bin(min(last_arrival.values()), first_ts)-1
 		self.fairness_binIds = list(range(fairness_start_bin, fairness_end_bin+1))
-		self.fairnesses = []
-		self.group_fairnesses = []
-		totals = {k:0 for k in departures.keys()}
-		group_totals = {}	 
-		for binId in self.fairness_binIds:
-			values = []
-			group_values = {}
-			for flowId in self.flows:
-				v = departures[flowId].get(binId, None)
-				if not v is None:
-					values.append(v)
-					group_id = self.flow_info[flowId]['group']
-					group_values[group_id] = group_values.get(group_id, 0)+v
-					totals[flowId] += v
-					group_totals[group_id] = group_totals.get(group_id, 0)+v
-
-			self.fairnesses.append(self.jain_fairness(values) if values and sum(values) > 0 else None)
-			self.group_fairnesses.append(self.jain_fairness(group_values.values()) if sum(group_values.values()) > 0 else None)
+		num_fairness_bins = len(self.fairness_binIds)
+
+		window_bits = np.zeros((len(self.flows), num_fairness_bins))
+		window_present = np.zeros(window_bits.shape, dtype=bool)
+		for row, flow_id in enumerate(self.flows):
+			if flow_id not in departure_bins:
+				continue
+
+			first_bin, departure_bits, departure_counts = departure_bins[flow_id]
+			lo = max(fairness_start_bin, first_bin)
+			hi = min(fairness_end_bin + 1, first_bin + len(departure_bits))
+			if lo >= hi:
+				continue
+
+			window = slice(lo - fairness_start_bin, hi - fairness_start_bin)
+			flow_window = slice(lo - first_bin, hi - first_bin)
+			window_bits[row, window] = departure_bits[flow_window]
+			window_present[row, window] = departure_counts[flow_window] > 0
+
+		group_ids = [self.flow_info[flow_id]['group'] for flow_id in self.flows]
+		groups = sorted(set(group_ids))
+		group_bits = np.zeros((len(groups), num_fairness_bins))
+		group_present = np.zeros(group_bits.shape, dtype=bool)
+		for row, group_id in enumerate(group_ids):
+			group_row = groups.index(group_id)
+			group_bits[group_row] += window_bits[row]
+			group_present[group_row] |= window_present[row]
+
+		self.fairnesses = self.jain_fairness_per_bin(window_bits, window_present)
+		self.group_fairnesses = self.jain_fairness_per_bin(
+			group_bits, group_present)
+
+		flow_totals = window_bits.sum(axis=1)
+		totals = {}
+		for row, flow_id in enumerate(self.flows):
+			if flow_id in departure_bins:
+				totals[flow_id] = int(flow_totals[row])
+		group_totals = {}
+		for row, group_id in enumerate(groups):
+			if group_present[row].any():
+				group_totals[group_id] = int(group_bits[row].sum())
 
 		self.fairness_t = [self.bin_to_s(b+1) for b in self.fairness_binIds]
 		t = self.bin_to_s(fairness_end_bin+1)-self.bin_to_s(fairness_start_bin)
 		self.converged_group_tputs = {k:(v/t/1000000.0) for k, v in group_totals.items()}
 		self.converged_tput = sum(self.converged_group_tputs.values())
-		
+
 		max_fairness_bin = self.fairnesses.index(max(self.fairnesses))
 		#time to max fairness, from start of fairness measurement
 		self.time_to_max_fairness = self.bin_to_s(max_fairness_bin)
-		self.throughput_relative_standard_deviation = {flowId:np.std(departures[flowId].values())/np.mean(departures[flowId].values()) for flowId in departures}
+		self.throughput_relative_standard_deviation = {}
+		for flow_id, (_, departure_bits, departure_counts) in \
+				departure_bins.items():
+			occupied = departure_bits[departure_counts > 0].astype(np.int64)
+			self.throughput_relative_standard_deviation[flow_id] = (
+				np.std(occupied) / np.mean(occupied))
 		self.interval_fairness = np.mean(self.fairnesses[max_fairness_bin:])
 		self.overall_fairness = self.jain_fairness(totals.values())
 		self.group_interval_fairness = np.mean(self.group_fairnesses[max_fairness_bin:])
 		self.group_overall_fairness = self.jain_fairness(group_totals.values())
-		
- 
+
+	def jain_fairness_per_bin(self, bits, present):
+		"""Jain fairness of each column of bits over its present rows, or
+		None for columns without any bits."""
+		counts = present.sum(axis=0)
+		totals = bits.sum(axis=0)
+		squares = (bits ** 2.0).sum(axis=0)
+
+		fairnesses = []
+		for count, total, square in zip(counts, totals, squares):
+			if count and total > 0:
+				fairnesses.append(float(total) ** 2.0 / square / count)
+			else:
+				fairnesses.append(None)
+		return fairnesses
 
 	def jain_fairness(self, values):
 		return sum(values)**2.0/sum(map(lambda x: x**2.0, values))/len(values)
@@ -474,8 +471,39 @@ class TunnelGraph(object):
 
 		return ret
 
+	def cache_params(self):
+		"""parameters the cached results of the tunnel log depend on"""
+		cache_params = [self.ms_per_bin, self.flow_info]
+		if self.capacity is not None:
+			cache_params.append(self.capacity.params())
+		return cache_params
+
+	def cache_results(self, cache, log_path, tunnel_results, sha1=None):
+		cache.put(log_path, 'tunnel_graph', self.cache_params(), tunnel_results,
+				  series=self.series, sha1=sha1)
+
+		# per-flow throughput, delay and loss and the duration are computed
+		# from all events of the log, so they depend on none of cache_params
+		flow_stats = {'duration': tunnel_results['duration'],
+					  'flow_data': tunnel_results['flow_data']}
+		cache.put(log_path, 'flow_stats', [], flow_stats)
+
 	def run(self):
-		self.parse_tunnel_log()
+		series = None
+		if self.cache:
+			series = self.cache.get_series(
+				self.tunnel_log, 'tunnel_graph', self.cache_params())
+
+		cached = series is not None
+		if cached:
+			# restore the series from the cache to redraw the graphs
+			self.__dict__.update(series)
+		else:
+			attrs = set(self.__dict__)
+			self.parse_tunnel_log()
+			series = dict((k, v) for k, v in self.__dict__.iteritems()
+						  if k not in attrs)
+		self.series = series
 
 		if self.throughput_graph:
 			self.plot_throughput_graph()
@@ -522,6 +550,11 @@ class TunnelGraph(object):
 		tunnel_results['flow_data'] = flow_data
 		tunnel_results['group_data'] = group_data
 
+		if self.cache and not cached:
+			# the log was hashed when parse_tunnel_log read it
+			sha1 = load_parsed_log(self.tunnel_log).sha1
+			self.cache_results(self.cache, self.tunnel_log, tunnel_results, sha1)
+
 		return tunnel_results
 
 
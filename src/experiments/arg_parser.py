@@ -13,6 +13,21 @@ def parse_benchmark(default_data_dir, default_tmp_dir):
 	parser.add_argument('--tmp_dir', type=str, default=default_tmp_dir, help='specify tmp dir (if not default)')
 	parser.add_argument('--verbose', action='store_true', default=False, help='enable full logging')
 	parser.add_argument('--no_ramdisk', action='store_true', default=False, help='do not make tmp_dir a ramkdisk')
+	parser.add_argument('--binary_logs', action='store_true', default=False, help='save tunnel logs in the binary format instead of text')
+	parser.add_argument('--merge_processes', type=int, default=1, help='merge the tunnel logs of the flows of each run in this many processes, on the CPUs of its experiment (default 1: stream them in the experiment\'s process, which uses the least memory)')
+	parser.add_argument('--concurrency', type=int, default=1, help='number of experiments to run at the same time, each pinned to its own CPUs (default 1)')
+	parser.add_argument('--max_load', type=float, default=0.9, help='CPU load (0-1) above which runs are flagged as overloaded in results.csv and no further experiments are started (default 0.9)')
+	parser.add_argument('--analysis_workers', type=int, default=0, help='analyze finished experiments in this many background processes on CPUs reserved for them, while the next experiments run (default 0: analyze each experiment right after running it)')
+	parser.add_argument('--traces', nargs='+', default=['constant'], choices=['constant', 'step', 'outage', 'cellular'], help='bottleneck uplink traces to sweep over (default constant): constant rate, a step down halfway, periodic outages, or markov-modulated cellular capacity')
+	parser.add_argument('--no_link_logs', action='store_true', default=False, help='do not log the bottleneck capacity with mm-link, the largest log of every run; it is derived from the traces instead')
+	parser.add_argument('--live_metrics', action='store_true', default=False, help='compute the metrics of each run while it runs and write them to <experiment>_live_run<N>.json; with --no_link_logs, the analysis reuses them instead of parsing the logs again')
+	parser.add_argument('--converge_window', type=float, default=None, help='stop each run once its total throughput and fairness were stable for this many seconds (default: always run for the full runtime)')
+	parser.add_argument('--min_runtime', type=float, default=30, help='seconds each run lasts at least with --converge_window (default 30)')
+	parser.add_argument('--budget', type=int, default=None, help='run at most this many experiments, starting with a coarse grid of RTTs and queue sizes and refining it where loss, fairness or utilization change sharply (default: run the full grid)')
+	parser.add_argument('--runs', type=int, default=1, help='number of runs of each experiment, or the minimum number of them with --ci_target (default 1)')
+	parser.add_argument('--ci_target', type=float, default=None, help='repeat each experiment until the 95%% confidence intervals of throughput, 95th percentile delay and fairness are narrower than +-CI_TARGET of their means, e.g. 0.05 (default: always do --runs runs)')
+	parser.add_argument('--max_runs', type=int, default=10, help='maximum number of runs of each experiment with --ci_target (default 10)')
+	parser.add_argument('--max_pending', type=int, default=1, help='maximum number of finished experiments waiting for an analysis worker (default 1)')
 	return parser.parse_args()
 
 def verify_schemes(schemes):
@@ -105,6 +120,15 @@ def parse_test_shared(local, remote, config_args):
 
         mode.add_argument('--run-times', metavar='TIMES', type=int, default=1,
                           help='run times of each scheme (default 1)')
+        mode.add_argument(
+            '--ci-target', metavar='FRACTION', type=float,
+            help='repeat the test until the 95%% confidence intervals of '
+            'throughput, 95th percentile delay and fairness are narrower '
+            'than +-FRACTION of their means, with --run-times as the '
+            'minimum number of runs (at least 2)')
+        mode.add_argument('--max-run-times', metavar='TIMES', type=int,
+                          default=10, help='maximum number of runs with '
+                          '--ci-target (default 10)')
         mode.add_argument('--start-run-id', metavar='ID', type=int, default=1,
                           help='run ID to start with')
         mode.add_argument('--random-order', action='store_true',
@@ -117,6 +141,14 @@ def parse_test_shared(local, remote, config_args):
         mode.add_argument(
             '--pkill-cleanup', action='store_true', help='clean up using pkill'
             ' (send SIGKILL when necessary) if there were errors during tests')
+        mode.add_argument(
+            '--binary-logs', action='store_true',
+            help='save tunnel logs in the binary format instead of text')
+        mode.add_argument(
+            '--merge-processes', metavar='N', type=int, default=1,
+            help='merge the tunnel logs of the flows in N processes (0: one '
+            'per CPU) instead of streaming them in the test process, which '
+            'uses more memory (default 1)')
 
 
 def parse_test_local(local):
@@ -141,6 +173,10 @@ def parse_test_local(local):
         help='extra arguments to pass to mm-link when running locally. Note '
         'that uplink (downlink) always represents the link from sender to '
         'receiver (from receiver to sender)')
+    local.add_argument(
+        '--no-link-logs', action='store_true',
+        help='do not log the capacity of mm-link; the analysis derives it '
+        'from the traces instead')
 
 
 def parse_test_remote(remote):
@@ -165,6 +201,11 @@ def parse_test_remote(remote):
     remote.add_argument(
         '--ntp-addr', metavar='HOST',
         help='address of an NTP server to query clock offset')
+    remote.add_argument(
+        '--clock-offset-validity', metavar='SECONDS', type=float,
+        default=120, help='reuse clock offsets measured by earlier runs for '
+        'this many seconds, unless they changed by more than 2 ms between '
+        'measurements; 0 measures them in every run (default 120)')
     remote.add_argument(
         '--local-desc', metavar='DESC',
         help='extra description of the local side')
@@ -182,6 +223,8 @@ def verify_test_args(args):
             sys.exit('Cannot apply --prepend-mm-cmds, --append-mm-cmds or '
                      '--extra-mm-link-args without pantheon tunnels')
 
+    if args.ci_target is not None and args.ci_target <= 0:
+        sys.exit('--ci-target must be positive')
     if args.runtime > 60 or args.runtime <= 0:
         sys.exit('runtime cannot be non-positive or greater than 60 s')
     if args.flows < 0:
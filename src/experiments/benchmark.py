@@ -2,123 +2,294 @@
 
 from experiment import Experiment
 import os
+import sys
 from helpers.subprocess_wrappers import check_output
 from helpers import utils
 import context
 from router import Router
 from trace import Trace
+from trace_synthesis import ScheduleTrace, OnOffTrace, MarkovTrace
 import math
+import shutil
 import itertools
 import traceback
-import pandas as pd
 from multiprocessing import Process, Lock
 import arg_parser
+from scheduler import Scheduler, AnalysisPool
+from helpers.results_store import ResultsStore, experiment_rows, results_table
+from helpers.repetitions import Repetitions
+from sweep_planner import AdaptiveSweep, result_metrics
 
 class Benchmark():
-	def __init__(self, scheme, ramdisk = True, tmp_dir='./tmp_data', data_dir = './data', verbose=False):
+	def __init__(self, scheme, ramdisk = True, tmp_dir='./tmp_data', data_dir = './data', verbose=False, binary_logs=False, merge_processes=1, concurrency=1, max_load=0.9, analysis_workers=0, max_pending=1, traces=('constant',), link_logs=True, live_metrics=False, converge_window=None, min_runtime=30, budget=None, runs=1, ci_target=None, max_runs=10):
+		"""
+			Keyword Arguments:
+			concurrency -- number of experiments to run at the same time, each pinned to its own CPUs
+			max_load -- CPU load (0-1) above which runs are flagged as overloaded and no further experiments are started
+			analysis_workers -- number of background processes analyzing finished experiments on CPUs reserved for them, while the next experiments run (0: analyze each experiment right after running it)
+			max_pending -- maximum number of finished experiments waiting for an analysis worker, each keeping its logs in tmp_dir
+			traces -- names of the bottleneck uplink traces to sweep over, see TRACES
+			link_logs -- log the capacity of the bottleneck with mm-link, instead of deriving it from the traces
+			live_metrics -- compute the metrics of each run while it runs, so that with link_logs=False its analysis only draws the graphs
+			converge_window -- stop runs once throughput and fairness were stable for this many seconds, see Experiment
+			min_runtime -- seconds a run lasts at least when it is stopped early
+			budget -- maximum number of experiments to run, planned adaptively by an AdaptiveSweep that refines a coarse grid where results change sharply (None: run the full grid)
+			runs -- number of runs of each experiment, or the minimum number of them with ci_target
+			ci_target -- repeat each experiment until the confidence intervals of its results are narrower than +-ci_target of their means, see Repetitions (None: always do runs runs)
+			max_runs -- maximum number of runs of each experiment with ci_target
+		"""
 		check_output('python %s --schemes %s'%(os.path.join(context.src_dir, 'experiments/setup.py'), scheme), shell=True) #loads all schemes after reboot
 		self.tmp_dir = tmp_dir
 		self.data_dir = data_dir
 		if ramdisk:
 			utils.make_sure_dir_exists(self.tmp_dir)
 			res = check_output('df -T %s'%self.tmp_dir, shell=True)
-			if not 'tmpfs' in res: check_output('sudo mount -t tmpfs -o size=300M tmpfs %s' % self.tmp_dir, shell=True)
+			#room for the logs of running experiments and of those waiting for analysis
+			ramdisk_size = 300 * (concurrency + (analysis_workers + max_pending if analysis_workers else 0))
+			if not 'tmpfs' in res: check_output('sudo mount -t tmpfs -o size=%dM tmpfs %s' % (ramdisk_size, self.tmp_dir), shell=True)
 			else: print('%s is already a ramdisk' %self.tmp_dir)
 		self.scheme = scheme
 		self.verbose = verbose
+		self.binary_logs = binary_logs
+		self.merge_processes = merge_processes
+		self.concurrency = concurrency
+		self.max_load = max_load
+		self.analysis_workers = analysis_workers
+		self.max_pending = max_pending
+		for trace in traces:
+			if trace not in self.TRACES: raise Exception('unknown trace \'%s\'' % trace)
+		self.traces = traces
+		self.link_logs = link_logs
+		self.live_metrics = live_metrics
+		self.converge_window = converge_window
+		self.min_runtime = min_runtime
+		self.budget = budget
+		self.runs = runs
+		self.ci_target = ci_target
+		self.max_runs = max_runs
+		self.repetitions = Repetitions(runs, max_runs, ci_target) if ci_target else None
+		self.exceptions_lock = Lock()
 		self.build_experiments()
 		
+	#bottleneck uplink traces a benchmark can sweep over
+	TRACES = ['constant', 'step', 'outage', 'cellular']
+
+	def build_trace(self, name, mbps, runtime):
+		"""return the uplink Trace named name (see TRACES) with an average rate of about mbps for experiments of runtime seconds"""
+		runtime_ms = runtime*1000
+		if name == 'constant':
+			return Trace(mbps=mbps)
+		if name == 'step':
+			#capacity drops to a third halfway through
+			return ScheduleTrace([(0, 1.5*mbps), (runtime_ms/2, 0.5*mbps)], runtime_ms, name=name)
+		if name == 'outage':
+			#1 s outages every 10 s
+			return OnOffTrace(mbps*10/9.0, 9000, 1000, runtime_ms, name=name)
+		if name == 'cellular':
+			#markov-modulated rate changing every 500 ms, starting in the middle state
+			return MarkovTrace([0.25*mbps, mbps, 1.75*mbps], [[0.9, 0.1, 0.0], [0.05, 0.9, 0.05], [0.0, 0.1, 0.9]],
+							   500, runtime_ms, initial=1, name=name, poisson=True)
+		raise Exception('unknown trace \'%s\'' % name)
+
 	def build_experiments(self):
-		runs = 1
+		runs = self.runs
 		runtime = 90
 		routers = 11
 		delays = [0, 25, 50, 75, 100]
-		self.solo =  self.build_rtt_experiments(self.scheme, self.scheme, delays, runs, runtime, routers)
-		self.mixed = self.build_rtt_experiments(self.scheme, 'cubic'	, delays, runs, runtime, routers)
-		print('Expected runtime: %d seconds'%(runs*runtime*routers*len(delays)**2*2))
+		self.solo = []
+		self.mixed = []
+		#(scheme_a, scheme_b, trace), index of rtt_a, of rtt_b and of the queue size of each experiment
+		self.grid_points = {}
+		self.grid_shape = (len(delays), len(delays), routers)
+		#distance between the points of the first, coarse grid an adaptive sweep runs
+		self.coarse_steps = (2, 2, 5)
+		for trace in self.traces:
+			self.solo +=  self.build_rtt_experiments(self.scheme, self.scheme, delays, runs, runtime, routers, trace)
+			self.mixed += self.build_rtt_experiments(self.scheme, 'cubic'	, delays, runs, runtime, routers, trace)
+		num_experiments = routers*len(delays)**2*2*len(self.traces)
+		if self.budget is not None: num_experiments = min(num_experiments, self.budget)
+		max_runs = self.repetitions.max_runs if self.repetitions else runs
+		bounded = self.budget is not None or self.repetitions is not None
+		print('Expected runtime: %s%d seconds'%('at most ' if bounded else '', max_runs*runtime*num_experiments/self.concurrency))
 
-	def build_rtt_experiments(self, scheme_a, scheme_b, delays, runs, runtime, routers):
+	def build_rtt_experiments(self, scheme_a, scheme_b, delays, runs, runtime, routers, trace='constant'):
 		rtt_unfairness_routers = [Router(delay=d) for d in delays]
-		bottleneck_routers = self.build_router_range(12, 25, routers, range_factor=20)
+		bottleneck_routers = self.build_router_range(12, 25, routers, range_factor=20, up_trace=self.build_trace(trace, 12, runtime))
 		
 		res = []
-		for rtt_a, rtt_b in itertools.product(rtt_unfairness_routers, rtt_unfairness_routers):
+		queue_index = dict((q_size, i) for i, q_size in enumerate(sorted(bottleneck_routers)))
+		for (i_a, rtt_a), (i_b, rtt_b) in itertools.product(enumerate(rtt_unfairness_routers), repeat=2):
 			#build an experiment for each combination of rtt routers
 			flows = [{'scheme':scheme_a, 'sender_router':rtt_a, 'count':3, 'flow_info':{'name':'%s_%d'%(scheme_a, rtt_a.args['delay'])}},
 				 {'scheme':scheme_b, 'sender_router':rtt_b, 'count':3, 'flow_info':{'name':'%s_%d'%(scheme_b, rtt_b.args['delay'])}}]
 			
-			exs = [	Experiment(  '3x%s%dms_3x%s%dms_queue%dB'%(scheme_a, rtt_a.args['delay'],scheme_b, rtt_b.args['delay'], q_size),
-				flows,
-				router,
-				runtime=runtime,
-				interval=5,
-				runs=runs,
-				tmp_dir=self.tmp_dir,
-				data_dir=self.data_dir)
-				for q_size, router in bottleneck_routers.items()]
-			res.extend(exs)
+			for q_size, router in bottleneck_routers.items():
+				name = '3x%s%dms_3x%s%dms_queue%dB'%(scheme_a, rtt_a.args['delay'],scheme_b, rtt_b.args['delay'], q_size)
+				if trace != 'constant': name += '_%s' % trace
+				self.grid_points[name] = ((scheme_a, scheme_b, trace), i_a, i_b, queue_index[q_size])
+				#each experiment gets its own directories, so that experiments can run concurrently
+				res.append(Experiment(name,
+					flows,
+					router,
+					runtime=runtime,
+					interval=5,
+					runs=runs,
+					tmp_dir=os.path.join(self.tmp_dir, name),
+					data_dir=os.path.join(self.data_dir, name),
+					binary_logs=self.binary_logs,
+					merge_processes=self.merge_processes,
+					link_logs=self.link_logs,
+					live_metrics=self.live_metrics,
+					converge_window=self.converge_window,
+					min_runtime=self.min_runtime,
+					ci_target=self.ci_target,
+					max_runs=self.max_runs))
 		return res	   
 
-	def build_router_range(self, mbps, delay, num_routers, range_factor=10):
+	def build_router_range(self, mbps, delay, num_routers, range_factor=10, up_trace=None):
 		"""return a dict where
 			values are routers with throughput 'mpbs' and delay 'delay' each, and queue sizes distributed logarithmically from bdp up to ranger_factor x bdp
-			keys are the respectively used queue sizes"""
+			keys are the respectively used queue sizes
+			up_trace replaces the constant uplink trace of rate 'mbps' if given"""
 		bdp_bits = mbps*delay*1000.0*2
 		bdp_bytes = bdp_bits/8
 		step_size = 1.0/(num_routers-1)
 		routers = {}
 		current_queue_size = int(bdp_bytes)
 		for i in range(num_routers):
-			r = Router(delay=delay, up_trace=Trace(mbps=mbps), up_queue_type='droptail', up_queue_args = 'bytes=%d'%int(current_queue_size), down_trace=Trace(mbps=mbps))
+			r = Router(delay=delay, up_trace=up_trace or Trace(mbps=mbps), up_queue_type='droptail', up_queue_args = 'bytes=%d'%int(current_queue_size), down_trace=Trace(mbps=mbps))
 			routers[int(current_queue_size)] = r
 			current_queue_size *= math.pow(range_factor, step_size)
 		return routers
 
+	def log_exception(self):
+		with self.exceptions_lock:
+			with open(os.path.join(context.src_dir, 'experiments/exceptions.txt'), 'a+') as log:
+				traceback.print_exc(file=log)
+
+	def run_experiment(self, ex):
+		"""run and analyze an experiment and return its rows for results.csv, or None if it failed (runs in a process of the scheduler)"""
+		if not self.emulate_experiment(ex):
+			return None
+		return self.analyze_experiment(ex)
+
+	def emulate_experiment(self, ex):
+		"""run an experiment, leaving its logs in its tmp dir, and return whether it succeeded"""
+		print('running experiment %s' % ex.experiment_name)
+		try:
+			utils.make_sure_dir_exists(ex.data_dir)
+			with utils.nostdout(do_nothing=self.verbose, log_path=os.path.join(ex.data_dir, 'stdout.txt')):
+				ex.run()
+		except Exception:
+			self.log_exception()
+			return False
+		return True
+
+	def analyze_experiment(self, ex):
+		"""analyze the logs of a finished experiment, move its graphs to its data dir and return its rows for results.csv, or None if it failed"""
+		try:
+			with utils.nostdout(do_nothing=self.verbose, log_path=os.path.join(ex.data_dir, 'analysis.txt')):
+				rows = experiment_rows(ex, ex.plot())
+
+				#killing all iperf processes would break concurrently running experiments
+				ex.cleanup_files(kill_9_iperf=self.concurrency == 1 and not self.analysis_workers)
+		except Exception:
+			self.log_exception()
+			return None
+
+		shutil.rmtree(ex.tmp_dir, ignore_errors=True)
+		return rows
+
+	def store_rows(self, store, completed, ex_rows, load):
+		if ex_rows is None:
+			return
+		ex_rows = [data for data in ex_rows if (data['ex_name'], data['run_id']) not in completed]
+		for data in ex_rows:
+			data.update(load)
+		store.append(ex_rows)
+
+	def run_pipelined(self, scheduler, experiments, store, completed):
+		"""run experiments while analyzing finished ones in the background, on CPUs the scheduler keeps free of experiments"""
+		cpus = scheduler.reserved_cpus or None
+		if cpus is None:
+			sys.stderr.write('Warning: no CPUs left to reserve for analysis, analysis workers compete with experiments\n')
+		analysis = AnalysisPool(experiments, self.analyze_experiment, workers=self.analysis_workers, cpus=cpus, max_pending=self.max_pending)
+
+		loads = {}
+		for index, ex, emulated, load in scheduler.run(experiments, self.emulate_experiment):
+			if emulated:
+				loads[index] = load
+				#blocks while max_pending experiments wait for analysis, which holds back the next experiments
+				analysis.submit(index)
+			for i, ex_rows in analysis.finished():
+				self.store_rows(store, completed, ex_rows, loads.pop(i))
+
+		for i, ex_rows in analysis.finished(block=True):
+			self.store_rows(store, completed, ex_rows, loads.pop(i))
+		analysis.close()
+
+	def run_batch(self, scheduler, experiments, store):
+		"""run the experiments whose runs are not all in the results store already"""
+		completed = store.completed_runs()
+		stored = {}
+		if self.repetitions is not None:
+			for data in store.load():
+				stored.setdefault(data['ex_name'], []).append(data)
+		missing = [ex for ex in experiments if not self.experiment_completed(ex, completed, stored.get(ex.experiment_name, []))]
+		if len(missing) < len(experiments):
+			print('Skipping %d completed experiments found in %s' % (len(experiments) - len(missing), store.path))
+
+		if self.analysis_workers:
+			self.run_pipelined(scheduler, missing, store, completed)
+		else:
+			for index, ex, ex_rows, load in scheduler.run(missing, self.run_experiment):
+				self.store_rows(store, completed, ex_rows, load)
+
+	def experiment_completed(self, ex, completed, rows):
+		"""whether all runs of an experiment are in the results store, or with ci_target, whether its stored rows need no further runs"""
+		if self.repetitions is None:
+			return all((ex.experiment_name, run_id) in completed for run_id in range(1, ex.runs+1))
+		return bool(rows) and self.repetitions.done(rows)
+
+	def run_adaptive(self, scheduler, experiments, store):
+		"""run at most budget experiments, starting with a coarse grid and refining it where loss, fairness or utilization change sharply between neighbouring experiments
+
+		Experiments are planned from the results store only, so that an interrupted sweep resumes with the same plan."""
+		by_point = dict((self.grid_points[ex.experiment_name], ex) for ex in experiments)
+		groups = sorted(set(point[0] for point in by_point))
+		sweep = AdaptiveSweep(groups, self.grid_shape, self.coarse_steps, budget=self.budget)
+		batch = sweep.initial_points()
+		while batch:
+			print('Adaptive sweep: running %d more experiments, %d of a budget of %d planned' % (len(batch), len(sweep.planned), self.budget))
+			self.run_batch(scheduler, [by_point[point] for point in batch], store)
+
+			rows = {}
+			for data in store.load():
+				if data['ex_name'] in self.grid_points:
+					rows.setdefault(self.grid_points[data['ex_name']], []).append(data)
+			batch = sweep.refine(dict((point, result_metrics(point_rows)) for point, point_rows in rows.items() if point in sweep.planned))
+
 	def run(self):
-		ex_identifiers = ['ex_name', 'run_id']
-		ex_parameters = ['bottleneck_tput', 'q_size', 'scheme_a', 'scheme_b', 'rtprop_a', 'rtprop_b', 'runtime']
-		ex_results = ['loss', 'interval_fairness', 'time_to_max_fairness', 'delay', 'throughput', 'duration'] + ['throughput_rsd%d'%i for i in range(1, 7)]
-		results = pd.DataFrame(columns=ex_identifiers + ex_parameters + ex_results)
-		for ex in self.solo + self.mixed:
-			print('running experiment %s' % ex.experiment_name)
-			try:
-				with utils.nostdout(do_nothing=self.verbose):
-					ex.run()
-					ex_results = ex.plot()
-					for run_id, res in ex_results.items():
-						res.pop('stats')
-						data = {}
-						data['ex_name']=ex.experiment_name
-						data['run_id']=int(run_id)
-						data['bottleneck_tput']=ex.router.up_trace.mbps
-						data['bottleneck_rtprop']=2*ex.router.delay
-						data['q_size']=int(ex.router.up_queue_args.split('=')[1])
-						data['scheme_a']=ex.flows[0]['scheme']
-						data['scheme_b']=ex.flows[1]['scheme']
-						data['rtprop_a']=2*ex.flows[0]['sender_router'].delay
-						data['rtprop_b']=2*ex.flows[1]['sender_router'].delay
-						data['runtime']=ex.runtime
-						for flow_id, rsd in res.pop('throughput_relative_standard_deviation').items():
-							data['throughput_rsd%d'%flow_id]=rsd
-						data['scheme_a_tput'] = res['group_data'][0]['tput']
-						data['scheme_b_tput'] = res['group_data'][1]['tput']
-						res.pop('group_data')						
-						data.update(res)
-
-						results = results.append(data, ignore_index=True)
-
-					ex.cleanup_files()
-			except Exception:
-				with open(os.path.join(context.src_dir, 'experiments/exceptions.txt'), 'a+') as log:
-					traceback.print_exc(file=log)
-				continue
-
-		results.to_csv(path_or_buf=os.path.join(self.data_dir, 'results.csv'), index=False)   
+		utils.make_sure_dir_exists(self.data_dir)
+		store = ResultsStore(os.path.join(self.data_dir, 'results.jsonl'))
+		experiments = self.solo + self.mixed
+		#the processes running experiments are forked from this one and inherit the git summary instead of each computing it
+		utils.get_git_summary()
+		scheduler = Scheduler(concurrency=self.concurrency, max_load=self.max_load, reserve=self.analysis_workers)
+		if self.budget is None:
+			self.run_batch(scheduler, experiments, store)
+		else:
+			self.run_adaptive(scheduler, experiments, store)
+
+		#keep the order of experiments regardless of when they finished
+		order = dict((ex.experiment_name, i) for i, ex in enumerate(experiments))
+		rows = sorted(store.load(), key=lambda data: (order.get(data['ex_name'], len(order)), data['run_id']))
+		results_table(rows).to_csv(path_or_buf=os.path.join(self.data_dir, 'results.csv'), index=False)   
 
 if __name__ == '__main__':
 	default_data_dir = os.path.join(context.src_dir, 'experiments/data')
 	default_tmp_dir = os.path.join(context.src_dir, 'experiments/tmp_data')
 	args = arg_parser.parse_benchmark(default_data_dir, default_tmp_dir)
-	b = Benchmark(args.scheme, ramdisk = not args.no_ramdisk, tmp_dir = args.tmp_dir, data_dir = args.data_dir, verbose = args.verbose)
+	b = Benchmark(args.scheme, ramdisk = not args.no_ramdisk, tmp_dir = args.tmp_dir, data_dir = args.data_dir, verbose = args.verbose, binary_logs = args.binary_logs, merge_processes = args.merge_processes, concurrency = args.concurrency, max_load = args.max_load, analysis_workers = args.analysis_workers, max_pending = args.max_pending, traces = args.traces, link_logs = not args.no_link_logs, live_metrics = args.live_metrics, converge_window = args.converge_window, min_runtime = args.min_runtime, budget = args.budget, runs = args.runs, ci_target = args.ci_target, max_runs = args.max_runs)
 	b.run()
 
@@ -12,7 +12,7 @@ from helpers.subprocess_wrappers import check_output
 
 class Experiment():
     """ Wrapper for multi scheme experiments"""
-    def __init__(self, experiment_name, flows, router, tmp_dir = './tmp_data', data_dir = './data', runtime=30, interval=1, runs=1):
+    def __init__(self, experiment_name, flows, router, tmp_dir = './tmp_data', data_dir = './data', runtime=30, interval=1, runs=1, binary_logs=False, merge_processes=1, link_logs=True, live_metrics=False, converge_window=None, min_runtime=None, ci_target=None, max_runs=10):
         """
             Arguments:
             experiment_name -- the name the experiment is referenced by in report, plots, and filenames
@@ -29,16 +29,27 @@ class Experiment():
             tmp_dir -- path of temporary experiment data to be stored in, such as logs (will be cleared when cleanup is called)
             runtime -- experiment length in seconds
             interval -- interval between starting flows in seconds
-            runs -- number of repetitions of experiment
+            runs -- number of repetitions of experiment, or the minimum number of them with ci_target
+            binary_logs -- save tunnel logs in the binary format instead of text
+            merge_processes -- number of processes merging the tunnel logs of a run, 0 for one per CPU (default 1: merge them in this process, which uses the least memory)
+            link_logs -- log the capacity of the bottleneck with mm-link, instead of deriving it from the traces
+            live_metrics -- compute the metrics of each run from the tunnel logs while it runs, see analysis/live_metrics.py
+            converge_window -- stop runs once throughput and fairness were stable for this many seconds (default None: always run for runtime)
+            min_runtime -- seconds a run lasts at least when it is stopped early
+            ci_target -- repeat the experiment until the 95% confidence intervals of throughput, delay and fairness are narrower than +-ci_target of their means, see helpers/repetitions.py (default None: always run runs times)
+            max_runs -- maximum number of repetitions with ci_target
         """
         self.experiment_name = experiment_name
         self.runs = runs
         self.data_dir = data_dir
         self.tmp_dir = tmp_dir
+        #not in utils.tmp_dir, which concurrently running experiments share
+        self.tunnel_log_dir = os.path.join(tmp_dir, 'tunnel_logs')
         self.next_flow_group_id = 0
         self.router = router
         self.flows = flows
         self.runtime=runtime
+        self.link_logs = link_logs
         converted_flows = []
         for flow in flows:
             for k in flow.keys():
@@ -58,6 +69,7 @@ class Experiment():
         args['flows']=len(converted_flows)
         args['mode']='local'
         args['data_dir']=self.tmp_dir
+        args['tunnel_log_dir']=self.tunnel_log_dir
         args['runtime']=runtime
         args['interval']=interval
         args['start_run_id']=1
@@ -68,6 +80,14 @@ class Experiment():
         args['all']=None
         args['schemes']=None
         args['pkill_cleanup']=None
+        args['binary_logs']=binary_logs
+        args['merge_processes']=merge_processes
+        args['no_link_logs']=not link_logs
+        args['live_metrics']=live_metrics
+        args['converge_window']=converge_window
+        args['min_runtime']=min_runtime
+        args['ci_target']=ci_target
+        args['max_run_times']=max_runs
 
         args['prepend_mm_cmds']=router.get_mahimahi_command(include_link=False)
         args['append_mm_cmds']=''
@@ -102,23 +122,24 @@ class Experiment():
         Args = namedtuple('Args', plt_args.keys())
         p = Plot(Args(**plt_args), {i+1:flow['flow_info'] for i, flow in enumerate(self.args_tuple.test_config['flows'])})
         p.run()
+        #with ci_target, the number of runs is only known once they finished
+        self.runs = p.run_times
         return p.perf_data[self.experiment_name]
 
     def cleanup_files(self, kill_9_iperf = True):
 
         #1. delete .log files explicitly
-        log_types = ['acklink', 'datalink', 'mm_acklink', 'mm_datalink', 'stats']
+        log_types = ['acklink', 'datalink', 'stats']
+        if self.link_logs: log_types += ['mm_acklink', 'mm_datalink']
         run_ids = list(range(1, self.runs+1))
         file_names = ['%s_%s_run%d.log'%(self.experiment_name, t, i) for t, i in itertools.product(log_types, run_ids)]
+        if not self.link_logs: file_names += ['%s_link_run%d.json'%(self.experiment_name, i) for i in run_ids]
         file_paths = [os.path.join(self.tmp_dir, f) for f in file_names]
         for f in file_paths:
             os.remove(f)
 
-        #2. delete all .log.ingress and .log.egress containing experiment name
-        for filename in os.listdir(utils.tmp_dir):
-            if not self.experiment_name in filename: continue
-            path = os.path.join(utils.tmp_dir, filename)
-            os.remove(path)
+        #2. delete the .log.ingress and .log.egress files of the tunnels
+        shutil.rmtree(self.tunnel_log_dir, ignore_errors=True)
 
         #3. move all remaining files (graphs) to persistent data folder
 	utils.make_sure_dir_exists(self.data_dir)
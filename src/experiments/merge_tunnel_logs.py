@@ -1,8 +1,27 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import argparse
+import shutil
+import tempfile
 import heapq
+import multiprocessing
+from collections import OrderedDict
+
+import context
+from helpers.tunnel_log import (
+    open_events, open_log_writer, convert_tunnel_log, read_binary_log,
+    iter_binary_events, ms_to_us, text_init_ts, MAX_RECORD_FLOW, ARRIVAL,
+    DEPARTURE, CAPACITY)
+
+
+# packets that have not left a tunnel after this many ms are considered lost
+DEFAULT_MAX_DELAY = 60000
+
+
+class MergeError(Exception):
+    pass
 
 
 def parse_arguments():
@@ -29,6 +48,13 @@ def parse_arguments():
     single_parser.add_argument(
         '-e-clock-offset', metavar='MS', type=float,
         help='clock offset on the end where egress log is saved')
+    single_parser.add_argument(
+        '--max-delay', metavar='MS', type=float, default=DEFAULT_MAX_DELAY,
+        help='consider packets lost that have not left the tunnel after '
+        'this many ms (default %(default)s)')
+    single_parser.add_argument(
+        '--binary', action='store_true',
+        help='write the tunnel log in the binary format')
 
     # subparser for multiple mode
     multiple_parser = subparsers.add_parser(
@@ -42,6 +68,23 @@ def parse_arguments():
     multiple_parser.add_argument(
         '-o', action='store', metavar='OUTPUT-LOG', dest='output_log',
         required=True, help='output log after merging')
+    multiple_parser.add_argument(
+        '--binary', action='store_true',
+        help='write the output log in the binary format')
+
+    # subparser for convert mode
+    convert_parser = subparsers.add_parser(
+        'convert', help='convert a tunnel log between the text and the '
+        'binary format')
+    convert_parser.add_argument(
+        '-i', action='store', metavar='INPUT-LOG', dest='input_log',
+        required=True, help='text or binary tunnel log')
+    convert_parser.add_argument(
+        '-o', action='store', metavar='OUTPUT-LOG', dest='output_log',
+        required=True, help='tunnel log after conversion')
+    convert_parser.add_argument(
+        '--to', choices=['text', 'binary'], required=True,
+        help='format of the output log')
 
     return parser.parse_args()
 
@@ -51,48 +94,74 @@ def parse_line(line):
     return (float(ts), int(uid), int(size))
 
 
-def single_mode(args):
-    recv_log = open(args.ingress_log)
-    send_log = open(args.egress_log)
-    output_log = open(args.output_log, 'w')
+def single_merge(ingress_log, egress_log, i_clock_offset=None,
+                 e_clock_offset=None, max_delay=DEFAULT_MAX_DELAY):
+    """Merge the ingress log and egress log of a single tunnel.
+
+    Returns the init timestamp of the tunnel log and a generator of its
+    (ts, event, size, delay, flow) events. Packets still in the tunnel after
+    max_delay ms are considered lost (max_delay=None keeps them until the
+    end), and departures of unknown packets are dropped. Raises MergeError if
+    a log is empty or a packet changed its size in the tunnel.
+    """
+    recv_log = open(ingress_log)
+    send_log = open(egress_log)
 
     # retrieve initial timestamp of sender from the first line
     line = send_log.readline()
     if not line:
-        sys.exit('Warning: egress log is empty\n')
+        raise MergeError('egress log is empty')
 
     send_init_ts = float(line.rsplit(':', 1)[-1])
-    if args.e_clock_offset is not None:
-        send_init_ts += args.e_clock_offset
+    if e_clock_offset is not None:
+        send_init_ts += e_clock_offset
 
     min_init_ts = send_init_ts
 
     # retrieve initial timestamp of receiver from the first line
     line = recv_log.readline()
     if not line:
-        sys.exit('Warning: ingress log is empty\n')
+        raise MergeError('ingress log is empty')
 
     recv_init_ts = float(line.rsplit(':', 1)[-1])
-    if args.i_clock_offset is not None:
-        recv_init_ts += args.i_clock_offset
+    if i_clock_offset is not None:
+        recv_init_ts += i_clock_offset
 
     if recv_init_ts < min_init_ts:
         min_init_ts = recv_init_ts
 
-    output_log.write('# init timestamp: %.3f\n' % min_init_ts)
-
     # timestamp calibration to ensure non-negative timestamps
     send_cal = send_init_ts - min_init_ts
     recv_cal = recv_init_ts - min_init_ts
 
-    # construct a hash table using uid as keys
-    send_pkts = {}
-    for line in send_log:
-        (send_ts, send_uid, send_size) = parse_line(line)
-        send_pkts[send_uid] = (send_ts + send_cal, send_size)
+    # the egress log is read twice: once to merge arrivals and once ahead of
+    # departures to pair them with their arrivals
+    window_log = open(egress_log)
+    window_log.readline()
+
+    return min_init_ts, merge_sorted(send_log, recv_log, window_log,
+                                     send_cal, recv_cal, max_delay)
 
-    send_log.seek(0)
-    send_log.readline()
+
+def read_send(send_log, send_cal):
+    line = send_log.readline()
+    if not line:
+        return None
+
+    (send_ts, send_uid, send_size) = parse_line(line)
+    return (send_ts + send_cal, send_uid, send_size)
+
+
+def merge_sorted(send_log, recv_log, window_log, send_cal, recv_cal,
+                 max_delay):
+    # packets that came into the tunnel but have not left it yet, keyed by
+    # uid in the order they came in. Packets are removed once they leave the
+    # tunnel or once they are older than max_delay, so the window only holds
+    # packets in flight rather than every packet in the egress log.
+    window = OrderedDict()
+    window_next = read_send(window_log, send_cal)
+    evicted = 0
+    unmatched = 0
 
     # merge two sorted logs into one
     send_l = send_log.readline()
@@ -110,157 +179,285 @@ def single_mode(args):
             recv_ts_cal = recv_ts + recv_cal
 
         if (send_l and recv_l and send_ts_cal <= recv_ts_cal) or not recv_l:
-            output_log.write('%.3f + %s\n' % (send_ts_cal, send_size))
+            yield send_ts_cal, ARRIVAL, send_size, None, 0
             send_l = send_log.readline()
             if send_l:
                 (send_ts, send_uid, send_size) = parse_line(send_l)
         elif (send_l and recv_l and send_ts_cal > recv_ts_cal) or not send_l:
-            if recv_uid in send_pkts:
-                (paired_send_ts, paired_send_size) = send_pkts[recv_uid]
+            if max_delay is not None:
+                # evict packets that never left the tunnel
+                while window:
+                    (uid, (ts, size)) = next(window.iteritems())
+                    if ts >= recv_ts_cal - max_delay:
+                        break
+                    del window[uid]
+                    evicted += 1
+
+            # read ahead in the egress log; clock offsets may make a packet
+            # seem to leave the tunnel shortly before it came in
+            while recv_uid not in window and window_next is not None:
+                (ts, uid, size) = window_next
+                if max_delay is not None and ts > recv_ts_cal + max_delay:
+                    break
+                window[uid] = (ts, size)
+                window_next = read_send(window_log, send_cal)
+
+            paired = window.pop(recv_uid, None)
+            if paired is None:
+                # nonexistent packet or packet delayed by more than max_delay
+                unmatched += 1
+            else:
+                (paired_send_ts, paired_send_size) = paired
                 # inconsistent packet size
                 if paired_send_size != recv_size:
-                    sys.exit(
-                        'Warning: packet %s came into tunnel with size %s '
-                        'but left with size %s\n' %
+                    raise MergeError(
+                        'packet %s came into tunnel with size %s '
+                        'but left with size %s' %
                         (recv_uid, paired_send_size, recv_size))
-            else:
-                # nonexistent packet
-                sys.exit('Warning: received a packet with nonexistent '
-                         'uid %s\n' % recv_uid)
 
-            delay = recv_ts_cal - paired_send_ts
-            output_log.write('%.3f - %s %.3f\n'
-                             % (recv_ts_cal, recv_size, delay))
+                delay = recv_ts_cal - paired_send_ts
+                yield recv_ts_cal, DEPARTURE, recv_size, delay, 0
+
             recv_l = recv_log.readline()
             if recv_l:
                 (recv_ts, recv_uid, recv_size) = parse_line(recv_l)
 
+    sys.stderr.write('Merged %s and %s: %d packets evicted, %d departures '
+                     'unmatched\n' % (recv_log.name, send_log.name,
+                                      evicted, unmatched))
+
     recv_log.close()
     send_log.close()
-    output_log.close()
-
+    window_log.close()
 
-def push_to_heap(heap, index, log_file, init_ts_delta):
-    line = None
 
-    while True:
-        line = log_file.readline()
-        if not line:
-            break
+def write_events(output_log, events):
+    """Write events with a log writer and close it. Raises MergeError if an
+    event does not fit into a binary tunnel log."""
+    try:
+        for event in events:
+            output_log.write(*event)
+    except ValueError as e:
+        raise MergeError(str(e))
+    finally:
+        output_log.close()
 
-        if line.startswith('#'):
-            continue
 
-        # if log_file is mm-link-log
-        if index == -1:
-            # find the next delivery opportunity
-            if '#' in line:
-                break
-        else:
-            break
+def single_mode(args):
+    try:
+        init_ts, events = single_merge(args.ingress_log, args.egress_log,
+                                       args.i_clock_offset,
+                                       args.e_clock_offset, args.max_delay)
 
-    if line:
-        line_list = line.strip().split()
-        calibrated_ts = float(line_list[0]) + init_ts_delta
+        output_log = open_log_writer(args.output_log, init_ts,
+                                     binary=args.binary)
+        write_events(output_log, events)
+    except MergeError as e:
+        sys.exit('Warning: %s\n' % e)
 
-        line_list[0] = '%.3f' % calibrated_ts
-        if line_list[1] == '#':
-            line_list[2] = str(int(line_list[2]) - 4)
-        line = ' '.join(line_list)
-        heapq.heappush(heap, (calibrated_ts, index, line))
 
-    return line
+def push_to_heap(heap, index, events, init_ts_delta):
+    for (ts, event, size, delay, flow) in events:
+        # if events come from mm-link-log
+        if index == -1:
+            # find the next delivery opportunity
+            if event != CAPACITY:
+                continue
+            size -= 4
 
+        calibrated_ts = ts + init_ts_delta
+        heapq.heappush(heap, (calibrated_ts, index, event, size, delay))
+        return True
 
-def multiple_mode(args):
-    # open log files
-    link_log = None
-    if args.link_log:
-        link_log = open(args.link_log)
+    return False
 
-    tun_logs = []
-    for tun_log_name in args.tunnel_logs:
-        tun_logs.append(open(tun_log_name))
 
-    output_log = open(args.output_log, 'w')
+def multiple_merge(output_log, tunnels, link_log=None, binary=False):
+    """Merge the tunnel logs of one or more tunnels into output_log.
 
-    # maintain a min heap to merge sorted logs
-    heap = []
+    tunnels contains an (init_ts, events) pair per tunnel, as returned by
+    single_merge, and link_log is an optional log generated by mm-link. Each
+    event stream is only read as far as needed to keep one event per stream
+    in a heap. Raises MergeError if a log is empty, or if the tunnels or
+    their packets do not fit into a binary output_log.
+    """
+    link_events = None
     if link_log:
-        # find initial timestamp in the mm-link log
-        while True:
-            line = link_log.readline()
-            if not line:
-                sys.exit('Warning: link log %s is empty' % link_log.name)
-
-            if not line.startswith('# init timestamp'):
-                continue
-
-            link_init_ts = float(line.split(':')[1])
-            min_init_ts = link_init_ts
-            break
+        link_init_ts, _, link_events = open_events(link_log)
+        if link_init_ts is None:
+            raise MergeError('link log %s is empty' % link_log)
+        min_init_ts = link_init_ts
     else:
         min_init_ts = 1e20
 
     # find the smallest initial timestamp
+    tun_events = []
     init_ts_delta = []
-    for tun_log in tun_logs:
-        while True:
-            line = tun_log.readline()
-            if not line:
-                sys.exit('Warning: tunnel log %s is empty' % tun_log.name)
-
-            if not line.startswith('# init timestamp'):
-                continue
-
-            init_ts = float(line.split(':')[1])
-            init_ts_delta.append(init_ts)
-            if init_ts < min_init_ts:
-                min_init_ts = init_ts
-            break
+    for init_ts, events in tunnels:
+        tun_events.append(events)
+        init_ts_delta.append(init_ts)
+        if init_ts < min_init_ts:
+            min_init_ts = init_ts
 
-    if link_log:
+    if link_events:
         link_init_ts_delta = link_init_ts - min_init_ts
 
     for i in xrange(len(init_ts_delta)):
         init_ts_delta[i] -= min_init_ts
 
-    output_log.write('# init timestamp: %.3f\n' % min_init_ts)
-
-    # build the min heap
-    if link_log:
-        line = push_to_heap(heap, -1, link_log, link_init_ts_delta)
-        if not line:
-            sys.exit('Warning: no delivery opportunities found\n')
-
-    for i in xrange(len(tun_logs)):
-        line = push_to_heap(heap, i, tun_logs[i], init_ts_delta[i])
-        if not line:
-            sys.exit(
-                'Warning: %s does not contain any arrival or '
-                'departure events\n' % tun_logs[i].name)
-
-    # merge all log files
-    while heap:
-        (ts, index, line) = heapq.heappop(heap)
-
-        # append flow ids to arrival and departure events
-        if index != -1:
-            line += ' %s' % (index + 1)
+    # maintain a min heap to merge sorted logs
+    heap = []
+    if link_events:
+        if not push_to_heap(heap, -1, link_events, link_init_ts_delta):
+            raise MergeError('no delivery opportunities found')
+
+    for i in xrange(len(tun_events)):
+        if not push_to_heap(heap, i, tun_events[i], init_ts_delta[i]):
+            raise MergeError('tunnel %s does not contain any arrival or '
+                             'departure events' % (i + 1))
+
+    if binary and len(tun_events) > MAX_RECORD_FLOW:
+        raise MergeError('binary tunnel logs hold at most %d flows, not %d' %
+                         (MAX_RECORD_FLOW, len(tun_events)))
+
+    output_log = open_log_writer(output_log, min_init_ts,
+                                 flows=len(tun_events), binary=binary)
+
+    def merged_events():
+        # merge all log files
+        while heap:
+            (ts, index, event, size, delay) = heapq.heappop(heap)
+
+            if index == -1:
+                yield ts, event, size, None, 0
+                push_to_heap(heap, index, link_events, link_init_ts_delta)
+            else:
+                # append flow ids to arrival and departure events
+                yield ts, event, size, delay, index + 1
+                push_to_heap(heap, index, tun_events[index],
+                             init_ts_delta[index])
 
-        output_log.write(line + '\n')
+    write_events(output_log, merged_events())
 
-        if index == -1:
-            push_to_heap(heap, index, link_log, link_init_ts_delta)
-        else:
-            push_to_heap(heap, index, tun_logs[index], init_ts_delta[index])
 
-    # close log files
-    if link_log:
-        link_log.close()
-    for tun_log in tun_logs:
-        tun_log.close()
-    output_log.close()
+def multiple_mode(args):
+    try:
+        tunnels = []
+        for tun_log_name in args.tunnel_logs:
+            init_ts, _, events = open_events(tun_log_name)
+            if init_ts is None:
+                raise MergeError('tunnel log %s is empty' % tun_log_name)
+            tunnels.append((init_ts, events))
+
+        multiple_merge(args.output_log, tunnels, args.link_log, args.binary)
+    except MergeError as e:
+        sys.exit('Warning: %s\n' % e)
+
+
+def quantize(events):
+    # round to the microsecond resolution of tunnel logs, so that events are
+    # ordered the same as when tunnel logs were written to disk first
+    for ts, event, size, delay, flow in events:
+        if delay is not None:
+            delay = ms_to_us(delay) / 1000.0
+        yield ms_to_us(ts) / 1000.0, event, size, delay, flow
+
+
+def single_merge_to_file(args):
+    # runs in a worker process; the merged events are written to a temporary
+    # binary log in chunks rather than held in memory, and its path is sent
+    # back
+    (tunnel, max_delay, tmp_dir) = args
+    fd, tmp_path = tempfile.mkstemp(suffix='.log', dir=tmp_dir)
+    os.close(fd)
+
+    init_ts, events = single_merge(*tunnel, max_delay=max_delay)
+    write_events(open_log_writer(tmp_path, init_ts, binary=True), events)
+    return init_ts, tmp_path
+
+
+def merge_links(links, binary=False, processes=1,
+                max_delay=DEFAULT_MAX_DELAY):
+    """Merge the ingress and egress logs of all tunnels on one or more links
+    without writing intermediate tunnel logs.
+
+    links is a list of (output_log, link_log, tunnels), where link_log is an
+    mm-link log or None, and tunnels has one (ingress_log, egress_log,
+    i_clock_offset, e_clock_offset) tuple per tunnel, in the order of flow ids.
+
+    With processes=1 (the default), the single merges of all tunnels run
+    lazily in the calling process and are streamed directly into
+    multiple_merge. With more processes, they run in a pool of worker
+    processes (None: number of CPUs), which write them to temporary binary
+    logs next to output_log that are streamed from disk into multiple_merge,
+    so that memory use stays bounded either way.
+
+    Returns a list with an error message for each link that failed to merge,
+    or None for each link that merged successfully. max_delay is passed to
+    single_merge.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    tunnels = [tunnel for _, _, link_tunnels in links
+               for tunnel in link_tunnels]
+    processes = min(processes, len(tunnels))
+
+    pool = None
+    if processes > 1:
+        # next to the output logs, which are on a ramdisk in benchmarks
+        tmp_dir = tempfile.mkdtemp(
+            prefix='merge_', dir=os.path.dirname(os.path.abspath(links[0][0])))
+        pool = multiprocessing.Pool(processes=processes)
+        results = [pool.apply_async(single_merge_to_file,
+                                    ((tunnel, max_delay, tmp_dir),))
+                   for tunnel in tunnels]
+
+    errors = []
+    try:
+        for output_log, link_log, link_tunnels in links:
+            if pool is not None:
+                link_results = results[:len(link_tunnels)]
+                del results[:len(link_tunnels)]
+
+            tmp_paths = []
+            try:
+                merged = []
+                for i, tunnel in enumerate(link_tunnels):
+                    if pool is None:
+                        init_ts, events = single_merge(
+                            *tunnel, max_delay=max_delay)
+                        events = quantize(events)
+                    else:
+                        init_ts, tmp_path = link_results[i].get()
+                        tmp_paths.append(tmp_path)
+                        events = iter_binary_events(
+                            read_binary_log(tmp_path)[1])
+                    merged.append((text_init_ts(init_ts), events))
+
+                multiple_merge(output_log, merged, link_log, binary)
+                errors.append(None)
+            except MergeError as e:
+                errors.append('%s: %s' % (output_log, e))
+            finally:
+                for tmp_path in tmp_paths:
+                    os.remove(tmp_path)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            # logs of tunnels whose link failed before they were read
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return errors
+
+
+def convert_mode(args):
+    try:
+        convert_tunnel_log(args.input_log, args.output_log,
+                           binary=(args.to == 'binary'))
+    except ValueError as e:
+        sys.exit('Warning: %s\n' % e)
 
 
 def main():
@@ -268,8 +465,10 @@ def main():
 
     if args.mode == 'single':
         single_mode(args)
-    else:
+    elif args.mode == 'multiple':
         multiple_mode(args)
+    else:
+        convert_mode(args)
 
 
 if __name__ == '__main__':
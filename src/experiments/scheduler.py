@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+import traceback
+from Queue import Empty
+from multiprocessing import Process, Pipe, Queue
+
+import context
+from helpers.subprocess_wrappers import check_output
+
+
+def read_cpu_times():
+	"""Return {cpu id: (busy jiffies, total jiffies)} from /proc/stat"""
+	cpu_times = {}
+	with open('/proc/stat') as stat:
+		for line in stat:
+			if not line.startswith('cpu') or line.startswith('cpu '):
+				continue
+			fields = line.split()
+			times = [int(t) for t in fields[1:]]
+			idle = times[3] + times[4]  # idle and iowait
+			cpu_times[int(fields[0][3:])] = (sum(times) - idle, sum(times))
+	return cpu_times
+
+
+def cpu_load(before, after, cpus):
+	"""Fraction of time the cpus were busy between two read_cpu_times()"""
+	busy = sum(after[c][0] - before[c][0] for c in cpus)
+	total = sum(after[c][1] - before[c][1] for c in cpus)
+	if total <= 0:
+		return 0.0
+	return float(busy) / total
+
+
+def pin_to_cpus(cpus):
+	"""pin the calling process, and every process it starts, to cpus"""
+	check_output(['taskset', '-pc', ','.join(str(c) for c in cpus),
+				  str(os.getpid())])
+
+
+def run_job(conn, work, item, cpus):
+	result = None
+	try:
+		if cpus is not None:
+			pin_to_cpus(cpus)
+		result = work(item)
+	except Exception:
+		traceback.print_exc()
+	finally:
+		conn.send(result)
+		conn.close()
+
+
+class Job(object):
+	def __init__(self, index, item, cpus):
+		self.index = index
+		self.item = item
+		self.cpus = cpus
+		self.loads = []
+		self.result = None
+
+
+class Scheduler(object):
+	"""Runs experiments concurrently, each in its own process.
+
+	Every running experiment is pinned to its own group of CPUs. The load on
+	these CPUs is sampled while the experiment runs, and experiments are only
+	started while the load on all CPUs not reserved for other work stays
+	below max_load, as mahimahi emulates links less faithfully on busy CPUs.
+	"""
+
+	def __init__(self, concurrency=1, max_load=0.9, poll_interval=1.0, reserve=0):
+		"""
+			Keyword Arguments:
+			concurrency -- maximum number of experiments running at the same time, at most one per CPU not reserved
+			max_load -- fraction of CPU time above which an experiment is flagged as overloaded and no further experiments are started
+			poll_interval -- seconds between two samples of the CPU load
+			reserve -- number of CPUs to keep free of experiments, e.g. for an AnalysisPool (at least one CPU is left to experiments)
+		"""
+		self.max_load = max_load
+		self.poll_interval = poll_interval
+
+		cpus = sorted(read_cpu_times().keys())
+		reserve = max(0, min(reserve, len(cpus) - 1))
+		self.reserved_cpus = cpus[len(cpus) - reserve:]
+		cpus = cpus[:len(cpus) - reserve]
+		self.all_cpus = cpus
+		if concurrency > len(cpus):
+			#experiments sharing a CPU would distort each other's links
+			sys.stderr.write('Warning: running at most %d experiments at the same time, one per CPU left to them, instead of %d\n'
+							 % (len(cpus), concurrency))
+			concurrency = len(cpus)
+		self.concurrency = concurrency
+		self.cpu_groups = None
+		if concurrency > 1 or self.reserved_cpus:
+			#split CPUs into one group per concurrently running experiment
+			size = len(cpus) // concurrency
+			self.cpu_groups = [cpus[i * size:(i + 1) * size] for i in range(concurrency)]
+
+	def load_stats(self, job):
+		"""return cpu load statistics of a finished job"""
+		if not job.loads:
+			return {'cpu_load':None, 'cpu_load_max':None, 'overloaded':False}
+		max_load = max(job.loads)
+		return {'cpu_load':sum(job.loads) / len(job.loads),
+				'cpu_load_max':max_load,
+				'overloaded':max_load > self.max_load}
+
+	def run(self, items, work):
+		"""Run work(item) for each item in a separate process.
+
+		Yields (index of item, item, result of work or None if it failed, cpu load statistics) as experiments finish.
+		"""
+		pending = list(enumerate(items))
+		free_groups = list(self.cpu_groups or [])
+		running = {}
+		host_load = 0.0
+		cpu_times = read_cpu_times()
+
+		while pending or running:
+			#start experiments while there are free slots and the host is not overloaded
+			while pending and len(running) < self.concurrency and (not running or host_load < self.max_load):
+				index, item = pending.pop(0)
+				cpus = free_groups.pop(0) if self.cpu_groups else None
+				job = Job(index, item, cpus)
+				conn, child_conn = Pipe(duplex=False)
+				proc = Process(target=run_job, args=(child_conn, work, item, cpus))
+				proc.start()
+				child_conn.close()
+				running[conn] = (proc, job)
+
+			time.sleep(self.poll_interval)
+
+			last_cpu_times = cpu_times
+			cpu_times = read_cpu_times()
+			host_load = cpu_load(last_cpu_times, cpu_times, self.all_cpus)
+
+			for conn, (proc, job) in running.items():
+				job.loads.append(cpu_load(last_cpu_times, cpu_times, job.cpus or self.all_cpus))
+
+				if not conn.poll() and proc.is_alive():
+					continue
+				#poll again, as the job may have sent its result and exited since the first poll
+				if conn.poll():
+					try:
+						job.result = conn.recv()
+					except EOFError:
+						pass  #process died without sending a result
+
+				proc.join()
+				conn.close()
+				del running[conn]
+				if job.cpus is not None:
+					free_groups.append(job.cpus)
+
+				stats = self.load_stats(job)
+				if stats['overloaded']:
+					sys.stderr.write('Warning: CPU load reached %.2f while running experiment %d, '
+									 'results may be inaccurate\n' % (stats['cpu_load_max'], job.index))
+				yield job.index, job.item, job.result, stats
+
+
+def analysis_worker(tasks, results, items, work, cpus):
+	if cpus is not None:
+		pin_to_cpus(cpus)
+	while True:
+		index = tasks.get()
+		if index is None:
+			break
+		result = None
+		try:
+			result = work(items[index])
+		except Exception:
+			traceback.print_exc()
+		results.put((index, result))
+
+
+class AnalysisPool(object):
+	"""Runs work(item) in background processes for items whose experiments
+	have finished, while the Scheduler goes on with the next experiments.
+
+	At most max_pending items wait for a free worker; submit() blocks beyond
+	that, so that the logs of finished experiments do not fill up the tmp dir.
+	Workers are forked when the pool is created and inherit items, so only
+	indices of items are sent to them.
+	"""
+
+	def __init__(self, items, work, workers=1, cpus=None, max_pending=1, poll_interval=1.0):
+		"""
+			Keyword Arguments:
+			workers -- number of worker processes
+			cpus -- CPUs to pin the workers to, or None to not pin them
+			max_pending -- maximum number of submitted items not yet picked up by a worker
+			poll_interval -- seconds between checks whether the workers are still alive while waiting for results
+		"""
+		self.poll_interval = poll_interval
+		self.tasks = Queue(maxsize=max(1, max_pending))
+		self.results = Queue()
+		self.pending = 0
+		self.procs = []
+		for i in range(workers):
+			#not daemonic, as work may start processes of its own
+			proc = Process(target=analysis_worker, args=(self.tasks, self.results, items, work, cpus))
+			proc.start()
+			self.procs.append(proc)
+
+	def submit(self, index):
+		"""queue items[index] for analysis, blocking while max_pending items are queued already"""
+		self.tasks.put(index)
+		self.pending += 1
+
+	def finished(self, block=False):
+		"""Yields (index of item, result of work or None if it failed) of finished items.
+
+		With block=True, waits until all submitted items are finished.
+		"""
+		while self.pending:
+			try:
+				index, result = self.results.get(block, self.poll_interval)
+			except Empty:
+				if not block:
+					return
+				if not any(proc.is_alive() for proc in self.procs):
+					sys.stderr.write('Warning: analysis workers died with %d experiments left\n' % self.pending)
+					self.pending = 0
+					return
+				continue
+			self.pending -= 1
+			yield index, result
+
+	def close(self):
+		"""stop the workers once they finished all submitted items, discarding results not fetched with finished()"""
+		for proc in self.procs:
+			self.tasks.put(None)
+		for result in self.finished(block=True):
+			pass
+		for proc in self.procs:
+			proc.join()
@@ -0,0 +1,99 @@
+import math
+import itertools
+
+
+#metrics of results whose change between neighbouring experiments is refined, and the change that counts as sharp
+REFINE_THRESHOLDS = {'loss': 0.01, 'overall_fairness': 0.05, 'utilization': 0.05}
+
+def coarse_indices(size, step):
+	"""indices of a coarse grid along an axis of size points, including both ends"""
+	indices = range(0, size, step)
+	if indices[-1] != size - 1:
+		indices.append(size - 1)
+	return indices
+
+def result_metrics(rows):
+	"""average the metrics of REFINE_THRESHOLDS over the result rows of the runs of an experiment"""
+	metrics = {}
+	values = {}
+	for row in rows:
+		row = dict(row)
+		if row.get('throughput') is not None and row.get('bottleneck_tput'):
+			row['utilization'] = row['throughput'] / float(row['bottleneck_tput'])
+		for metric in REFINE_THRESHOLDS:
+			value = row.get(metric)
+			if value is not None and not math.isnan(value):
+				values.setdefault(metric, []).append(value)
+	for metric, metric_values in values.items():
+		metrics[metric] = sum(metric_values) / len(metric_values)
+	return metrics
+
+class AdaptiveSweep(object):
+	"""Plans which points of grids of experiments to run, starting from a coarse grid and refining it where results change sharply.
+
+	Points are (grid, index along each axis) tuples; grids share their shape but are refined independently. Along each axis, two evaluated
+	points of a grid are neighbours if no point between them has been evaluated. Where a metric changes by more than its threshold between
+	neighbours, the point halfway between them is planned next, the sharpest changes first, until no change is left or the budget is spent.
+	"""
+
+	def __init__(self, grids, shape, steps, budget=None, thresholds=REFINE_THRESHOLDS):
+		"""
+			Arguments:
+			grids -- keys of the grids
+			shape -- number of points along each axis
+			steps -- distance between the points of the coarse grid along each axis
+
+			Keyword Arguments:
+			budget -- maximum number of points to plan in total, or None for no limit
+			thresholds -- change of each metric between neighbours above which the points between them are planned
+		"""
+		self.grids = grids
+		self.shape = shape
+		self.steps = steps
+		self.budget = budget
+		self.thresholds = thresholds
+		self.planned = set()
+
+	def take(self, points):
+		"""plan points in order while the budget lasts and return them"""
+		points = [p for p in points if p not in self.planned]
+		if self.budget is not None:
+			points = points[:max(0, self.budget - len(self.planned))]
+		self.planned.update(points)
+		return points
+
+	def initial_points(self):
+		axes = [coarse_indices(size, step) for size, step in zip(self.shape, self.steps)]
+		return self.take([(grid,) + indices for grid in self.grids for indices in itertools.product(*axes)])
+
+	def change(self, a, b):
+		"""largest change of a metric between the results a and b, relative to its threshold"""
+		score = 0.0
+		for metric, threshold in self.thresholds.items():
+			if metric in a and metric in b:
+				score = max(score, abs(a[metric] - b[metric]) / threshold)
+		return score
+
+	def refine(self, results):
+		"""return the points to run next, or an empty list once the sweep is done
+
+		results maps evaluated points to their metrics, e.g. from result_metrics"""
+		candidates = {}
+		for axis in range(1, len(self.shape) + 1):
+			#evaluated points on each line along axis
+			lines = {}
+			for point in results:
+				lines.setdefault(point[:axis] + point[axis+1:], []).append(point)
+
+			for line in lines.values():
+				line.sort(key=lambda p: p[axis])
+				for a, b in zip(line, line[1:]):
+					if b[axis] - a[axis] < 2:
+						continue
+					score = self.change(results[a], results[b])
+					if score <= 1:
+						continue
+					middle = a[:axis] + ((a[axis] + b[axis]) // 2,) + a[axis+1:]
+					candidates[middle] = max(score, candidates.get(middle, 0))
+
+		return self.take(sorted(candidates, key=lambda p: (-candidates[p], p)))
@@ -13,7 +13,16 @@ from collections import namedtuple
 
 import arg_parser
 import context
-from helpers import utils, kernel_ctl
+from merge_tunnel_logs import merge_links, DEFAULT_MAX_DELAY
+from tunnel_manager import (TunnelManagerClient, tunnel_request, poll,
+                            wait_until, sleep)
+from helpers import utils, kernel_ctl, ssh_pool
+from helpers.clock_offset import clock_offsets
+from helpers.link_capacity import (link_info_path, save_link_info,
+                                   TraceCapacity)
+from analysis.live_metrics import LiveMetrics, live_status_path
+from analysis.plot import Plot
+from helpers.repetitions import Repetitions
 from helpers.subprocess_wrappers import Popen, call
 
 
@@ -25,6 +34,18 @@ Flow = namedtuple('Flow', ['cc', # replace self.cc
                            'mm_sender_cmd', #additional mahimahi command for sender (for unfairness)
                            'mm_receiver_cmd']) #additional mahimahi command for receiver (for unfairness)
 
+# seconds for tunnel managers to start and to answer status and halt
+MANAGER_TIMEOUT = 20
+
+# seconds between two updates of the live metrics of a run
+LIVE_INTERVAL = 1
+
+# seconds for a tunnel client to connect to its tunnel server
+TUNNEL_TIMEOUT = 20
+
+# maximum number of times to run the tunnel client of a tunnel
+MAX_TUNNEL_RUNS = 3
+
 
 class Test(object):
     def __init__(self, args, run_id, cc):
@@ -33,11 +54,28 @@ class Test(object):
         self.cc = cc
         self.data_dir = path.abspath(args.data_dir)
 
+        # ingress and egress logs of the tunnels, in a directory of their own
+        # if the caller cleans them up, e.g. when experiments run concurrently
+        self.tunnel_log_dir = path.abspath(
+            getattr(args, 'tunnel_log_dir', None) or utils.tmp_dir)
+        utils.make_sure_dir_exists(self.tunnel_log_dir)
+
         # shared arguments between local and remote modes
         self.flows = args.flows
         self.runtime = args.runtime
         self.interval = args.interval
         self.run_times = args.run_times
+        self.binary_logs = getattr(args, 'binary_logs', False)
+        # None: one process per CPU
+        self.merge_processes = getattr(args, 'merge_processes', 1) or None
+        self.link_logs = not getattr(args, 'no_link_logs', False)
+        self.live_metrics = getattr(args, 'live_metrics', False)
+        self.live = None
+
+        # stop runs early once the flows converged, which needs live metrics
+        self.converge_window = getattr(args, 'converge_window', None)
+        self.min_runtime = getattr(args, 'min_runtime', None) or 0
+        self.converged_after = None
 
         # used for cleanup
         self.proc_first = None
@@ -71,6 +109,7 @@ class Test(object):
             self.remote_desc = args.remote_desc
 
             self.ntp_addr = args.ntp_addr
+            self.clock_offset_validity = args.clock_offset_validity
             self.local_ofst = None
             self.remote_ofst = None
 
@@ -135,10 +174,14 @@ class Test(object):
         if self.prepend_mm_cmds:
             self.mm_cmd += self.prepend_mm_cmds.split()
 
-        self.mm_cmd += [
-            'mm-link', uplink_trace, downlink_trace,
-            '--uplink-log=' + uplink_log,
-            '--downlink-log=' + downlink_log]
+        self.mm_cmd += ['mm-link', uplink_trace, downlink_trace]
+
+        # without tunnels, the mm-link logs are the only logs of a run
+        if self.link_logs or self.flows == 0:
+            self.mm_cmd += ['--uplink-log=' + uplink_log,
+                            '--downlink-log=' + downlink_log]
+        else:
+            self.mm_datalink_log = self.mm_acklink_log = None
 
         if self.extra_mm_link_args:
             self.mm_cmd += self.extra_mm_link_args.split()
@@ -153,7 +196,7 @@ class Test(object):
         self.acklink_ingress_logs = {}
         self.acklink_egress_logs = {}
 
-        local_tmp = utils.tmp_dir
+        local_tmp = self.tunnel_log_dir
 
         if self.mode == 'remote':
             remote_tmp = self.r['tmp_dir']
@@ -206,8 +249,9 @@ class Test(object):
             self.run_first = None
             self.run_second = None
 
-        # wait for 3 seconds until run_first is ready
-        self.run_first_setup_time = 3
+        # tun_id -> (cc, pid of the process running it locally or None,
+        # port, start time) of the side that runs first in each tunnel
+        self.first_sides = {}
 
         # setup output logs
         self.datalink_name = self.cc + '_datalink_run%d' % self.run_id
@@ -224,10 +268,15 @@ class Test(object):
         if self.mode == 'local':
             self.setup_mm_cmd()
         else:
+            # all ssh commands of the run share one connection, which is
+            # reopened if it was lost since the previous run
+            ssh_pool.connect(self.r['host_addr'])
+
             # record local and remote clock offset
             if self.ntp_addr is not None:
-                self.local_ofst, self.remote_ofst = utils.query_clock_offset(
-                    self.ntp_addr, self.r['ssh_cmd'])
+                self.local_ofst, self.remote_ofst = clock_offsets(
+                    self.ntp_addr, self.r['ssh_cmd'],
+                    self.clock_offset_validity).get()
 
     # test congestion control without running pantheon tunnel
     def run_without_tunnel(self):
@@ -236,11 +285,12 @@ class Test(object):
         # run the side specified by self.run_first
         cmd = ['python', self.cc_src, self.run_first, port]
         sys.stderr.write('Running %s %s...\n' % (self.cc, self.run_first))
+        first_start_time = time.time()
         self.proc_first = Popen(cmd, preexec_fn=os.setsid)
 
-        # sleep just in case the process isn't quite listening yet
-        # the cleaner approach might be to try to verify the socket is open
-        time.sleep(self.run_first_setup_time)
+        # wait until the process is listening on port
+        utils.wait_until_ready(self.cc, self.proc_first.pid, port,
+                               first_start_time)
 
         self.test_start_time = utils.utc_time()
         # run the other side specified by self.run_second
@@ -280,16 +330,6 @@ class Test(object):
         sys.stderr.write('[tunnel server manager (tsm)] ')
         self.ts_manager = Popen(ts_manager_cmd, stdin=PIPE, stdout=PIPE,
                                 preexec_fn=os.setsid)
-        ts_manager = self.ts_manager
-
-        while True:
-            running = ts_manager.stdout.readline()
-            if 'tunnel manager is running' in running:
-                sys.stderr.write(running)
-                break
-
-        ts_manager.stdin.write('prompt [tsm]\n')
-        ts_manager.stdin.flush()
 
         # run tunnel client manager
         if self.mode == 'remote':
@@ -302,22 +342,35 @@ class Test(object):
             tc_manager_cmd = self.mm_cmd + ['python', self.tunnel_manager]
 
         sys.stderr.write('[tunnel client manager (tcm)] ')
+        self.link_start_ts = time.time() * 1000
         self.tc_manager = Popen(tc_manager_cmd, stdin=PIPE, stdout=PIPE,
                                 preexec_fn=os.setsid)
-        tc_manager = self.tc_manager
 
-        while True:
-            running = tc_manager.stdout.readline()
-            if 'tunnel manager is running' in running:
-                sys.stderr.write(running)
-                break
+        if self.mode == 'local' and self.mm_datalink_log is None:
+            # the link starts within a few ms of its mahimahi shells, so
+            # that its capacity can be derived from the traces instead
+            save_link_info(
+                link_info_path(self.data_dir, self.cc, self.run_id),
+                self.datalink_trace, self.acklink_trace, self.link_start_ts)
 
-        tc_manager.stdin.write('prompt [tcm]\n')
-        tc_manager.stdin.flush()
+        # wait for both managers to start
+        ts_manager = TunnelManagerClient(self.ts_manager)
+        tc_manager = TunnelManagerClient(self.tc_manager)
+        managers = [ts_manager, tc_manager]
+
+        if not wait_until(managers,
+                          lambda: ts_manager.ready and tc_manager.ready,
+                          time.time() + MANAGER_TIMEOUT):
+            sys.stderr.write('Tunnel managers failed to start\n')
+            return None
+
+        sys.stderr.write('tunnel managers are running\n')
+        ts_manager.request('prompt', prompt='[tsm]')
+        tc_manager.request('prompt', prompt='[tcm]')
 
         return ts_manager, tc_manager
 
-    def run_tunnel_server(self, tun_id, ts_manager):
+    def tunnel_server_cmd(self, tun_id):
         if self.server_side == self.sender_side:
             ts_cmd = 'mm-tunnelserver --ingress-log=%s --egress-log=%s' % (
                 self.acklink_ingress_logs[tun_id],
@@ -335,19 +388,44 @@ class Test(object):
                 if self.local_if is not None:
                     ts_cmd += ' --interface=' + self.local_if
 
-        ts_cmd = 'tunnel %s %s\n' % (tun_id, ts_cmd)
-        ts_manager.stdin.write(ts_cmd)
-        ts_manager.stdin.flush()
-
-        # read the command to run tunnel client
-        readline_cmd = 'tunnel %s readline\n' % tun_id
-        ts_manager.stdin.write(readline_cmd)
-        ts_manager.stdin.flush()
-
-        cmd_to_run_tc = ts_manager.stdout.readline().split()
-        return cmd_to_run_tc
-
-    def run_tunnel_client(self, tun_id, tc_manager, cmd_to_run_tc):
+        return ts_cmd
+
+    def run_tunnel_servers(self, ts_manager, tun_ids):
+        """Start the tunnel servers of all tunnels at once and return
+        {tun_id: command to run its tunnel client}, or None on failure."""
+        ts_manager.batch([
+            tunnel_request(tun_id, self.tunnel_server_cmd(tun_id))
+            for tun_id in tun_ids])
+
+        # each server prints the command to run its tunnel client first
+        cmds_to_run_tc = {}
+
+        def all_started():
+            for tun_id in tun_ids:
+                if tun_id not in cmds_to_run_tc:
+                    line = ts_manager.next_line(tun_id)
+                    if line is None and not ts_manager.has_exited(tun_id):
+                        return False
+                    cmds_to_run_tc[tun_id] = (line or '').split()
+            return True
+
+        wait_until([ts_manager], all_started, time.time() + TUNNEL_TIMEOUT)
+
+        started = True
+        for tun_id in tun_ids:
+            if tun_id not in cmds_to_run_tc:
+                sys.stderr.write('Tunnel %d: tunnel server did not start\n'
+                                 % tun_id)
+                started = False
+            elif len(cmds_to_run_tc[tun_id]) < 5:
+                sys.stderr.write('Tunnel %d: tunnel server failed to start\n'
+                                 % tun_id)
+                started = False
+
+        return cmds_to_run_tc if started else None
+
+    def tunnel_client_cmd(self, tun_id, cmd_to_run_tc):
+        cmd_to_run_tc = list(cmd_to_run_tc)
         if self.mode == 'local':
             cmd_to_run_tc[1] = '$MAHIMAHI_BASE'
         else:
@@ -377,44 +455,80 @@ class Test(object):
                 if self.remote_if is not None:
                     tc_cmd += ' --interface=' + self.remote_if
 
-        tc_cmd = 'tunnel %s %s\n' % (tun_id, tc_cmd)
-        readline_cmd = 'tunnel %s readline\n' % tun_id
-
-        # re-run tunnel client after 20s timeout for at most 3 times
-        max_run = 3
-        curr_run = 0
-        got_connection = ''
-        while 'got connection' not in got_connection:
-            curr_run += 1
-            if curr_run > max_run:
-                sys.stderr.write('Unable to establish tunnel\n')
-                return False
-
-            tc_manager.stdin.write(tc_cmd)
-            tc_manager.stdin.flush()
-            while True:
-                tc_manager.stdin.write(readline_cmd)
-                tc_manager.stdin.flush()
-
-                signal.signal(signal.SIGALRM, utils.timeout_handler)
-                signal.alarm(20)
-
-                try:
-                    got_connection = tc_manager.stdout.readline()
-                    sys.stderr.write('Tunnel is connected\n')
-                except utils.TimeoutError:
-                    sys.stderr.write('Tunnel connection timeout\n')
-                    break
-                except IOError:
-                    sys.stderr.write('Tunnel client failed to connect to '
-                                     'tunnel server\n')
-                    return False
+        return tc_cmd
+
+    def run_tunnel_clients(self, tc_manager, cmds_to_run_tc):
+        """Start the tunnel clients of all tunnels at once and wait until
+        each is connected to its tunnel server.
+
+        A client that exits or does not connect within TUNNEL_TIMEOUT
+        seconds is re-run, at most MAX_TUNNEL_RUNS times in total, without
+        holding up the other tunnels. Returns whether all tunnels are
+        connected.
+        """
+        tc_cmds = {}
+        runs = {}
+        deadlines = {}
+
+        def client_request(tun_id):
+            runs[tun_id] = runs.get(tun_id, 0) + 1
+            deadlines[tun_id] = time.time() + TUNNEL_TIMEOUT
+            return tunnel_request(tun_id, tc_cmds[tun_id])
+
+        for tun_id in cmds_to_run_tc:
+            tc_cmds[tun_id] = self.tunnel_client_cmd(
+                tun_id, cmds_to_run_tc[tun_id])
+        tc_manager.batch([client_request(tun_id)
+                          for tun_id in sorted(tc_cmds)])
+
+        connected = set()
+        failed = set()
+        while len(connected) + len(failed) < len(tc_cmds):
+            waiting = [tun_id for tun_id in sorted(tc_cmds)
+                       if tun_id not in connected and tun_id not in failed]
+            poll([tc_manager],
+                 min(deadlines[tun_id] for tun_id in waiting) - time.time())
+
+            rerun = []
+            for tun_id in waiting:
+                line = tc_manager.next_line(tun_id)
+                while line is not None and 'got connection' not in line:
+                    line = tc_manager.next_line(tun_id)
+
+                if line is not None:
+                    sys.stderr.write('Tunnel %d is connected\n' % tun_id)
+                    connected.add(tun_id)
+                    continue
+
+                if tc_manager.closed:
+                    sys.stderr.write('Tunnel %d: tunnel manager exited\n'
+                                     % tun_id)
+                    failed.add(tun_id)
+                    continue
+
+                if tc_manager.has_exited(tun_id):
+                    sys.stderr.write('Tunnel %d: tunnel client exited\n'
+                                     % tun_id)
+                elif time.time() >= deadlines[tun_id]:
+                    sys.stderr.write('Tunnel %d: connection timeout\n'
+                                     % tun_id)
                 else:
-                    signal.alarm(0)
-                    if 'got connection' in got_connection:
-                        break
+                    continue
 
-        return True
+                if runs[tun_id] >= MAX_TUNNEL_RUNS:
+                    failed.add(tun_id)
+                else:
+                    rerun.append(tun_id)
+
+            # re-run tunnel clients
+            if rerun:
+                tc_manager.batch([client_request(tun_id) for tun_id in rerun])
+
+        for tun_id in sorted(failed):
+            sys.stderr.write('Tunnel %d: unable to establish tunnel after %d '
+                             'runs of its client\n' % (tun_id, runs[tun_id]))
+
+        return not failed
 
     def run_first_side(self, tun_id, send_manager, recv_manager,
                        send_pri_ip, recv_pri_ip):
@@ -431,13 +545,11 @@ class Test(object):
 
             port = utils.get_open_port()
 
-            first_cmd = 'tunnel %s python %s receiver %s\n' % (
-                tun_id, first_src, port)
-            second_cmd = 'tunnel %s python %s sender %s %s\n' % (
-                tun_id, second_src, recv_pri_ip, port)
+            first_cmd = 'python %s receiver %s' % (first_src, port)
+            second_cmd = 'python %s sender %s %s' % (
+                second_src, recv_pri_ip, port)
 
-            recv_manager.stdin.write(first_cmd)
-            recv_manager.stdin.flush()
+            recv_manager.tunnel(tun_id, first_cmd)
         elif self.run_first == 'sender':  # self.run_first == 'sender'
             if self.mode == 'remote':
                 if self.sender_side == 'local':
@@ -447,13 +559,11 @@ class Test(object):
 
             port = utils.get_open_port()
 
-            first_cmd = 'tunnel %s python %s sender %s\n' % (
-                tun_id, first_src, port)
-            second_cmd = 'tunnel %s python %s receiver %s %s\n' % (
-                tun_id, second_src, send_pri_ip, port)
+            first_cmd = 'python %s sender %s' % (first_src, port)
+            second_cmd = 'python %s receiver %s %s' % (
+                second_src, send_pri_ip, port)
 
-            send_manager.stdin.write(first_cmd)
-            send_manager.stdin.flush()
+            send_manager.tunnel(tun_id, first_cmd)
 
         # get run_first and run_second from the flow object
         else:
@@ -475,13 +585,12 @@ class Test(object):
 
                 port = utils.get_open_port()
 
-                first_cmd = 'tunnel %s %s python %s receiver %s\n' % (
-                    tun_id, mm_receiver_cmd, first_src, port)
-                second_cmd = 'tunnel %s %s python %s sender %s %s\n' % (
-                    tun_id, mm_sender_cmd, second_src, recv_pri_ip, port)
+                first_cmd = '%s python %s receiver %s' % (
+                    mm_receiver_cmd, first_src, port)
+                second_cmd = '%s python %s sender %s %s' % (
+                    mm_sender_cmd, second_src, recv_pri_ip, port)
 
-                recv_manager.stdin.write(first_cmd)
-                recv_manager.stdin.flush()
+                recv_manager.tunnel(tun_id, first_cmd)
             else:  # flow.run_first == 'sender'
                 if self.mode == 'remote':
                     if self.sender_side == 'local':
@@ -491,43 +600,66 @@ class Test(object):
 
                 port = utils.get_open_port()
 
-                first_cmd = 'tunnel %s %s python %s sender %s\n' % (
-                    tun_id, mm_sender_cmd, first_src, port)
-                second_cmd = 'tunnel %s %s python %s receiver %s %s\n' % (
-                    tun_id, mm_receiver_cmd, second_src, send_pri_ip, port)
+                first_cmd = '%s python %s sender %s' % (
+                    mm_sender_cmd, first_src, port)
+                second_cmd = '%s python %s receiver %s %s' % (
+                    mm_receiver_cmd, second_src, send_pri_ip, port)
+
+                send_manager.tunnel(tun_id, first_cmd)
+
+        if self.test_config is None:
+            cc, run_first = self.cc, self.run_first
+        else:
+            flow = self.flow_objs[tun_id]
+            cc, run_first = flow.cc, flow.run_first
+
+        # the first side can only be probed if its manager runs on this host
+        if self.mode == 'local':
+            is_local = True
+        elif run_first == 'sender':
+            is_local = self.sender_side == 'local'
+        else:
+            is_local = self.sender_side == 'remote'
 
-                send_manager.stdin.write(first_cmd)
-                send_manager.stdin.flush()
+        manager = send_manager if run_first == 'sender' else recv_manager
+        pid = manager.proc.pid if is_local else None
+        self.first_sides[tun_id] = (cc, pid, port, time.time())
 
         return second_cmd
 
+    def wait_for_first_side(self, tun_id):
+        cc, pid, port, start_time = self.first_sides[tun_id]
+        utils.wait_until_ready(cc, pid, port, start_time)
+
     def run_second_side(self, send_manager, recv_manager, second_cmds):
-        time.sleep(self.run_first_setup_time)
+        # keep handling output of the tunnels while waiting for flows
+        managers = [send_manager, recv_manager]
+
+        # start as soon as the first side of the first flow is ready
+        self.wait_for_first_side(1)
 
         start_time = time.time()
         self.test_start_time = utils.utc_time()
+        self.flows_start_time = start_time
 
         # start each flow self.interval seconds after the previous one
         for i in xrange(len(second_cmds)):
             if i != 0:
-                time.sleep(self.interval)
+                self.wait(managers, self.interval)
+                self.wait_for_first_side(i + 1)
             second_cmd = second_cmds[i]
 
             if self.run_first == 'receiver':
-                send_manager.stdin.write(second_cmd)
-                send_manager.stdin.flush()
+                send_manager.tunnel(i + 1, second_cmd)
             elif self.run_first == 'sender':
-                recv_manager.stdin.write(second_cmd)
-                recv_manager.stdin.flush()
+                recv_manager.tunnel(i + 1, second_cmd)
             else:
                 assert(hasattr(self, 'flow_objs'))
                 flow = self.flow_objs[i+1]
                 if flow.run_first == 'receiver':
-                    send_manager.stdin.write(second_cmd)
-                    send_manager.stdin.flush()
+                    send_manager.tunnel(i + 1, second_cmd)
                 elif flow.run_first == 'sender':
-                    recv_manager.stdin.write(second_cmd)
-                    recv_manager.stdin.flush()
+                    recv_manager.tunnel(i + 1, second_cmd)
 
                 
         elapsed_time = time.time() - start_time
@@ -547,7 +679,7 @@ class Test(object):
                     print(i+1, uss, ctx)
                 time.sleep(1)
         else:
-            time.sleep(self.runtime - elapsed_time) #previous way of waiting until experiment is done
+            self.wait(managers, self.runtime - elapsed_time, stop_early=True) #previous way of waiting until experiment is done
 
         self.test_end_time = utils.utc_time()
 
@@ -556,7 +688,10 @@ class Test(object):
     # test congestion control using tunnel client and tunnel server
     def run_with_tunnel(self):
         # run pantheon tunnel server and client managers
-        ts_manager, tc_manager = self.run_tunnel_managers()
+        managers = self.run_tunnel_managers()
+        if managers is None:
+            return False
+        ts_manager, tc_manager = managers
 
         # create alias for ts_manager and tc_manager using sender or receiver
         if self.sender_side == self.server_side:
@@ -566,15 +701,25 @@ class Test(object):
             send_manager = tc_manager
             recv_manager = ts_manager
 
+        # establish the tunnels of all flows concurrently; only the flows
+        # themselves are started one after another
+        tun_ids = range(1, self.flows + 1)
+
+        cmds_to_run_tc = self.run_tunnel_servers(ts_manager, tun_ids)
+        if cmds_to_run_tc is None:
+            return False
+
+        if not self.run_tunnel_clients(tc_manager, cmds_to_run_tc):
+            return False
+
+        if (self.live_metrics or self.converge_window) and \
+                self.mode == 'local':
+            self.start_live_metrics()
+
         # run every flow
         second_cmds = []
-        for tun_id in xrange(1, self.flows + 1):
-            # run tunnel server for tunnel tun_id
-            cmd_to_run_tc = self.run_tunnel_server(tun_id, ts_manager)
-
-            # run tunnel client for tunnel tun_id
-            if not self.run_tunnel_client(tun_id, tc_manager, cmd_to_run_tc):
-                return False
+        for tun_id in tun_ids:
+            cmd_to_run_tc = cmds_to_run_tc[tun_id]
 
             tc_pri_ip = cmd_to_run_tc[3]  # tunnel client private IP
             ts_pri_ip = cmd_to_run_tc[4]  # tunnel server private IP
@@ -595,53 +740,141 @@ class Test(object):
         if not self.run_second_side(send_manager, recv_manager, second_cmds):
             return False
 
+        # report tunnels whose processes exited while the flows were running
+        status = [(manager, manager.request('status'))
+                  for manager in managers]
+        if wait_until(managers,
+                      lambda: all(req in m.replies for m, req in status),
+                      time.time() + MANAGER_TIMEOUT):
+            for manager, req in status:
+                tunnels = manager.replies[req]['tunnels']
+                for tun_id in sorted(tunnels, key=int):
+                    if not tunnels[tun_id]['running']:
+                        sys.stderr.write('Warning: tunnel %s exited during '
+                                         'the test\n' % tun_id)
+
         # stop all the running flows and quit tunnel managers
-        ts_manager.stdin.write('halt\n')
-        ts_manager.stdin.flush()
-        tc_manager.stdin.write('halt\n')
-        tc_manager.stdin.flush()
+        for manager in managers:
+            manager.request('halt')
+        wait_until(managers, lambda: all(m.closed for m in managers),
+                   time.time() + MANAGER_TIMEOUT)
+
+        live_graph = None
+        if self.live is not None:
+            live_graph = self.finish_live_metrics()
 
         # process tunnel logs
         self.process_tunnel_logs()
 
+        # without link logs, the merged datalink log holds exactly the events
+        # the live metrics were computed from
+        if live_graph is not None and self.mm_datalink_log is None:
+            self.live.cache_results(live_graph, self.datalink_log,
+                                    self.data_dir)
+
         return True
 
-    def download_tunnel_logs(self, tun_id):
-        assert(self.mode == 'remote')
+    def start_live_metrics(self):
+        # the tunnels of all flows are established, so all logs exist
+        tunnels = [(self.datalink_ingress_logs[tun_id],
+                    self.datalink_egress_logs[tun_id], None, None)
+                   for tun_id in xrange(1, self.flows + 1)]
 
-        # download logs from remote side
-        cmd = 'scp -C %s:' % self.r['host_addr']
-        cmd += '%(remote_log)s %(local_log)s'
+        flow_info = None
+        if self.test_config is not None:
+            flow_info = dict((i + 1, flow.get('flow_info')) for i, flow in
+                             enumerate(self.test_config['flows']))
+
+        capacity = TraceCapacity(path.abspath(self.datalink_trace),
+                                 self.link_start_ts)
+
+        self.live = LiveMetrics(tunnels, flow_info=flow_info,
+                                capacity=capacity,
+                                max_delay=DEFAULT_MAX_DELAY)
+        self.live_status = live_status_path(self.data_dir, self.cc,
+                                            self.run_id)
+
+    def wait(self, managers, seconds, stop_early=False):
+        """sleep while handling messages from managers, updating the live
+        metrics every LIVE_INTERVAL seconds
+
+        With stop_early, returns as soon as the flows converged for
+        converge_window seconds, but only min_runtime seconds after the
+        first flow started."""
+        if self.live is None:
+            sleep(managers, seconds)
+            return
 
-        # function to get a corresponding local path from a remote path
-        f = lambda p: path.join(utils.tmp_dir, path.basename(p))
+        deadline = time.time() + seconds
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+
+            sleep(managers, min(LIVE_INTERVAL, remaining))
+            if not self.live.update():
+                continue
+            self.live.write_status(self.live_status)
+
+            elapsed_time = time.time() - self.flows_start_time
+            if (stop_early and self.converge_window and
+                    elapsed_time >= self.min_runtime and
+                    self.live.converged(self.converge_window)):
+                self.converged_after = elapsed_time
+                sys.stderr.write('Flows converged after %.1f seconds\n' %
+                                 elapsed_time)
+                return
+
+    def finish_live_metrics(self):
+        """write the final live status with the results of the run, and
+        return the TunnelGraph they came from or None"""
+        graph = None
+        try:
+            if self.live.flow_info is not None:
+                graph = self.live.finish()
+            else:
+                self.live.update()
+            self.live.write_status(
+                self.live_status, graph.results if graph else None)
+        except Exception:
+            # the merged logs are analyzed as usual instead
+            sys.stderr.write('Warning: live metrics failed\n')
+            traceback.print_exc()
+            graph = None
+
+        return graph
+
+    def download_tunnel_logs(self):
+        """download the logs the remote side wrote for all tunnels in one
+        compressed tar stream, rather than with an scp per log"""
+        assert(self.mode == 'remote')
 
         if self.sender_side == 'remote':
-            local_log = f(self.datalink_egress_logs[tun_id])
-            call(cmd % {'remote_log': self.datalink_egress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.datalink_egress_logs[tun_id] = local_log
-
-            local_log = f(self.acklink_ingress_logs[tun_id])
-            call(cmd % {'remote_log': self.acklink_ingress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.acklink_ingress_logs[tun_id] = local_log
+            remote_logs = [self.datalink_egress_logs, self.acklink_ingress_logs]
         else:
-            local_log = f(self.datalink_ingress_logs[tun_id])
-            call(cmd % {'remote_log': self.datalink_ingress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.datalink_ingress_logs[tun_id] = local_log
-
-            local_log = f(self.acklink_egress_logs[tun_id])
-            call(cmd % {'remote_log': self.acklink_egress_logs[tun_id],
-                        'local_log': local_log}, shell=True)
-            self.acklink_egress_logs[tun_id] = local_log
-
+            remote_logs = [self.datalink_ingress_logs, self.acklink_egress_logs]
+
+        # all remote logs are in the remote tmp dir
+        log_names = [path.basename(logs[tun_id]) for tun_id in
+                     xrange(1, self.flows + 1) for logs in remote_logs]
+        tar_cmd = 'tar -C %s -czf - %s' % (self.r['tmp_dir'],
+                                             ' '.join(log_names))
+
+        remote_tar = Popen(self.r['ssh_cmd'] + [tar_cmd], stdout=PIPE)
+        local_tar = Popen(['tar', '-C', self.tunnel_log_dir, '-xzf', '-'],
+                          stdin=remote_tar.stdout)
+        remote_tar.stdout.close()  # so that ssh gets SIGPIPE if tar dies
+        local_status = local_tar.wait()
+        if remote_tar.wait() != 0 or local_status != 0:
+            sys.stderr.write('Warning: failed to download some tunnel logs '
+                             'from %s\n' % self.r['host_addr'])
+
+        for logs in remote_logs:
+            for tun_id in xrange(1, self.flows + 1):
+                logs[tun_id] = path.join(self.tunnel_log_dir,
+                                         path.basename(logs[tun_id]))
 
     def process_tunnel_logs(self):
-        datalink_tun_logs = []
-        acklink_tun_logs = []
-
         apply_ofst = False
         if self.mode == 'remote':
             if self.remote_ofst is not None and self.local_ofst is not None:
@@ -658,53 +891,42 @@ class Test(object):
                     data_e_ofst = self.local_ofst
                     ack_i_ofst = self.local_ofst
 
-        merge_tunnel_logs = path.join(context.src_dir, 'experiments',
-                                      'merge_tunnel_logs.py')
+        # clock offsets are stored as strings in ms
+        if apply_ofst:
+            datalink_ofst = (float(data_i_ofst), float(data_e_ofst))
+            acklink_ofst = (float(ack_i_ofst), float(ack_e_ofst))
+        else:
+            datalink_ofst = acklink_ofst = (None, None)
 
-        for tun_id in xrange(1, self.flows + 1):
-            if self.mode == 'remote':
-                self.download_tunnel_logs(tun_id)
+        datalink_tunnels = []
+        acklink_tunnels = []
 
-            uid = uuid.uuid4()
-            datalink_tun_log = path.join(
-                utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
-                % (self.datalink_name, tun_id, uid))
-            acklink_tun_log = path.join(
-                utils.tmp_dir, '%s_flow%s_uid%s.log.merged'
-                % (self.acklink_name, tun_id, uid))
-
-            cmd = [merge_tunnel_logs, 'single',
-                   '-i', self.datalink_ingress_logs[tun_id],
-                   '-e', self.datalink_egress_logs[tun_id],
-                   '-o', datalink_tun_log]
-            if apply_ofst:
-                cmd += ['-i-clock-offset', data_i_ofst,
-                        '-e-clock-offset', data_e_ofst]
-            call(cmd)
-
-            cmd = [merge_tunnel_logs, 'single',
-                   '-i', self.acklink_ingress_logs[tun_id],
-                   '-e', self.acklink_egress_logs[tun_id],
-                   '-o', acklink_tun_log]
-            if apply_ofst:
-                cmd += ['-i-clock-offset', ack_i_ofst,
-                        '-e-clock-offset', ack_e_ofst]
-            call(cmd)
-
-            datalink_tun_logs.append(datalink_tun_log)
-            acklink_tun_logs.append(acklink_tun_log)
-
-        cmd = [merge_tunnel_logs, 'multiple', '-o', self.datalink_log]
-        if self.mode == 'local':
-            cmd += ['--link-log', self.mm_datalink_log]
-        cmd += datalink_tun_logs
-        call(cmd)
+        if self.mode == 'remote':
+            self.download_tunnel_logs()
 
-        cmd = [merge_tunnel_logs, 'multiple', '-o', self.acklink_log]
+        for tun_id in xrange(1, self.flows + 1):
+            datalink_tunnels.append((self.datalink_ingress_logs[tun_id],
+                                     self.datalink_egress_logs[tun_id]) +
+                                    datalink_ofst)
+            acklink_tunnels.append((self.acklink_ingress_logs[tun_id],
+                                    self.acklink_egress_logs[tun_id]) +
+                                   acklink_ofst)
+
+        mm_datalink_log = mm_acklink_log = None
         if self.mode == 'local':
-            cmd += ['--link-log', self.mm_acklink_log]
-        cmd += acklink_tun_logs
-        call(cmd)
+            mm_datalink_log = self.mm_datalink_log
+            mm_acklink_log = self.mm_acklink_log
+
+        # merge the logs of all tunnels in this process, writing only the
+        # final datalink and acklink logs
+        errors = merge_links(
+            [(self.datalink_log, mm_datalink_log, datalink_tunnels),
+             (self.acklink_log, mm_acklink_log, acklink_tunnels)],
+            binary=self.binary_logs, processes=self.merge_processes)
+
+        for error in errors:
+            if error is not None:
+                sys.stderr.write('Warning: %s\n' % error)
 
     def run_congestion_control(self):
         if self.flows > 0:
@@ -734,6 +956,11 @@ class Test(object):
             sys.stderr.write(test_run_duration)
             stats.write(test_run_duration)
 
+        if self.converged_after is not None:
+            converged = 'Converged after: %.1f s\n' % self.converged_after
+            sys.stderr.write(converged)
+            stats.write(converged)
+
         if self.mode == 'remote':
             ofst_info = ''
             if self.local_ofst is not None:
@@ -796,19 +1023,84 @@ def run_tests(args):
     meta = vars(args).copy()
     meta['cc_schemes'] = sorted(cc_schemes)
     meta['git_summary'] = git_summary
+    # so that reports describe the system without running commands
+    meta['sys_info'] = utils.get_sys_info()
 
     metadata_path = path.join(args.data_dir, 'pantheon_metadata.json')
-    utils.save_test_metadata(meta, metadata_path)
+    utils.save_test_metadata(meta.copy(), metadata_path)
+
+    # with a confidence interval target, run_times is the minimum number of
+    # runs, and runs go on until the results of every scheme are precise
+    repetitions = None
+    max_run_times = args.run_times
+    if getattr(args, 'ci_target', None):
+        repetitions = Repetitions(args.run_times, args.max_run_times,
+                                  args.ci_target)
+        max_run_times = repetitions.max_runs
+        run_results = RunResults(args, cc_schemes)
 
     # run tests
     for run_id in xrange(args.start_run_id,
-                         args.start_run_id + args.run_times):
+                         args.start_run_id + max_run_times):
         if not hasattr(args, 'test_config') or args.test_config is None:
             for cc in cc_schemes:
                 Test(args, run_id, cc).run()
         else:
             Test(args, run_id, None).run()
 
+        if repetitions is not None:
+            results = run_results.add(run_id)
+            if all(repetitions.done(r) for r in results.values()):
+                break
+
+    if repetitions is not None:
+        # the analysis reads the number of runs from the metadata
+        meta['run_times'] = run_id - args.start_run_id + 1
+        utils.save_test_metadata(meta, metadata_path)
+        sys.stderr.write('Ran %d times, confidence intervals: %s\n' % (
+            meta['run_times'], run_results.summary(repetitions)))
+
+
+class RunResults(object):
+    """Results of the runs of a test, analyzed as soon as each run ends"""
+
+    def __init__(self, args, cc_schemes):
+        flow_info = None
+        if getattr(args, 'test_config', None) is not None:
+            cc_schemes = [args.test_config['test-name']]
+            flow_info = dict((i + 1, flow.get('flow_info')) for i, flow in
+                             enumerate(args.test_config['flows']))
+
+        plot_args = {'schemes': ' '.join(cc_schemes),
+                     'data_dir': args.data_dir,
+                     'no_graphs': True,
+                     'custom_test': True,
+                     'include_acklink': False}
+        Args = namedtuple('Args', plot_args.keys())
+        # analyzed logs are cached, so the final analysis does not parse
+        # them again
+        self.plot = Plot(Args(**plot_args), flow_info)
+        self.results = dict((cc, []) for cc in self.plot.cc_schemes)
+
+    def add(self, run_id):
+        """analyze run_id of every scheme and return the results of all
+        runs so far, by scheme (None for failed runs)"""
+        for cc in self.results:
+            try:
+                result = self.plot.parse_tunnel_log(cc, run_id)
+            except Exception:
+                traceback.print_exc()
+                result = None
+            self.results[cc].append(result)
+        return self.results
+
+    def summary(self, repetitions):
+        return ', '.join(
+            '%s: %s' % (cc, ', '.join(
+                '%s +-%.1f%%' % (metric, 100 * width) for metric, width in
+                sorted(repetitions.half_widths(results).items())))
+            for cc, results in sorted(self.results.items()))
+
 
 def pkill(args):
     sys.stderr.write('Cleaning up using pkill...'
@@ -1,5 +1,8 @@
 import math
-from numpy.random import poisson
+import json
+import hashlib
+import numpy as np
+from numpy.random import RandomState
 import argparse
 import os
 from helpers import utils
@@ -7,69 +10,111 @@ import context
 
 """Tool for generating mahimahi trace files. Can be used as a standalone commandline tool or from another python script."""
 
+#bump whenever generated traces change for the same parameters
+TRACE_FORMAT = 1
+
+#seed of poisson traces if none is given, so that cached traces are reproducible
+DEFAULT_SEED = 0
+
+#ms of trace formatted and written at once
+WRITE_CHUNK_MS = 60000
+
+def format_counts(counts, first_ms=1):
+	"""mahimahi trace lines for counts[i] delivery opportunities in ms first_ms+i"""
+	#format each ms once rather than each opportunity
+	return ''.join(('%d\n'%m)*c for m, c in enumerate(counts.tolist(), first_ms) if c)
+
+def write_trace(file_path, counts):
+	"""write a trace with counts[i] delivery opportunities in ms i+1 to file_path"""
+	#write atomically, as concurrent experiments may generate the same trace
+	tmp_path = '%s.%d.tmp'%(file_path, os.getpid())
+	with open(tmp_path, 'w') as f:
+		for start in xrange(0, len(counts), WRITE_CHUNK_MS):
+			f.write(format_counts(counts[start:start+WRITE_CHUNK_MS], start+1))
+		if not counts.any(): f.write('\n')
+	os.rename(tmp_path, file_path)
+
 class Trace():
 	"""Abstract trace object. Generates traces if they do not already exist."""
-	def __init__(self, mbps = 8, distribution = 'constant', file_path = None, ms = 1000):
+	def __init__(self, mbps = 8, distribution = 'constant', file_path = None, ms = 1000, seed = None):
 		"""
 		Arguments:
 			mbps -- float or integer, desired throughput
 			distribution -- 'constant' or 'poisson', depending on the distribution ot be used
-			file_path -- string, optional. If None, a combination of distribution and throughput will be used as default
+			file_path -- string, optional. If None, the trace is generated into a cache shared by all experiments, keyed by the other arguments
 			ms -- int, maximum length of generated trace
+			seed -- int, optional. Seed of the random numbers of poisson traces (default DEFAULT_SEED)
 		"""
 		self.mbps=mbps
+		self.name=distribution
 		if file_path: self.file_path = file_path
 		else:
 			trace_dir=os.path.join(context.src_dir, 'experiments/traces')
 			utils.make_sure_dir_exists(trace_dir)
-			self.file_path = '%s/%dmbps_%s.trace'%(trace_dir, mbps, distribution)
+			self.file_path = os.path.join(trace_dir, self.cache_name(mbps, distribution, ms, seed))
 			if not os.path.isfile(self.file_path):
-				self.generate_trace(mbps, distribution, trace_ms = ms, file_path = self.file_path)
+				#written in chunks rather than formatted as a whole
+				opportunities = self.opportunities(mbps, distribution, trace_ms = ms, seed = seed)
+				write_trace(self.file_path, np.bincount(opportunities)[1:])
 
-	def generate_constant_trace(self, mbps, max_trace_ms = 1000):
+	def cache_name(self, mbps, distribution, trace_ms, seed):
+		"""file name of a generated trace, addressed by everything its contents depend on"""
+		if distribution == 'poisson' and seed is None: seed = DEFAULT_SEED
+		if distribution == 'constant': seed = None
+		key = json.dumps([TRACE_FORMAT, float(mbps), distribution, trace_ms, seed])
+		return '%gmbps_%s_%s.trace'%(mbps, distribution, hashlib.sha1(key).hexdigest()[:16])
+
+	def constant_opportunities(self, mbps, max_trace_ms = 1000):
+		"""return the ms of each delivery opportunity of a constant trace, which ends as soon as its average is close to mbps"""
 		mtu_per_ms = mbps/12.0 #Mbps/8/1500*1000
 		full_mtu_per_ms = int(math.floor(mtu_per_ms))
 		mtu_buildup = 0.0
-		trace = []
+		counts = []
+		total = 0
+		#accumulate fractions per ms as before, so that traces do not change
 		for i in xrange(1, max_trace_ms+1):
-			trace = trace + [i]*full_mtu_per_ms
+			count = full_mtu_per_ms
 			mtu_buildup += mtu_per_ms - full_mtu_per_ms
 			if mtu_buildup >= 1.0:
-				trace.append(i)
+				count += 1
 				mtu_buildup -=1
-			if abs(len(trace)/float(i)-mtu_per_ms) < 0.05:
+			counts.append(count)
+			total += count
+			if abs(total/float(i)-mtu_per_ms) < 0.05:
 				break
 
+		return np.repeat(np.arange(1, len(counts)+1), counts)
 
-		str_trace = map(str, trace)
-		result = '\n'.join(str_trace) + '\n'
+	def poisson_opportunities(self, mbps, trace_ms=1000, seed=None):
+		"""return the ms of each delivery opportunity of a trace with a poisson distributed number of opportunities per ms"""
+		mtu_per_ms = mbps/12.0 #Mbps/8/1500*1000
+		if seed is None: seed = DEFAULT_SEED
+		counts = RandomState(seed).poisson(mtu_per_ms, trace_ms)
+		return np.repeat(np.arange(1, trace_ms+1), counts)
 
-		return result
+	def format_trace(self, opportunities):
+		"""mahimahi trace file contents, one line per delivery opportunity"""
+		if not len(opportunities): return '\n'
+		return format_counts(np.bincount(opportunities)[1:])
 
-	def generate_poisson_trace(self, mbps, trace_ms=1000):
-		mtu_per_ms = mbps/12.0 #Mbps/8/1500*1000
-		distribution = poisson(mtu_per_ms, trace_ms)
-		trace = []
-		for i, p in enumerate(distribution):
-			trace += [i+1]*p
-		str_trace = map(str, trace)
-		result = '\n'.join(str_trace) + '\n'
+	def opportunities(self, mbps, distribution, trace_ms=1000, seed=None):
+		if distribution == "constant": return self.constant_opportunities(mbps, trace_ms)
+		if distribution == "poisson": return self.poisson_opportunities(mbps, trace_ms, seed)
+		raise Exception("unknown distribution \"%s\"" % distribution)
+
+	def generate_constant_trace(self, mbps, max_trace_ms = 1000):
+		return self.format_trace(self.constant_opportunities(mbps, max_trace_ms))
 
-		return result
+	def generate_poisson_trace(self, mbps, trace_ms=1000, seed=None):
+		return self.format_trace(self.poisson_opportunities(mbps, trace_ms, seed))
 
 	#Mbps: average Mb/s of the generated trace
 	#distribution: "constant" or "poisson", depending on the probability distribution to be used
-	#trace size: length of trace file in milliseconds		
-	def generate_trace(self, mbps, distribution, trace_ms=1000, file_path=None):
-		if distribution == "constant": trace = self.generate_constant_trace(mbps, trace_ms)
-		elif distribution == "poisson": trace = self.generate_poisson_trace(mbps, trace_ms)
-		else: raise Exception("unknown distribution \"%s\"" % distribution)
-
-		if file_path:
-			with open(file_path, "w+") as f:
-				f.write(trace)
-
-		return trace
+	#trace size: length of trace file in milliseconds
+	def generate_trace(self, mbps, distribution, trace_ms=1000, file_path=None, seed=None):
+		opportunities = self.opportunities(mbps, distribution, trace_ms, seed)
+		if file_path: write_trace(file_path, np.bincount(opportunities)[1:])
+		return self.format_trace(opportunities)
 
 	def get_path(self):
 		return self.file_path
@@ -79,8 +124,9 @@ if __name__ == "__main__":
 	parser.add_argument('Mbps', type=float, help='average Mbps of the trace file')
 	parser.add_argument('distribution', help='"constant" or "poisson", the distribution to be used')
 	parser.add_argument('--trace_ms', type=int, help='maximum length of the trace in ms', default=1000)
+	parser.add_argument('--seed', type=int, help='seed of poisson traces (default %d)'%DEFAULT_SEED, default=None)
 	parser.add_argument('--file', help='file path to write trace to')
 	args = parser.parse_args()
-	
-	print(Trace(file_path='a').generate_trace(args.Mbps, args.distribution, args.trace_ms, args.file))
-	
+
+	print(Trace(file_path='a').generate_trace(args.Mbps, args.distribution, args.trace_ms, args.file, args.seed))
+
@@ -0,0 +1,197 @@
+import os
+import json
+import bisect
+import hashlib
+import numpy as np
+from numpy.random import RandomState
+import context
+from helpers import utils
+from trace import TRACE_FORMAT, DEFAULT_SEED, write_trace
+
+"""Synthesis of time-varying mahimahi traces, such as capacity steps, on/off outages and Markov-modulated cellular links.
+
+Every trace comes with the analytic expected capacity of the link over time, stored next to the trace file (see load_capacity)."""
+
+#suffix of the expected capacity file of a trace
+CAPACITY_SUFFIX = '.capacity.json'
+
+#ms per bin of the expected capacity series
+CAPACITY_BIN_MS = 100
+
+def rates_to_counts(mbps, rng=None):
+	"""return the number of delivery opportunities in each ms of a link with rate mbps[i] in ms i+1
+
+	Opportunities are poisson distributed if rng (a RandomState) is given, and spread evenly otherwise."""
+	mtu_per_ms = np.asarray(mbps, dtype=np.float64)/12.0 #Mbps/8/1500*1000
+	if rng is not None:
+		return rng.poisson(mtu_per_ms)
+	#carry fractions of opportunities over to the following ms
+	total = np.floor(np.cumsum(mtu_per_ms) + 1e-9).astype(np.int64)
+	return np.diff(np.concatenate(([0], total)))
+
+def schedule_rates(schedule, duration_ms):
+	"""return the rate in each ms of a piecewise constant schedule [(start ms, mbps), ...], which must start at 0 ms"""
+	starts, rates = zip(*sorted(schedule))
+	if starts[0] != 0:
+		raise Exception('rate schedule must start at 0 ms')
+	segment = np.searchsorted(starts, np.arange(duration_ms), side='right') - 1
+	return np.asarray(rates, dtype=np.float64)[segment]
+
+def bin_means(values, bin_ms):
+	"""average values over bins of bin_ms entries (the last bin may be shorter)"""
+	bins = np.arange(len(values)) // bin_ms
+	return np.bincount(bins, weights=values) / np.bincount(bins)
+
+def capacity_path(trace_path):
+	return trace_path + CAPACITY_SUFFIX
+
+def load_capacity(trace_path):
+	"""return (ms per bin, expected capacity in Mbps per bin) of a synthesized trace, or None for other traces"""
+	try:
+		with open(capacity_path(trace_path)) as f:
+			capacity = json.load(f)
+	except (IOError, ValueError):
+		return None
+	return capacity['bin_ms'], np.array(capacity['expected_mbps'])
+
+class SynthesizedTrace(object):
+	"""Trace generated from the rate of the link in each ms, with the same interface as Trace.
+
+	Subclasses describe themselves by params and implement rates(rng), the rate in each ms of one realization of the link, and expected_rates(), its expected rate in each ms.
+	Traces are cached in the trace directory by a hash of their parameters, like those of Trace."""
+
+	def __init__(self, name, params, duration_ms, poisson=False, seed=None):
+		"""
+		Arguments:
+			name -- string, names the trace in file names and results
+			params -- JSON serializable parameters of the subclass
+			duration_ms -- int, length of the trace, after which mahimahi repeats it
+			poisson -- bool, draw the opportunities of each ms from a poisson distribution instead of spreading them evenly
+			seed -- int, optional. Seed of all random numbers of the trace (default DEFAULT_SEED)
+		"""
+		self.name = name
+		self.duration_ms = int(duration_ms)
+		self.poisson = poisson
+		self.seed = DEFAULT_SEED if seed is None else seed
+
+		key = json.dumps([TRACE_FORMAT, type(self).__name__, params, self.duration_ms, poisson, self.seed], sort_keys=True)
+		trace_dir = os.path.join(context.src_dir, 'experiments/traces')
+		utils.make_sure_dir_exists(trace_dir)
+		self.file_path = os.path.join(trace_dir, '%s_%s.trace'%(name, hashlib.sha1(key).hexdigest()[:16]))
+
+		if not os.path.isfile(capacity_path(self.file_path)) or not os.path.isfile(self.file_path):
+			self.generate()
+
+		bin_ms, expected_mbps = load_capacity(self.file_path)
+		self.mbps = float(np.dot(expected_mbps, self.bin_lengths(bin_ms))) / self.duration_ms
+
+	def bin_lengths(self, bin_ms):
+		lengths = np.full(-(-self.duration_ms // bin_ms), bin_ms, dtype=np.float64)
+		lengths[-1] = self.duration_ms - bin_ms*(len(lengths)-1)
+		return lengths
+
+	def generate(self):
+		rng = RandomState(self.seed)
+		counts = rates_to_counts(self.rates(rng), rng if self.poisson else None)
+		#mahimahi repeats a trace after its last opportunity, which must therefore be in its last ms
+		if counts[-1] == 0:
+			counts[-1] = 1
+		write_trace(self.file_path, counts)
+
+		#write the capacity last, as it marks the trace as complete
+		capacity = {'bin_ms': CAPACITY_BIN_MS,
+				'duration_ms': self.duration_ms,
+				'expected_mbps': bin_means(self.expected_rates(), CAPACITY_BIN_MS).tolist()}
+		tmp_path = '%s.%d.tmp'%(capacity_path(self.file_path), os.getpid())
+		with open(tmp_path, 'w') as f:
+			json.dump(capacity, f)
+		os.rename(tmp_path, capacity_path(self.file_path))
+
+	def rates(self, rng):
+		raise NotImplementedError
+
+	def expected_rates(self):
+		raise NotImplementedError
+
+	def get_path(self):
+		return self.file_path
+
+class ScheduleTrace(SynthesizedTrace):
+	"""Trace of a link whose rate follows a piecewise constant schedule, e.g. capacity steps"""
+
+	def __init__(self, schedule, duration_ms, name='schedule', poisson=False, seed=None):
+		"""
+		Arguments:
+			schedule -- list of (start ms, mbps), the rate from each start on, starting at 0 ms
+			duration_ms -- int, length of the trace
+		"""
+		self.schedule = sorted((int(start), float(mbps)) for start, mbps in schedule)
+		super(ScheduleTrace, self).__init__(name, self.schedule, duration_ms, poisson, seed)
+
+	def rates(self, rng):
+		return schedule_rates(self.schedule, self.duration_ms)
+
+	def expected_rates(self):
+		return schedule_rates(self.schedule, self.duration_ms)
+
+class OnOffTrace(ScheduleTrace):
+	"""Trace of a link that is repeatedly up at mbps for on_ms and down for off_ms"""
+
+	def __init__(self, mbps, on_ms, off_ms, duration_ms, name='onoff', poisson=False, seed=None):
+		schedule = []
+		for start in xrange(0, int(duration_ms), int(on_ms + off_ms)):
+			schedule += [(start, mbps), (start + on_ms, 0)]
+		super(OnOffTrace, self).__init__(schedule, duration_ms, name, poisson, seed)
+
+class MarkovTrace(SynthesizedTrace):
+	"""Trace of a cellular-style link whose rate is modulated by a Markov chain
+
+	Every step_ms, the chain moves from state i to state j with probability transitions[i][j]; in state i the link runs at states_mbps[i]."""
+
+	def __init__(self, states_mbps, transitions, step_ms, duration_ms, initial=0, name='markov', poisson=False, seed=None):
+		"""
+		Arguments:
+			states_mbps -- list of the rate in each state
+			transitions -- square matrix (list of lists) of transition probabilities, whose rows sum to 1
+			step_ms -- int, ms between two transitions
+			duration_ms -- int, length of the trace
+			initial -- int, state the chain starts in
+		"""
+		self.states_mbps = np.asarray(states_mbps, dtype=np.float64)
+		self.transitions = np.asarray(transitions, dtype=np.float64)
+		if self.transitions.shape != (len(self.states_mbps),)*2 or not np.allclose(self.transitions.sum(axis=1), 1):
+			raise Exception('transitions must be a %dx%d matrix whose rows sum to 1'%((len(self.states_mbps),)*2))
+		self.step_ms = int(step_ms)
+		self.initial = initial
+		self.steps = -(-int(duration_ms) // self.step_ms)
+
+		params = [self.states_mbps.tolist(), self.transitions.tolist(), self.step_ms, initial]
+		super(MarkovTrace, self).__init__(name, params, duration_ms, poisson, seed)
+
+	def per_ms(self, per_step):
+		return np.repeat(per_step, self.step_ms)[:self.duration_ms]
+
+	def rates(self, rng):
+		cumulative = np.cumsum(self.transitions, axis=1).tolist()
+		draws = rng.random_sample(self.steps).tolist()
+		last_state = len(self.states_mbps) - 1
+		states = np.empty(self.steps, dtype=np.int64)
+		state = self.initial
+		for step in xrange(self.steps):
+			states[step] = state
+			state = min(bisect.bisect_right(cumulative[state], draws[step]), last_state)
+		return self.per_ms(self.states_mbps[states])
+
+	def expected_rates(self):
+		#distribution over states in each step, until it converges
+		expected = np.empty(self.steps)
+		distribution = np.zeros(len(self.states_mbps))
+		distribution[self.initial] = 1.0
+		for step in xrange(self.steps):
+			expected[step] = np.dot(distribution, self.states_mbps)
+			next_distribution = np.dot(distribution, self.transitions)
+			if np.allclose(next_distribution, distribution, rtol=0, atol=1e-12):
+				expected[step:] = expected[step]
+				break
+			distribution = next_distribution
+		return self.per_ms(expected)
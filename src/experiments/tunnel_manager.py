@@ -1,108 +1,426 @@
 #!/usr/bin/env python
 
+"""Runs pantheon tunnels, and the commands inside them, on behalf of Test.
+
+A tunnel manager reads requests from stdin and writes replies and events to
+stdout, one JSON object per line. Every request carries an id that is
+repeated in its reply:
+
+    {"id": 1, "cmd": "tunnel", "tunnel": 1, "args": "mm-tunnelserver ..."}
+    {"id": 2, "cmd": "batch", "requests": [{"cmd": "tunnel", ...}, ...]}
+    {"id": 3, "cmd": "status"}
+    {"id": 4, "cmd": "prompt", "prompt": "[tsm]"}
+    {"id": 5, "cmd": "halt"}
+
+A "tunnel" request starts the tunnel client or server of a tunnel, replacing
+the one running already, or runs a command inside a running tunnel. The
+output of tunnel processes is streamed as events as soon as it is read,
+tagged with the tunnel and the pid of the process:
+
+    {"event": "output", "tunnel": 1, "pid": 1234, "line": "got connection"}
+    {"event": "exit", "tunnel": 1, "pid": 1234, "returncode": 0}
+
+TunnelManagerClient drives a tunnel manager without blocking on it, so that
+the tunnels of many flows are handled in parallel.
+"""
+
 import os
 from os import path
 import sys
+import json
+import time
+import select
 import signal
+from collections import deque
 from subprocess import Popen, PIPE
 
 import context
 from helpers import utils
 
 
-def main():
-    prompt = ''
-    procs = {}
+# processes that run a tunnel
+TUNNEL_PROCESSES = ['mm-tunnelclient', 'mm-tunnelserver']
 
-    # register SIGINT and SIGTERM events to clean up gracefully before quit
-    def stop_signal_handler(signum, frame):
-        for tun_id in procs:
-            utils.kill_proc_group(procs[tun_id])
+# commands run inside a tunnel
+TUNNEL_COMMANDS = ['python', 'mm-link', 'mm-loss', 'mm-delay', 'mm-onoff']
 
-        sys.exit('tunnel_manager: caught signal %s and cleaned up\n' % signum)
+# output lines kept per tunnel by TunnelManagerClient until they are consumed
+MAX_LINES = 1000
 
-    signal.signal(signal.SIGINT, stop_signal_handler)
-    signal.signal(signal.SIGTERM, stop_signal_handler)
 
-    sys.stdout.write('tunnel manager is running\n')
-    sys.stdout.flush()
+class LineReader(object):
+    """Splits what is read from a file descriptor into lines, without
+    blocking on incomplete lines."""
 
-    while True:
-        input_cmd = sys.stdin.readline().strip()
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = ''
+        self.eof = False
+
+    def read(self):
+        """Read what is available on fd (call only once select reports it
+        readable) and return the lines completed by it."""
+        data = os.read(self.fd, 1 << 16)
+        if not data:
+            self.eof = True
+            lines = [self.buf] if self.buf else []
+            self.buf = ''
+            return lines
+
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        return lines
 
+
+def tunnel_request(tun_id, args):
+    return {'cmd': 'tunnel', 'tunnel': tun_id, 'args': args}
+
+
+def starts_tunnel(request):
+    args = request.get('args', '').split()
+    return (request.get('cmd') == 'tunnel' and len(args) > 0 and
+            args[0] in TUNNEL_PROCESSES)
+
+
+class TunnelManager(object):
+    def __init__(self):
+        self.prompt = ''
+        self.procs = {}
+
+        # fd of the stdout of a tunnel process -> (tun_id, proc, LineReader)
+        self.readers = {}
+        self.stdin = LineReader(sys.stdin.fileno())
+
+    def send(self, msg):
+        sys.stdout.write(json.dumps(msg) + '\n')
+        sys.stdout.flush()
+
+    def log(self, request):
         # print all the commands fed into tunnel manager
-        if prompt:
-            sys.stderr.write(prompt + ' ')
-        sys.stderr.write(input_cmd + '\n')
-        cmd = input_cmd.split()
+        if request.get('cmd') == 'tunnel':
+            line = 'tunnel %s %s' % (request.get('tunnel'),
+                                     request.get('args', '').strip())
+        else:
+            line = request.get('cmd', '')
+
+        if self.prompt:
+            sys.stderr.write(self.prompt + ' ')
+        sys.stderr.write(line + '\n')
+
+    def start_tunnel(self, tun_id, args):
+        # expand env variables (e.g., MAHIMAHI_BASE)
+        cmd_to_run = path.expandvars(' '.join(args)).split()
+
+        # expand home directory
+        for i in xrange(len(cmd_to_run)):
+            if ('--ingress-log' in cmd_to_run[i] or
+                '--egress-log' in cmd_to_run[i]):
+                t = cmd_to_run[i].split('=')
+                cmd_to_run[i] = t[0] + '=' + path.expanduser(t[1])
+
+        if tun_id in self.procs:
+            self.stop_tunnel(tun_id)
+
+        proc = Popen(cmd_to_run, stdin=PIPE, stdout=PIPE,
+                     preexec_fn=os.setsid)
+        self.procs[tun_id] = proc
+
+        fd = proc.stdout.fileno()
+        self.readers[fd] = (tun_id, proc, LineReader(fd))
+
+        return proc.pid
+
+    def stop_tunnel(self, tun_id):
+        proc = self.procs.pop(tun_id)
+        self.readers.pop(proc.stdout.fileno(), None)
+
+        utils.kill_proc_group(proc)
+        proc.stdout.close()
+
+    def run_in_tunnel(self, tun_id, args):
+        # run python scripts inside tunnel
+        self.procs[tun_id].stdin.write(' '.join(args) + '\n')
+        self.procs[tun_id].stdin.flush()
+
+    def handle(self, request):
+        """Carry out request and return its reply, without the id."""
+        cmd = request.get('cmd')
 
         # manage I/O of multiple tunnels
-        if cmd[0] == 'tunnel':
-            if len(cmd) < 3:
-                sys.stderr.write('error: usage: tunnel ID CMD...\n')
-                continue
+        if cmd == 'tunnel':
+            tun_id = request['tunnel']
+            args = request['args'].split()
+
+            if args and args[0] in TUNNEL_PROCESSES:
+                pid = self.start_tunnel(tun_id, args)
+                return {'ok': True, 'tunnel': tun_id, 'pid': pid}
+
+            if args and args[0] in TUNNEL_COMMANDS:
+                if tun_id not in self.procs:
+                    return {'ok': False, 'tunnel': tun_id,
+                            'error': 'run tunnel client or server first'}
+
+                self.run_in_tunnel(tun_id, args)
+                return {'ok': True, 'tunnel': tun_id}
+
+            return {'ok': False, 'tunnel': tun_id,
+                    'error': 'unknown command after "tunnel ID": %s'
+                             % ' '.join(args)}
+
+        if cmd == 'batch':
+            replies = []
+            for sub_request in request.get('requests', []):
+                self.log(sub_request)
+                replies.append(self.handle_safely(sub_request))
+
+            return {'ok': all(reply['ok'] for reply in replies),
+                    'replies': replies}
+
+        if cmd == 'status':
+            tunnels = {}
+            for tun_id, proc in self.procs.iteritems():
+                returncode = proc.poll()
+                tunnels[tun_id] = {'pid': proc.pid,
+                                   'running': returncode is None,
+                                   'returncode': returncode}
 
+            return {'ok': True, 'tunnels': tunnels}
+
+        # set prompt in front of commands to print
+        if cmd == 'prompt':
+            self.prompt = request['prompt'].strip()
+            return {'ok': True}
+
+        return {'ok': False, 'error': 'unknown command: %s' % cmd}
+
+    def handle_safely(self, request):
+        try:
+            return self.handle(request)
+        except (KeyError, AttributeError, TypeError, EnvironmentError) as e:
+            return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+
+    def halt(self):
+        # terminate all tunnel processes and quit
+        for tun_id in self.procs.keys():
+            self.stop_tunnel(tun_id)
+
+        sys.exit(0)
+
+    def read_requests(self):
+        for line in self.stdin.read():
             try:
-                tun_id = int(cmd[1])
+                request = json.loads(line)
             except ValueError:
-                sys.stderr.write('error: usage: tunnel ID CMD...\n')
+                sys.stderr.write('error: invalid request: %s\n' % line)
                 continue
 
-            cmd_to_run = ' '.join(cmd[2:])
-
-            if cmd[2] == 'mm-tunnelclient' or cmd[2] == 'mm-tunnelserver':
-                # expand env variables (e.g., MAHIMAHI_BASE)
-                cmd_to_run = path.expandvars(cmd_to_run).split()
-
-                # expand home directory
-                for i in xrange(len(cmd_to_run)):
-                    if ('--ingress-log' in cmd_to_run[i] or
-                        '--egress-log' in cmd_to_run[i]):
-                        t = cmd_to_run[i].split('=')
-                        cmd_to_run[i] = t[0] + '=' + path.expanduser(t[1])
-
-                procs[tun_id] = Popen(cmd_to_run, stdin=PIPE,
-                                      stdout=PIPE, preexec_fn=os.setsid)
-            elif cmd[2] in ['python', 'mm-link', 'mm-loss', 'mm-delay', 'mm-onoff']:  # run python scripts inside tunnel
-                if tun_id not in procs:
-                    sys.stderr.write(
-                        'error: run tunnel client or server first\n')
-
-                procs[tun_id].stdin.write(cmd_to_run + '\n')
-                procs[tun_id].stdin.flush()
-            elif cmd[2] == 'readline':  # readline from stdout of tunnel
-                if len(cmd) != 3:
-                    sys.stderr.write('error: usage: tunnel ID readline\n')
-                    continue
-
-                if tun_id not in procs:
-                    sys.stderr.write(
-                        'error: run tunnel client or server first\n')
-
-                sys.stdout.write(procs[tun_id].stdout.readline())
-                sys.stdout.flush()
-            else:
-                sys.stderr.write('unknown command after "tunnel ID": %s\n'
-                                 % cmd_to_run)
-                continue
-        elif cmd[0] == 'prompt':  # set prompt in front of commands to print
-            if len(cmd) != 2:
-                sys.stderr.write('error: usage: prompt PROMPT\n')
+            if not isinstance(request, dict):
+                sys.stderr.write('error: invalid request: %s\n' % line)
                 continue
 
-            prompt = cmd[1].strip()
-        elif cmd[0] == 'halt':  # terminate all tunnel processes and quit
-            if len(cmd) != 1:
-                sys.stderr.write('error: usage: halt\n')
-                continue
+            self.log(request)
+            if request.get('cmd') == 'halt':
+                self.send({'id': request.get('id'), 'ok': True})
+                self.halt()
 
-            for tun_id in procs:
-                utils.kill_proc_group(procs[tun_id])
+            reply = self.handle_safely(request)
+            reply['id'] = request.get('id')
+            self.send(reply)
 
-            sys.exit(0)
-        else:
-            sys.stderr.write('unknown command: %s\n' % input_cmd)
-            continue
+        if self.stdin.eof:
+            self.halt()
+
+    def read_tunnel(self, fd):
+        tun_id, proc, reader = self.readers[fd]
+
+        for line in reader.read():
+            self.send({'event': 'output', 'tunnel': tun_id, 'pid': proc.pid,
+                       'line': line})
+
+        if reader.eof:
+            del self.readers[fd]
+            self.send({'event': 'exit', 'tunnel': tun_id, 'pid': proc.pid,
+                       'returncode': proc.wait()})
+
+    def run(self):
+        self.send({'event': 'ready'})
+
+        while True:
+            fds = [self.stdin.fd] + self.readers.keys()
+            for fd in select.select(fds, [], [])[0]:
+                if fd == self.stdin.fd:
+                    self.read_requests()
+                elif fd in self.readers:
+                    self.read_tunnel(fd)
+
+
+class TunnelManagerClient(object):
+    """Sends requests to a tunnel manager running in proc, and collects its
+    replies and the output of its tunnels as they arrive, whenever poll()
+    or wait_until() finds them readable."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.reader = LineReader(proc.stdout.fileno())
+        self.next_id = 0
+
+        self.ready = False
+        self.closed = False
+        self.replies = {}
+
+        # tun_id -> pid of its tunnel process, None while it is (re)started
+        self.pids = {}
+
+        # tun_id -> output lines not consumed yet
+        self.lines = {}
+
+        # tun_id -> return code of its tunnel process once it exited
+        self.exits = {}
+
+    def fileno(self):
+        return self.reader.fd
+
+    def forget_tunnel(self, request):
+        if starts_tunnel(request):
+            tun_id = request['tunnel']
+            self.pids[tun_id] = None
+            self.lines.pop(tun_id, None)
+            self.exits.pop(tun_id, None)
+
+        for sub_request in request.get('requests', []):
+            self.forget_tunnel(sub_request)
+
+    def send(self, request):
+        """Send request and return its id, without waiting for the reply."""
+        self.next_id += 1
+        request = dict(request, id=self.next_id)
+
+        # drop output of the process a tunnel is replaced with from now on
+        self.forget_tunnel(request)
+
+        self.proc.stdin.write(json.dumps(request) + '\n')
+        self.proc.stdin.flush()
+
+        return self.next_id
+
+    def request(self, cmd, **kwargs):
+        return self.send(dict(kwargs, cmd=cmd))
+
+    def tunnel(self, tun_id, args):
+        return self.send(tunnel_request(tun_id, args))
+
+    def batch(self, requests):
+        return self.request('batch', requests=requests)
+
+    def handle_reply(self, reply):
+        if 'pid' in reply:
+            self.pids[reply['tunnel']] = reply['pid']
+
+        if not reply['ok'] and 'replies' not in reply:
+            sys.stderr.write('Warning: tunnel manager: %s\n'
+                             % reply.get('error'))
+
+        for sub_reply in reply.get('replies', []):
+            self.handle_reply(sub_reply)
+
+    def handle_message(self, msg):
+        event = msg.get('event')
+
+        if event == 'ready':
+            self.ready = True
+        elif event in ['output', 'exit']:
+            tun_id = msg['tunnel']
+
+            # skip output of processes replaced since
+            if self.pids.get(tun_id) != msg['pid']:
+                return
+
+            if event == 'output':
+                if tun_id not in self.lines:
+                    self.lines[tun_id] = deque(maxlen=MAX_LINES)
+                self.lines[tun_id].append(msg['line'])
+            else:
+                self.exits[tun_id] = msg['returncode']
+        elif 'id' in msg:
+            self.handle_reply(msg)
+            self.replies[msg['id']] = msg
+
+    def handle_input(self):
+        for line in self.reader.read():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue  # e.g., a login banner printed over ssh
+
+            if isinstance(msg, dict):
+                self.handle_message(msg)
+
+        if self.reader.eof:
+            self.closed = True
+
+    def next_line(self, tun_id):
+        """Pop the oldest output line of tun_id not consumed yet, or None."""
+        lines = self.lines.get(tun_id)
+        if not lines:
+            return None
+
+        return lines.popleft()
+
+    def has_exited(self, tun_id):
+        return tun_id in self.exits
+
+
+def poll(managers, timeout):
+    """Handle the messages that arrive from any of managers within timeout
+    seconds."""
+    managers = [manager for manager in managers if not manager.closed]
+    if not managers:
+        time.sleep(max(0, timeout))
+        return
+
+    for manager in select.select(managers, [], [], max(0, timeout))[0]:
+        manager.handle_input()
+
+
+def wait_until(managers, condition, deadline):
+    """Handle messages from managers until condition() holds, all managers
+    exited or time.time() reaches deadline, and return condition()."""
+    while not condition():
+        remaining = deadline - time.time()
+        if remaining <= 0 or all(manager.closed for manager in managers):
+            return condition()
+
+        poll(managers, remaining)
+
+    return True
+
+
+def sleep(managers, seconds):
+    """Sleep while handling messages from managers, so that the output of
+    their tunnels never fills up the pipes."""
+    deadline = time.time() + seconds
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+
+        poll(managers, remaining)
+
+
+def main():
+    manager = TunnelManager()
+
+    # register SIGINT and SIGTERM events to clean up gracefully before quit
+    def stop_signal_handler(signum, frame):
+        for tun_id in manager.procs:
+            utils.kill_proc_group(manager.procs[tun_id])
+
+        sys.exit('tunnel_manager: caught signal %s and cleaned up\n' % signum)
+
+    signal.signal(signal.SIGINT, stop_signal_handler)
+    signal.signal(signal.SIGTERM, stop_signal_handler)
+
+    manager.run()
 
 
 if __name__ == '__main__':
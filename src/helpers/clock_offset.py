@@ -0,0 +1,83 @@
+import sys
+import time
+
+import utils
+
+
+# seconds for which measured clock offsets are reused by later runs
+DEFAULT_VALIDITY = 120
+
+# ms by which an offset may change between two measurements for it to be
+# reused, about twice the jitter of NTP; offsets changing more are measured
+# every run
+MAX_OFFSET_CHANGE = 2.0
+
+# ClockOffsets shared by all runs of a process, by NTP server and ssh command
+shared_offsets = {}
+
+
+def clock_offsets(ntp_addr, ssh_cmd, validity=DEFAULT_VALIDITY):
+    """return the ClockOffsets of the local and remote side shared by all
+    runs that query ntp_addr"""
+    key = (ntp_addr, tuple(ssh_cmd))
+    if key not in shared_offsets:
+        shared_offsets[key] = ClockOffsets(ntp_addr, ssh_cmd, validity)
+    shared_offsets[key].validity = validity
+    return shared_offsets[key]
+
+
+class ClockOffsets(object):
+    """Clock offsets of the local and remote side towards an NTP server.
+
+    Offsets are measured with utils.query_clock_offset and reused as they are
+    for validity seconds. If an offset changed by more than MAX_OFFSET_CHANGE
+    since the previous measurement, reusing it would have been that far off,
+    so offsets are measured every time until they are stable again.
+    """
+
+    def __init__(self, ntp_addr, ssh_cmd, validity=DEFAULT_VALIDITY):
+        self.ntp_addr = ntp_addr
+        self.ssh_cmd = ssh_cmd
+        self.validity = validity
+
+        self.measured_ts = None  # time.time() of the last measurement
+        self.offsets = None  # (local, remote) offset, str in ms
+        self.drifting = False  # whether the last measurement changed much
+
+    def measure(self):
+        local, remote = utils.query_clock_offset(self.ntp_addr, self.ssh_cmd)
+        if local is None or remote is None:
+            # measure again next time rather than reuse a failed measurement
+            self.measured_ts = None
+            self.offsets = None
+            return local, remote
+
+        if self.offsets is not None:
+            self.drifting = False
+            for side, old, new in zip(['local', 'remote'], self.offsets,
+                                      (local, remote)):
+                change = float(new) - float(old)
+                if abs(change) > MAX_OFFSET_CHANGE:
+                    sys.stderr.write(
+                        'Warning: %s clock offset changed by %.1f ms in %.0f '
+                        's, measuring it every run\n' %
+                        (side, change, time.time() - self.measured_ts))
+                    self.drifting = True
+
+        self.measured_ts = time.time()
+        self.offsets = (local, remote)
+        return local, remote
+
+    def get(self):
+        """Return the (local, remote) clock offsets (str in ms, or None if
+        they could not be measured), like utils.query_clock_offset."""
+        elapsed = None
+        if self.measured_ts is not None:
+            elapsed = time.time() - self.measured_ts
+
+        if elapsed is None or elapsed > self.validity or self.drifting:
+            return self.measure()
+
+        sys.stderr.write('Reusing clock offsets measured %.0f s ago\n' %
+                         elapsed)
+        return self.offsets
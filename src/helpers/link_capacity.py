@@ -0,0 +1,98 @@
+import json
+from os import path
+
+import numpy as np
+
+
+# bits delivered per opportunity of an mm-link trace (one MTU-sized packet)
+BITS_PER_OPPORTUNITY = 1500 * 8
+
+
+def link_info_path(data_dir, cc, run_id):
+    return path.join(data_dir, '%s_link_run%s.json' % (cc, run_id))
+
+
+def save_link_info(info_path, datalink_trace, acklink_trace, start_ts):
+    """Record the traces of an mm-link and when it started (ms since the
+    epoch), so that its capacity can be derived without mm-link logs."""
+    info = {'datalink_trace': path.abspath(datalink_trace),
+            'acklink_trace': path.abspath(acklink_trace),
+            'start_ts': start_ts}
+    with open(info_path, 'w') as info_file:
+        json.dump(info, info_file)
+
+
+def load_link_capacity(data_dir, cc, run_id, link_t):
+    """Return a TraceCapacity for the datalink or acklink of a run whose
+    mm-link did not log, or None if the run has no link info."""
+    info_path = link_info_path(data_dir, cc, run_id)
+    if not path.isfile(info_path):
+        return None
+
+    with open(info_path) as info_file:
+        info = json.load(info_file)
+    return TraceCapacity(info['%s_trace' % link_t], info['start_ts'])
+
+
+class TraceCapacity(object):
+    """Capacity of an mm-link over time, computed from its trace.
+
+    mm-link delivers up to one packet at each ms listed in the trace, counted
+    from when the link started, and repeats the trace once it reaches its
+    last ms. The delivery opportunities before any point in time are
+    therefore known without logging them.
+    """
+
+    def __init__(self, trace_path, start_ts):
+        """
+            Arguments:
+            trace_path -- mahimahi trace of the link
+            start_ts -- ms since the epoch at which the link started
+        """
+        self.trace_path = trace_path
+        self.start_ts = start_ts
+
+        with open(trace_path) as trace:
+            self.opportunities = np.sort(
+                np.fromstring(trace.read(), dtype=np.int64, sep='\n'))
+        if not len(self.opportunities):
+            raise ValueError('trace %s is empty' % trace_path)
+
+        self.period = int(self.opportunities[-1])
+        if self.period <= 0:
+            raise ValueError('trace %s must end after 0 ms' % trace_path)
+
+    def params(self):
+        """JSON serializable parameters the capacity depends on"""
+        return [self.trace_path, self.start_ts]
+
+    def opportunities_before(self, ts):
+        """Number of delivery opportunities before each of the timestamps ts
+        (array of ms since the epoch)."""
+        t = np.asarray(ts, dtype=np.float64) - self.start_ts
+        t = np.maximum(t, 0)
+        periods = np.floor(t / self.period).astype(np.int64)
+
+        # all repetitions of the trace up to the previous one are complete,
+        # apart from its last opportunity if it coincides with t
+        count = np.maximum(periods - 1, 0) * len(self.opportunities)
+        previous = np.searchsorted(
+            self.opportunities, t - (periods - 1) * self.period)
+        count += np.where(periods > 0, previous, 0)
+        count += np.searchsorted(self.opportunities, t - periods * self.period)
+        return count
+
+    def binned(self, base_ts, ms_per_bin, num_bins):
+        """Bits the link could deliver in each of num_bins bins of ms_per_bin
+        ms from base_ts (ms since the epoch) on."""
+        edges = base_ts + ms_per_bin * np.arange(num_bins + 1)
+        return np.diff(self.opportunities_before(edges)) * BITS_PER_OPPORTUNITY
+
+    def average(self, first_ts, last_ts):
+        """Average capacity in Mbit/s between two timestamps (ms since the
+        epoch), or 0 if they are equal."""
+        if last_ts <= first_ts:
+            return 0
+        opportunities = np.diff(self.opportunities_before([first_ts, last_ts]))
+        bits = opportunities[0] * BITS_PER_OPPORTUNITY
+        return bits / (1000.0 * (last_ts - first_ts))
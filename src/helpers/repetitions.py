@@ -0,0 +1,82 @@
+import math
+
+
+# metrics of the results of a run whose confidence intervals decide how
+# often an experiment is repeated
+DEFAULT_METRICS = ['throughput', '95percentile_bottleneck_delay',
+                   'overall_fairness']
+
+# 97.5% quantiles of Student's t-distribution by degrees of freedom, for 95%
+# confidence intervals; the normal quantile is used beyond the table
+T_QUANTILES = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306,
+               2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110,
+               2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056,
+               2.052, 2.048, 2.045, 2.042]
+NORMAL_QUANTILE = 1.960
+
+
+def t_quantile(dof):
+    if dof <= len(T_QUANTILES):
+        return T_QUANTILES[dof - 1]
+    return NORMAL_QUANTILE
+
+
+def relative_half_width(values):
+    """Half width of the 95% confidence interval of the mean of values,
+    relative to the mean (0 if all values are 0)."""
+    n = len(values)
+    mean = sum(values) / float(n)
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    half_width = t_quantile(n - 1) * math.sqrt(variance / n)
+    if half_width == 0:
+        return 0.0
+    if mean == 0:
+        return float('inf')
+    return half_width / abs(mean)
+
+
+class Repetitions(object):
+    """Decides how often to repeat an experiment.
+
+    An experiment runs at least min_runs and at most max_runs times. In
+    between, it is repeated until the 95% confidence interval of the mean of
+    each metric over its runs is narrower than target times the mean, e.g.
+    +-5% for target=0.05.
+    """
+
+    def __init__(self, min_runs, max_runs, target, metrics=DEFAULT_METRICS):
+        # confidence intervals need at least two runs
+        self.min_runs = max(2, min_runs)
+        self.max_runs = max(self.min_runs, max_runs)
+        self.target = target
+        self.metrics = metrics
+
+    def half_widths(self, results):
+        """Relative half widths of the confidence intervals of the metrics
+        over the results of runs (dicts, None for failed runs); metrics with
+        fewer than two values are left out."""
+        half_widths = {}
+        for metric in self.metrics:
+            values = [r[metric] for r in results if r is not None and
+                      r.get(metric) is not None and
+                      not math.isnan(r[metric])]
+            if len(values) >= 2:
+                half_widths[metric] = relative_half_width(values)
+        return half_widths
+
+    def done(self, results):
+        """Whether the experiment needs no more runs, given the results of
+        all runs so far (dicts, None for failed runs)."""
+        if len(results) >= self.max_runs:
+            return True
+
+        succeeded = [r for r in results if r is not None]
+        if len(succeeded) < self.min_runs:
+            return False
+
+        # without any metric to judge them by, runs are repeated until
+        # max_runs rather than considered precise enough
+        half_widths = self.half_widths(succeeded)
+        if not half_widths:
+            return False
+        return all(w <= self.target for w in half_widths.values())
@@ -0,0 +1,193 @@
+import os
+from os import path
+import sys
+import json
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# maximum number of flows per experiment with a throughput_rsd column
+MAX_FLOWS = 6
+
+# columns of benchmark results and their types, in the order of results.csv;
+# results of experiments may add further columns after these
+RESULT_COLUMNS = [
+    # identifiers
+    ('ex_name', 'str'),
+    ('run_id', 'int'),
+    # parameters
+    ('bottleneck_tput', 'float'),
+    ('bottleneck_rtprop', 'float'),
+    ('trace', 'str'),
+    ('q_size', 'int'),
+    ('scheme_a', 'str'),
+    ('scheme_b', 'str'),
+    ('rtprop_a', 'float'),
+    ('rtprop_b', 'float'),
+    ('runtime', 'float'),
+    # seconds the runs lasted, less than runtime if they converged earlier
+    ('achieved_runtime', 'float'),
+    # results
+    ('loss', 'float'),
+    ('interval_fairness', 'float'),
+    ('time_to_max_fairness', 'float'),
+    ('delay', 'float'),
+    ('throughput', 'float'),
+    ('duration', 'float'),
+] + [('throughput_rsd%d' % i, 'float') for i in xrange(1, MAX_FLOWS + 1)] + [
+    ('overall_fairness', 'float'),
+    ('group_interval_fairness', 'float'),
+    ('group_overall_fairness', 'float'),
+    ('95percentile_bottleneck_delay', 'float'),
+    ('mean_bottleneck_delay', 'float'),
+    ('converged_tput', 'float'),
+    ('scheme_a_tput', 'float'),
+    ('scheme_b_tput', 'float'),
+    ('flow_data', 'object'),
+    # CPU load while the experiment ran
+    ('cpu_load', 'float'),
+    ('cpu_load_max', 'float'),
+    ('overloaded', 'bool'),
+]
+
+
+def experiment_rows(ex, ex_results):
+    """Return a row of results for each run of Experiment ex, from the
+    tunnel_results of its runs returned by Experiment.plot()."""
+    rows = []
+    for run_id, res in ex_results.items():
+        if res is None:
+            # the analysis of this run failed
+            continue
+        res = dict(res)
+        res.pop('stats')
+
+        data = {}
+        data['ex_name'] = ex.experiment_name
+        data['run_id'] = int(run_id)
+        data['bottleneck_tput'] = ex.router.up_trace.mbps
+        data['bottleneck_rtprop'] = 2 * ex.router.delay
+        data['trace'] = ex.router.up_trace.name
+        data['q_size'] = int(ex.router.up_queue_args.split('=')[1])
+        data['scheme_a'] = ex.flows[0]['scheme']
+        data['scheme_b'] = ex.flows[1]['scheme']
+        data['rtprop_a'] = 2 * ex.flows[0]['sender_router'].delay
+        data['rtprop_b'] = 2 * ex.flows[1]['sender_router'].delay
+        data['runtime'] = ex.runtime
+
+        rsds = res.pop('throughput_relative_standard_deviation')
+        for flow_id, rsd in rsds.items():
+            data['throughput_rsd%d' % flow_id] = rsd
+
+        group_data = res.pop('group_data')
+        data['scheme_a_tput'] = group_data[0]['tput']
+        data['scheme_b_tput'] = group_data[1]['tput']
+
+        data.update(res)
+        rows.append(data)
+
+    return rows
+
+
+def typed_column(column, column_type):
+    missing = column.isnull().any()
+
+    if column_type == 'float':
+        return column.astype(np.float64)
+    if column_type == 'int':
+        # integer columns cannot hold NaN
+        return column.astype(np.float64 if missing else np.int64)
+    if column_type == 'bool' and not missing:
+        return column.astype(bool)
+
+    return column
+
+
+def results_table(rows):
+    """Build a DataFrame with the columns of RESULT_COLUMNS, followed by any
+    other columns in rows, from a list of result rows at once."""
+    columns = [name for name, _ in RESULT_COLUMNS]
+    known = set(columns)
+    columns += sorted(set(key for row in rows for key in row) - known)
+
+    data = OrderedDict()
+    for name in columns:
+        data[name] = pd.Series([row.get(name) for row in rows], dtype=object)
+    table = pd.DataFrame(data, columns=columns)
+
+    for name, column_type in RESULT_COLUMNS:
+        table[name] = typed_column(table[name], column_type)
+
+    return table
+
+
+def to_json(value):
+    # convert numpy scalars in result rows to their Python equivalents
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+class ResultsStore(object):
+    """Append-only store of benchmark results, one JSON row per line.
+
+    Rows are flushed to disk as soon as they are appended, so that an
+    interrupted benchmark can be resumed without running completed
+    experiments again.
+    """
+
+    def __init__(self, store_path):
+        self.path = store_path
+
+    def load(self):
+        rows = []
+        if not path.isfile(self.path):
+            return rows
+
+        with open(self.path) as store:
+            for line in store:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    # lines may be incomplete after a crash
+                    sys.stderr.write('Warning: skipped an invalid line in '
+                                     '%s\n' % self.path)
+
+        return rows
+
+    def completed_runs(self):
+        """Return the set of (experiment name, run id) pairs in the store."""
+        return set((row['ex_name'], row['run_id']) for row in self.load())
+
+    def ends_with_newline(self):
+        if not path.isfile(self.path) or path.getsize(self.path) == 0:
+            return True
+
+        with open(self.path, 'rb') as store:
+            store.seek(-1, os.SEEK_END)
+            return store.read(1) == '\n'
+
+    def append(self, rows):
+        # terminate a line left incomplete by a crash before appending to it
+        incomplete = not self.ends_with_newline()
+
+        with open(self.path, 'a') as store:
+            if incomplete:
+                store.write('\n')
+            for row in rows:
+                store.write(json.dumps(row, sort_keys=True, default=to_json))
+                store.write('\n')
+            store.flush()
+            os.fsync(store.fileno())
+
+
+def load_results(data_dir):
+    """Load the benchmark results in data_dir as a DataFrame, from
+    results.jsonl if it exists and from results.csv otherwise."""
+    store = ResultsStore(path.join(data_dir, 'results.jsonl'))
+    if path.isfile(store.path):
+        return results_table(store.load())
+
+    return pd.read_csv(path.join(data_dir, 'results.csv'))
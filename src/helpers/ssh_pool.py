@@ -0,0 +1,94 @@
+import os
+from os import path
+import sys
+import errno
+import hashlib
+import tempfile
+import subprocess
+from subprocess_wrappers import call
+
+
+# seconds the master connection to a host stays open without any session
+CONTROL_PERSIST = 600
+
+# seconds to wait for the master connection to a host to be established
+CONNECT_TIMEOUT = 20
+
+# hosts whose master connection was up when last checked
+connected_hosts = set()
+
+
+def control_path(host_addr):
+    """Socket of the master connection to host_addr. It is kept short, as
+    unix socket paths are limited to about 100 characters."""
+    control_dir = path.join(tempfile.gettempdir(),
+                            'pantheon_ssh_%d' % os.getuid())
+    try:
+        os.mkdir(control_dir, 0700)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+    return path.join(control_dir, hashlib.sha1(host_addr).hexdigest()[:16])
+
+
+def ssh_cmd(host_addr):
+    """ssh command to run commands on host_addr over its master connection.
+
+    Without a master connection, e.g. before connect() or after it was lost,
+    the command connects on its own instead of becoming a master, so that it
+    never keeps running in the background."""
+    return ['ssh', '-o', 'ControlPath=%s' % control_path(host_addr),
+            '-o', 'ControlMaster=no', host_addr]
+
+
+def is_connected(host_addr):
+    """whether the master connection to host_addr is up"""
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(
+            ['ssh', '-o', 'ControlPath=%s' % control_path(host_addr),
+             '-O', 'check', host_addr], stdout=devnull, stderr=devnull) == 0
+
+
+def connect(host_addr):
+    """Make sure the master connection to host_addr is up, (re)starting it if
+    it is not, and return whether it is."""
+    if is_connected(host_addr):
+        connected_hosts.add(host_addr)
+        return True
+
+    if host_addr in connected_hosts:
+        sys.stderr.write('Warning: lost the ssh connection to %s, '
+                         'reconnecting\n' % host_addr)
+        connected_hosts.discard(host_addr)
+
+    # a master that died leaves its socket behind
+    socket_path = control_path(host_addr)
+    if path.exists(socket_path):
+        os.remove(socket_path)
+
+    # -f returns once the connection is established; stdio of the master is
+    # closed, as it outlives the process that started it
+    with open(os.devnull, 'r+') as devnull:
+        ret = call(['ssh', '-o', 'ControlPath=%s' % socket_path,
+                    '-o', 'ControlPersist=%d' % CONTROL_PERSIST,
+                    '-o', 'ConnectTimeout=%d' % CONNECT_TIMEOUT,
+                    '-M', '-N', '-f', host_addr],
+                   stdin=devnull, stdout=devnull)
+
+    if ret != 0 or not is_connected(host_addr):
+        sys.stderr.write('Warning: failed to open a shared ssh connection to '
+                         '%s, every ssh command connects on its own\n' %
+                         host_addr)
+        return False
+
+    connected_hosts.add(host_addr)
+    return True
+
+
+def disconnect(host_addr):
+    """close the master connection to host_addr, if it is up"""
+    connected_hosts.discard(host_addr)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(
+            ['ssh', '-o', 'ControlPath=%s' % control_path(host_addr),
+             '-O', 'exit', host_addr], stdout=devnull, stderr=devnull)
@@ -0,0 +1,367 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+
+
+ARRIVAL = 0
+DEPARTURE = 1
+CAPACITY = 2
+
+EVENT_TYPES = {'+': ARRIVAL, '-': DEPARTURE, '#': CAPACITY}
+
+# Binary tunnel logs start with a fixed-size header followed by fixed-width
+# little-endian records, so that they can be memory-mapped without parsing.
+# Timestamps and delays are stored in microseconds, which is the resolution
+# of the text format ('%.3f' ms).
+BINARY_MAGIC = 'PTUNLOG1'
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('init_ts', '<f8'),  # ms
+    ('flows', '<u4'),  # number of flows, 0 if the log carries no flow ids
+    ('reserved', '<u4')])
+
+RECORD_DTYPE = np.dtype([
+    ('ts', '<i8'),  # us since init timestamp
+    ('delay', '<i4'),  # us, departures only
+    ('size', '<u2'),  # bytes
+    ('flow', 'u1'),
+    ('event', 'u1')])
+
+# largest packet size and flow id that fit into a record
+MAX_RECORD_SIZE = np.iinfo(RECORD_DTYPE['size']).max
+MAX_RECORD_FLOW = np.iinfo(RECORD_DTYPE['flow']).max
+
+# number of records buffered by BinaryLogWriter before writing to disk
+WRITE_BUFFER_RECORDS = 1 << 16
+
+
+TunnelLog = namedtuple('TunnelLog', ['init_ts', 'flows', 'ts', 'event',
+                                     'size', 'delay', 'flow'])
+
+
+def is_binary_log(log_path):
+    with open(log_path, 'rb') as log:
+        return log.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def ms_to_us(ms):
+    # rounded exactly like '%.3f' % ms, as ms * 1000.0 may round a timestamp
+    # to the other side of half a microsecond
+    return int(round(float('%.3f' % ms) * 1000.0))
+
+
+def ms_array_to_us(ms):
+    # ms_to_us of each element of an array
+    ms = np.char.mod('%.3f', ms).astype(np.float64)
+    return np.rint(ms * 1000.0).astype(np.int64)
+
+
+def text_init_ts(init_ts):
+    # init timestamp as written to and read back from a text tunnel log, so
+    # that events of different tunnels are ordered as when tunnel logs were
+    # written to disk first, also with clock offsets
+    return float('%.3f' % init_ts)
+
+
+def check_record_range(size, flow):
+    """Raise ValueError unless a size and flow id fit into a binary log
+    record, which would otherwise silently wrap around."""
+    if not 0 <= size <= MAX_RECORD_SIZE:
+        raise ValueError('packet size %s does not fit into a binary tunnel '
+                         'log (at most %d bytes)' % (size, MAX_RECORD_SIZE))
+    if not 0 <= flow <= MAX_RECORD_FLOW:
+        raise ValueError('flow id %s does not fit into a binary tunnel log '
+                         '(at most %d flows)' % (flow, MAX_RECORD_FLOW))
+
+
+def to_record(ts, event, size, delay=None, flow=0):
+    check_record_range(size, flow)
+    delay_us = 0 if delay is None else ms_to_us(delay)
+    return (ms_to_us(ts), delay_us, size, flow, event)
+
+
+def events_to_records(events):
+    """Pack (ts, event, size, delay, flow) events into an array of binary log
+    records, e.g. to hand them to another process."""
+    return np.array([to_record(*event) for event in events],
+                    dtype=RECORD_DTYPE)
+
+
+def read_binary_log(log_path):
+    """Return the header and a read-only memory map of the records of a binary
+    tunnel log."""
+    header = np.fromfile(log_path, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header['magic'][0] != BINARY_MAGIC:
+        raise ValueError('%s is not a binary tunnel log' % log_path)
+
+    if os.path.getsize(log_path) == HEADER_DTYPE.itemsize:
+        records = np.zeros(0, dtype=RECORD_DTYPE)
+    else:
+        records = np.memmap(log_path, dtype=RECORD_DTYPE, mode='r',
+                            offset=HEADER_DTYPE.itemsize)
+
+    return header[0], records
+
+
+def read_text_init_ts(log_path):
+    with open(log_path) as log:
+        for line in log:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# init timestamp'):
+                return float(line.split(':')[1])
+
+    return None
+
+
+def load_binary_log(log_path, sha1=None):
+    header, records = read_binary_log(log_path)
+    if sha1 is not None:
+        sha1.update(header.tobytes())
+        sha1.update(records)
+
+    event = records['event'].astype(np.int8)
+    delay = np.where(event == DEPARTURE, records['delay'] / 1000.0, np.nan)
+
+    return TunnelLog(init_ts=float(header['init_ts']),
+                     flows=int(header['flows']),
+                     ts=records['ts'] / 1000.0,
+                     event=event,
+                     size=records['size'].astype(np.int64),
+                     delay=delay,
+                     flow=records['flow'].astype(np.int64))
+
+
+def load_text_log(log_path, sha1=None):
+    with open(log_path) as log:
+        text = log.read()
+    if sha1 is not None:
+        sha1.update(text)
+
+    # comments are normally confined to the header
+    while text.startswith('#'):
+        text = text.partition('\n')[2]
+    if '\n#' in text:
+        text = ''.join(line for line in text.splitlines(True)
+                       if not line.startswith('#'))
+
+    if text and not text.endswith('\n'):
+        text += '\n'
+
+    # number of fields on each line, which depends on the event type and on
+    # whether the log carries flow ids
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    spaces = np.flatnonzero(buf == ord(' '))
+    fields = np.bincount(np.searchsorted(newlines, spaces),
+                         minlength=len(newlines)) + 1
+
+    for event_type, event in EVENT_TYPES.items():
+        text = text.replace(' %s ' % event_type, ' %d ' % event)
+    values = np.fromstring(text, sep=' ')
+    if len(values) != fields.sum():
+        raise ValueError('malformed tunnel log %s' % log_path)
+
+    init_ts = read_text_init_ts(log_path)
+
+    if not len(values):
+        empty = np.zeros(0)
+        return TunnelLog(init_ts=init_ts, flows=0, ts=empty,
+                         event=empty.astype(np.int8),
+                         size=empty.astype(np.int64), delay=empty,
+                         flow=empty.astype(np.int64))
+
+    last = len(values) - 1
+    start = np.cumsum(fields) - fields
+
+    ts = values[start]
+    event = values[start + 1].astype(np.int8)
+    size = values[start + 2].astype(np.int64)
+
+    # '- size delay [flow]' and '+ size [flow]'
+    departure = event == DEPARTURE
+    delay = np.where(departure, values[np.minimum(start + 3, last)], np.nan)
+    flow_field = np.where(departure, 4, 3)
+    flow = np.where(fields > flow_field,
+                    values[np.minimum(start + flow_field, last)], 0)
+    flow = flow.astype(np.int64)
+
+    return TunnelLog(init_ts=init_ts, flows=int(flow.max()), ts=ts,
+                     event=event, size=size, delay=delay, flow=flow)
+
+
+def load_tunnel_log(log_path, sha1=None):
+    """Load a text or binary tunnel log into NumPy columns.
+
+    Returns a TunnelLog with one entry per event in ts, event, size, delay and
+    flow. event is one of ARRIVAL, DEPARTURE or CAPACITY, delay is NaN for
+    events other than departures and flow is 0 in logs without flow ids.
+
+    sha1 is an optional hashlib object updated with the contents of the log
+    as they are read.
+    """
+    if is_binary_log(log_path):
+        return load_binary_log(log_path, sha1)
+
+    return load_text_log(log_path, sha1)
+
+
+def iter_text_events(log):
+    for line in log:
+        if line.startswith('#'):
+            continue
+
+        items = line.split()
+        event = EVENT_TYPES[items[1]]
+        size = int(items[2])
+
+        delay = None
+        flow = 0
+        if event == DEPARTURE:
+            delay = float(items[3])
+            if len(items) == 5:
+                flow = int(items[4])
+        elif event == ARRIVAL and len(items) == 4:
+            flow = int(items[3])
+
+        yield float(items[0]), event, size, delay, flow
+
+    log.close()
+
+
+def iter_binary_events(records):
+    for start in xrange(0, len(records), WRITE_BUFFER_RECORDS):
+        chunk = records[start:start + WRITE_BUFFER_RECORDS]
+        for ts, delay, size, flow, event in chunk.tolist():
+            if event != DEPARTURE:
+                delay = None
+            else:
+                delay = delay / 1000.0
+            yield ts / 1000.0, event, size, delay, flow
+
+
+def open_events(log_path):
+    """Return (init_ts, flows, events) of a text or binary tunnel log, or of an
+    mm-link log, where events yields (ts, event, size, delay, flow) in the
+    order of the log. init_ts is None if the log has no init timestamp."""
+    if is_binary_log(log_path):
+        header, records = read_binary_log(log_path)
+        return (float(header['init_ts']), int(header['flows']),
+                iter_binary_events(records))
+
+    log = open(log_path)
+    init_ts = None
+    while True:
+        line = log.readline()
+        if not line:
+            break
+
+        if line.startswith('# init timestamp'):
+            init_ts = float(line.split(':')[1])
+            break
+
+    return init_ts, 0, iter_text_events(log)
+
+
+class TextLogWriter(object):
+    # flows is only taken for the same interface as BinaryLogWriter, as text
+    # logs carry no flow count and readers derive it from the flow ids
+    def __init__(self, log_path, init_ts, flows=0):
+        self.log = open(log_path, 'w')
+        self.log.write('# init timestamp: %.3f\n' % init_ts)
+
+    def write(self, ts, event, size, delay=None, flow=0):
+        if event == ARRIVAL:
+            line = '%.3f + %s' % (ts, size)
+        elif event == DEPARTURE:
+            line = '%.3f - %s %.3f' % (ts, size, delay)
+        else:
+            line = '%.3f # %s' % (ts, size)
+
+        if flow and event != CAPACITY:
+            line += ' %s' % flow
+
+        self.log.write(line + '\n')
+
+    def close(self):
+        self.log.close()
+
+
+class BinaryLogWriter(object):
+    def __init__(self, log_path, init_ts, flows=0):
+        self.log = open(log_path, 'wb')
+        self.records = []
+
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = BINARY_MAGIC
+        header['init_ts'] = init_ts
+        header['flows'] = flows
+        header.tofile(self.log)
+
+    def write(self, ts, event, size, delay=None, flow=0):
+        self.records.append(to_record(ts, event, size, delay, flow))
+
+        if len(self.records) >= WRITE_BUFFER_RECORDS:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            np.array(self.records, dtype=RECORD_DTYPE).tofile(self.log)
+            self.records = []
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+
+def open_log_writer(log_path, init_ts, flows=0, binary=False):
+    if binary:
+        return BinaryLogWriter(log_path, init_ts, flows)
+
+    return TextLogWriter(log_path, init_ts, flows)
+
+
+def write_binary_log(log_path, tunnel_log):
+    """Write the columns of a TunnelLog to log_path in the binary format."""
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = BINARY_MAGIC
+    header['init_ts'] = tunnel_log.init_ts
+    header['flows'] = tunnel_log.flows
+
+    if len(tunnel_log.ts):
+        check_record_range(tunnel_log.size.min(), tunnel_log.flow.min())
+        check_record_range(tunnel_log.size.max(), tunnel_log.flow.max())
+
+    records = np.zeros(len(tunnel_log.ts), dtype=RECORD_DTYPE)
+    records['ts'] = ms_array_to_us(tunnel_log.ts)
+    departure = tunnel_log.event == DEPARTURE
+    records['delay'][departure] = ms_array_to_us(tunnel_log.delay[departure])
+    records['size'] = tunnel_log.size
+    records['flow'] = tunnel_log.flow
+    records['event'] = tunnel_log.event
+
+    with open(log_path, 'wb') as log:
+        header.tofile(log)
+        records.tofile(log)
+
+
+def convert_tunnel_log(input_log, output_log, binary):
+    """Convert a text or binary tunnel log into the binary format if binary is
+    True, or into the text format otherwise."""
+    if binary:
+        tunnel_log = load_tunnel_log(input_log)
+        if tunnel_log.init_ts is None:
+            raise ValueError('%s has no init timestamp' % input_log)
+        write_binary_log(output_log, tunnel_log)
+        return
+
+    init_ts, _, events = open_events(input_log)
+    if init_ts is None:
+        raise ValueError('%s has no init timestamp' % input_log)
+
+    writer = TextLogWriter(output_log, init_ts)
+    for event in events:
+        writer.write(*event)
+    writer.close()
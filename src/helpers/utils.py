@@ -4,23 +4,28 @@ import sys
 import io
 import socket
 import signal
+import time
 import errno
 import json
 import yaml
 import subprocess
+import threading
 from datetime import datetime
 import context
 import contextlib
 from subprocess_wrappers import check_call, check_output, call
+import ssh_pool
 
 @contextlib.contextmanager
-def nostdout(do_nothing=False):
+def nostdout(do_nothing=False, log_path=None):
     if do_nothing:
         yield
         return
+    if log_path is None:
+        log_path = os.path.join(context.src_dir, 'experiments/stdout.txt')
     save_stdout = sys.stdout
     save_stderr = sys.stderr
-    log = open(os.path.join(context.src_dir, 'experiments/stdout.txt'), "w+")
+    log = open(log_path, "w+")
     try:
         sys.stdout = log
         sys.stderr = log
@@ -117,6 +122,21 @@ def verify_schemes_with_meta(schemes, meta):
     return cc_schemes
 
 
+def achieved_runtime(data_dir, cc, run_id, runtime):
+    """seconds a run lasted, which is the runtime unless it was stopped
+    once its flows converged"""
+    stats_log_path = path.join(
+        data_dir, '%s_stats_run%s.log' % (cc, run_id))
+
+    if path.isfile(stats_log_path):
+        with open(stats_log_path) as stats_log:
+            for line in stats_log:
+                if line.startswith('Converged after:'):
+                    return float(line.split(':')[1].split()[0])
+
+    return runtime
+
+
 def who_runs_first(cc):
     cc_src = path.join(context.src_dir, 'wrappers', cc + '.py')
 
@@ -133,6 +153,112 @@ def who_runs_first(cc):
     return run_first, run_second
 
 
+# seconds to wait for the side of a scheme that runs first to be ready if
+# config.yml does not specify ready_timeout
+DEFAULT_READY_TIMEOUT = 3
+
+# TCP sockets in this state of /proc/net/tcp are listening
+TCP_LISTEN = '0A'
+
+
+def ready_probe(cc):
+    """Return (whether the side of cc that runs first is ready once it
+    listens on its port, seconds to wait for it at most) from config.yml."""
+    scheme_config = parse_config()['schemes'].get(cc, {})
+
+    return (scheme_config.get('ready_probe', True),
+            scheme_config.get('ready_timeout', DEFAULT_READY_TIMEOUT))
+
+
+def child_pids():
+    children = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+
+        try:
+            with open(path.join('/proc', pid, 'stat')) as stat:
+                # the name in parentheses may contain spaces
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue  # the process exited meanwhile
+
+        children.setdefault(ppid, []).append(int(pid))
+
+    return children
+
+
+def descendant_pids(pid):
+    children = child_pids()
+
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        pids += children.get(pids[i], [])
+        i += 1
+
+    return pids
+
+
+def is_listening(pid, port):
+    """Whether a TCP socket listens, or a UDP socket is bound, on port in
+    the network namespace of process pid."""
+    port_hex = '%04X' % int(port)
+
+    for table in ['tcp', 'tcp6', 'udp', 'udp6']:
+        try:
+            with open(path.join('/proc', str(pid), 'net', table)) as sockets:
+                next(sockets)  # header
+                for line in sockets:
+                    fields = line.split()
+                    if fields[1].rsplit(':', 1)[1] != port_hex:
+                        continue
+                    if table.startswith('udp') or fields[3] == TCP_LISTEN:
+                        return True
+        except (IOError, StopIteration):
+            continue
+
+    return False
+
+
+def wait_until_listening(pid, port, deadline, poll_interval=0.05):
+    """Wait until process pid, or one of its descendants, listens on port,
+    which may be in another network namespace such as that of a mahimahi
+    shell, or until time.time() reaches deadline.
+
+    Sockets are looked up in /proc rather than connected to, so that the
+    probe does not count as a connection to e.g. an iperf server. Returns
+    whether the port was found listening before the deadline.
+    """
+    while True:
+        for p in descendant_pids(pid):
+            if is_listening(p, port):
+                return True
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll_interval, remaining))
+
+
+def wait_until_ready(cc, pid, port, start_time):
+    """Wait until the side of cc started at start_time by process pid (or
+    None if it does not run on this host) is ready to accept the other side
+    on port, for at most the ready_timeout of cc in config.yml."""
+    probe, timeout = ready_probe(cc)
+    deadline = start_time + timeout
+
+    if probe and pid is not None:
+        if wait_until_listening(pid, port, deadline):
+            return
+        sys.stderr.write('Warning: %s did not listen on port %s within %s '
+                         'seconds\n' % (cc, port, timeout))
+    else:
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
 def parse_remote_path(remote_path, cc=None):
     ret = {}
 
@@ -140,7 +266,8 @@ def parse_remote_path(remote_path, cc=None):
     ret['src_dir'] = path.join(ret['base_dir'], 'src')
     ret['tmp_dir'] = path.join(ret['base_dir'], 'tmp')
     ret['ip'] = ret['host_addr'].split('@')[-1]
-    ret['ssh_cmd'] = ['ssh', ret['host_addr']]
+    # multiplexed over a shared connection, see ssh_pool.connect()
+    ret['ssh_cmd'] = ssh_pool.ssh_cmd(ret['host_addr'])
     ret['tunnel_manager'] = path.join(
         ret['src_dir'], 'experiments', 'tunnel_manager.py')
 
@@ -150,53 +277,110 @@ def parse_remote_path(remote_path, cc=None):
     return ret
 
 
-def query_clock_offset(ntp_addr, ssh_cmd):
-    local_clock_offset = None
-    remote_clock_offset = None
+def query_ntp_offset(cmd):
+    """Return the clock offset (str in ms) that the ntpdate command cmd
+    measured, or None if it failed 3 times."""
+    for _ in xrange(3):
+        try:
+            offset = check_output(cmd)
+            sys.stderr.write(offset)
+
+            offset = offset.rsplit(' ', 2)[-2]
+            return str(float(offset) * 1000)
+        except subprocess.CalledProcessError:
+            sys.stderr.write('Failed to get clock offset\n')
+        except ValueError:
+            sys.stderr.write('Cannot convert clock offset to float\n')
 
+    sys.stderr.write('Failed after 3 queries to NTP server\n')
+    return None
+
+
+def query_clock_offset(ntp_addr, ssh_cmd):
     ntp_cmds = {}
     ntpdate_cmd = ['ntpdate', '-t', '5', '-quv', ntp_addr]
 
     ntp_cmds['local'] = ntpdate_cmd
     ntp_cmds['remote'] = ssh_cmd + ntpdate_cmd
 
+    # query both sides at the same time, as each query may take seconds
+    offsets = {}
+    threads = []
     for side in ['local', 'remote']:
-        cmd = ntp_cmds[side]
+        thread = threading.Thread(
+            target=lambda side=side: offsets.update(
+                {side: query_ntp_offset(ntp_cmds[side])}))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
 
-        fail = True
-        for _ in xrange(3):
-            try:
-                offset = check_output(cmd)
-                sys.stderr.write(offset)
+    return offsets.get('local'), offsets.get('remote')
 
-                offset = offset.rsplit(' ', 2)[-2]
-                offset = str(float(offset) * 1000)
-            except subprocess.CalledProcessError:
-                sys.stderr.write('Failed to get clock offset\n')
-            except ValueError:
-                sys.stderr.write('Cannot convert clock offset to float\n')
-            else:
-                if side == 'local':
-                    local_clock_offset = offset
-                else:
-                    remote_clock_offset = offset
 
-                fail = False
-                break
+def read_git_head(git_dir):
+    """contents of HEAD of the git dir and of the ref it points to"""
+    try:
+        with open(path.join(git_dir, 'HEAD')) as head_file:
+            head = head_file.read().strip()
+    except IOError:
+        return None
+
+    ref = None
+    if head.startswith('ref: '):
+        try:
+            with open(path.join(git_dir, head[len('ref: '):])) as ref_file:
+                ref = ref_file.read().strip()
+        except IOError:
+            # a packed ref, which changes with the packed-refs file
+            packed_refs = path.join(git_dir, 'packed-refs')
+            if path.isfile(packed_refs):
+                ref = os.stat(packed_refs).st_mtime
+    return head, ref
+
+
+def git_state(repo_dir):
+    """HEADs of the repository and of its submodules, which change whenever
+    any of them checks out another commit"""
+    state = [read_git_head(path.join(repo_dir, '.git'))]
+
+    try:
+        with open(path.join(repo_dir, '.gitmodules')) as gitmodules:
+            submodules = [line.split('=', 1)[1].strip() for line in gitmodules
+                          if line.strip().startswith('path')]
+    except IOError:
+        submodules = []
 
-        if fail:
-            sys.stderr.write('Failed after 3 queries to NTP server\n')
+    for submodule in submodules:
+        git_dir = path.join(repo_dir, submodule, '.git')
+        if path.isfile(git_dir):
+            # a gitdir link into the .git/modules of the repository
+            with open(git_dir) as gitdir_link:
+                git_dir = path.join(path.dirname(git_dir),
+                                    gitdir_link.read().split(':', 1)[1].strip())
+        state.append((submodule, read_git_head(git_dir)))
 
-    return local_clock_offset, remote_clock_offset
+    return json.dumps(state)
+
+
+# git summaries computed by this process, by the state of the repositories
+git_summaries = {}
 
 
 def get_git_summary(mode='local', remote_path=None):
+    # runs of a sweep all check the same commits, so git_summary.sh only
+    # runs again once HEAD of the repository or of a submodule changed
+    key = (mode, remote_path, git_state(context.base_dir))
+    if key in git_summaries:
+        return git_summaries[key]
+
     git_summary_src = path.join(context.src_dir, 'experiments',
                                 'git_summary.sh')
     local_git_summary = check_output(git_summary_src, cwd=context.base_dir)
 
     if mode == 'remote':
         r = parse_remote_path(remote_path)
+        ssh_pool.connect(r['host_addr'])
 
         git_summary_src = path.join(
             r['src_dir'], 'experiments', 'git_summary.sh')
@@ -212,6 +396,7 @@ def get_git_summary(mode='local', remote_path=None):
                 '--- remote git summary ---\n%s\n' % remote_git_summary)
             sys.exit('Repository differed between local and remote sides')
 
+    git_summaries[key] = local_git_summary
     return local_git_summary
 
 
@@ -220,6 +405,7 @@ def save_test_metadata(meta, metadata_path):
     meta.pop('schemes')
     meta.pop('data_dir')
     meta.pop('pkill_cleanup')
+    meta.pop('tunnel_log_dir', None)
 
     # use list in case meta.keys() returns an iterator in Python 3
     for key in list(meta.keys()):
@@ -236,14 +422,18 @@ def save_test_metadata(meta, metadata_path):
                   separators=(',', ': '))
 
 
+def read_sysctl(name):
+    """the value of sysctl name, formatted like sysctl prints it"""
+    with open(path.join('/proc/sys', name.replace('.', '/'))) as sysctl:
+        return '%s = %s\n' % (name, sysctl.read().strip())
+
+
 def get_sys_info():
-    sys_info = ''
-    sys_info += check_output(['uname', '-sr'])
-    sys_info += check_output(['sysctl', 'net.core.default_qdisc'])
-    sys_info += check_output(['sysctl', 'net.core.rmem_default'])
-    sys_info += check_output(['sysctl', 'net.core.rmem_max'])
-    sys_info += check_output(['sysctl', 'net.core.wmem_default'])
-    sys_info += check_output(['sysctl', 'net.core.wmem_max'])
-    sys_info += check_output(['sysctl', 'net.ipv4.tcp_rmem'])
-    sys_info += check_output(['sysctl', 'net.ipv4.tcp_wmem'])
+    # read from /proc/sys rather than by running sysctl once per setting
+    sys_info = '%s %s\n' % (os.uname()[0], os.uname()[2])
+    for name in ['net.core.default_qdisc', 'net.core.rmem_default',
+                 'net.core.rmem_max', 'net.core.wmem_default',
+                 'net.core.wmem_max', 'net.ipv4.tcp_rmem',
+                 'net.ipv4.tcp_wmem']:
+        sys_info += read_sysctl(name)
     return sys_info
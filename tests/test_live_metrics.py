@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from os import path
+import sys
+import math
+import shutil
+import random
+import tempfile
+
+import context
+sys.path.append(path.join(context.src_dir, 'analysis'))
+sys.path.append(path.join(context.src_dir, 'experiments'))
+from live_metrics import LiveMetrics
+from tunnel_graph import TunnelGraph
+from merge_tunnel_logs import merge_links, DEFAULT_MAX_DELAY
+from test_merge_tunnel_logs import write_tunnel_logs
+
+
+# number of pieces in which the logs are appended to between updates
+UPDATES = 7
+
+
+def assert_same(results, expected, key='results'):
+    if isinstance(expected, dict):
+        assert sorted(results) == sorted(expected), key
+        for k in expected:
+            assert_same(results[k], expected[k], '%s[%r]' % (key, k))
+    elif isinstance(expected, (list, tuple)):
+        assert len(results) == len(expected), key
+        for i, (r, e) in enumerate(zip(results, expected)):
+            assert_same(r, e, '%s[%d]' % (key, i))
+    elif isinstance(expected, float) and math.isnan(expected):
+        assert math.isnan(results), key
+    else:
+        assert results == expected, '%s: %r live, %r merged' % (
+            key, results, expected)
+
+
+def write_live(tunnels, live_tunnels, live):
+    """append the logs of tunnels to those of live_tunnels, which live
+    follows, in pieces cut anywhere within lines, updating live after each
+    piece"""
+    logs = []
+    for tunnel, live_tunnel in zip(tunnels, live_tunnels):
+        for log_path, live_path in [(tunnel[0], live_tunnel[0]),
+                                    (tunnel[1], live_tunnel[1])]:
+            with open(log_path) as log:
+                logs.append((log.read(), open(live_path, 'w')))
+
+    for piece in xrange(UPDATES):
+        for text, live_log in logs:
+            live_log.write(text[len(text) * piece // UPDATES:
+                                len(text) * (piece + 1) // UPDATES])
+            live_log.flush()
+        live.update()
+
+    for _, live_log in logs:
+        live_log.close()
+
+
+def test_live_metrics_match_merged_log():
+    data_dir = tempfile.mkdtemp()
+    try:
+        rng = random.Random(3)
+        tunnels = []
+        live_tunnels = []
+        flow_info = {}
+        for tun_id in xrange(1, 4):
+            ingress_log, egress_log = write_tunnel_logs(
+                data_dir, tun_id, 3000, rng)
+            tunnels.append((ingress_log, egress_log, None, None))
+            live_tunnels.append((ingress_log + '.live', egress_log + '.live',
+                                 None, None))
+            flow_info[tun_id] = {'name': 'flow%d' % tun_id, 'color': None,
+                                 'group': tun_id % 2}
+
+        live = LiveMetrics(live_tunnels, flow_info=flow_info,
+                           max_delay=DEFAULT_MAX_DELAY)
+        write_live(tunnels, live_tunnels, live)
+        graph = live.finish()
+
+        merged_log = path.join(data_dir, 'merged.log')
+        assert merge_links([(merged_log, None, tunnels)]) == [None]
+        expected = TunnelGraph(merged_log, flow_info=flow_info).run()
+
+        assert_same(graph.results, expected)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main():
+    test_live_metrics_match_merged_log()
+    sys.stderr.write('live metrics match the analysis of the merged log\n')
+
+
+if __name__ == '__main__':
+    main()
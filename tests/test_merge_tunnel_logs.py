@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+from os import path
+import sys
+import shutil
+import random
+import tempfile
+
+import context
+from helpers.subprocess_wrappers import check_call
+sys.path.append(path.join(context.src_dir, 'experiments'))
+from merge_tunnel_logs import merge_links
+
+
+MERGE_PY = path.join(context.src_dir, 'experiments', 'merge_tunnel_logs.py')
+
+
+def write_tunnel_logs(data_dir, tun_id, packets, rng):
+    """write the ingress and egress log of a tunnel carrying packets, with
+    random delays and losses"""
+    ingress_log = path.join(data_dir, 'flow%d.log.ingress' % tun_id)
+    egress_log = path.join(data_dir, 'flow%d.log.egress' % tun_id)
+
+    send_init_ts = 1500000000000 + rng.uniform(0, 10)
+    recv_init_ts = send_init_ts + rng.uniform(-5, 5)
+
+    sent = []
+    departures = []
+    ts = rng.uniform(0, 100)
+    for i in xrange(packets):
+        ts += rng.expovariate(1.0)
+        uid = tun_id * 10 ** 6 + i
+        size = rng.choice([52, 1500])
+        sent.append((ts, uid, size))
+        if rng.random() > 0.02:
+            departures.append((ts + send_init_ts - recv_init_ts +
+                               rng.uniform(1, 80), uid, size))
+    departures.sort()
+
+    with open(egress_log, 'w') as log:
+        log.write('# init timestamp: %.3f\n' % send_init_ts)
+        for ts, uid, size in sent:
+            log.write('%.4f-%d-%d\n' % (ts, uid, size))
+
+    with open(ingress_log, 'w') as log:
+        log.write('# init timestamp: %.3f\n' % recv_init_ts)
+        for ts, uid, size in departures:
+            log.write('%.4f-%d-%d\n' % (ts, uid, size))
+
+    return ingress_log, egress_log
+
+
+def merge_with_subprocesses(data_dir, tunnels, output_log):
+    """merge like test.py did before merge_links: a single mode merge per
+    tunnel, then a multiple mode merge of the tunnel logs"""
+    tunnel_logs = []
+    for tun_id, (ingress_log, egress_log, i_ofst, e_ofst) in enumerate(
+            tunnels, 1):
+        tunnel_log = path.join(data_dir, 'flow%d.log.merged' % tun_id)
+        cmd = [sys.executable, MERGE_PY, 'single', '-i', ingress_log,
+               '-e', egress_log, '-o', tunnel_log]
+        if i_ofst is not None:
+            cmd += ['-i-clock-offset', str(i_ofst)]
+        if e_ofst is not None:
+            cmd += ['-e-clock-offset', str(e_ofst)]
+        check_call(cmd)
+        tunnel_logs.append(tunnel_log)
+
+    check_call([sys.executable, MERGE_PY, 'multiple', '-o', output_log] +
+               tunnel_logs)
+
+
+def read(log_path):
+    with open(log_path) as log:
+        return log.read()
+
+
+def check_merge(clock_offsets):
+    data_dir = tempfile.mkdtemp()
+    try:
+        rng = random.Random(1)
+        tunnels = []
+        for tun_id in xrange(1, 4):
+            ingress_log, egress_log = write_tunnel_logs(
+                data_dir, tun_id, 3000, rng)
+            if clock_offsets:
+                ofsts = (rng.uniform(-3, 3), rng.uniform(-3, 3))
+            else:
+                ofsts = (None, None)
+            tunnels.append((ingress_log, egress_log) + ofsts)
+
+        expected_log = path.join(data_dir, 'expected.log')
+        merge_with_subprocesses(data_dir, tunnels, expected_log)
+        expected = read(expected_log)
+
+        for processes in [1, 2]:
+            output_log = path.join(data_dir, 'merged%d.log' % processes)
+            errors = merge_links([(output_log, None, tunnels)],
+                                 processes=processes)
+            assert errors == [None], errors
+            assert read(output_log) == expected, (
+                'merge_links with %d processes differs from single and '
+                'multiple mode' % processes)
+
+        # workers leave no temporary logs behind
+        assert sorted(os.listdir(data_dir)) == sorted(
+            ['expected.log', 'merged1.log', 'merged2.log'] +
+            [path.basename(p) for tunnel in tunnels for p in tunnel[:2]] +
+            ['flow%d.log.merged' % i for i in xrange(1, 4)])
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def test_merge_links():
+    check_merge(clock_offsets=False)
+
+
+def test_merge_links_with_clock_offsets():
+    check_merge(clock_offsets=True)
+
+
+def main():
+    test_merge_links()
+    test_merge_links_with_clock_offsets()
+    sys.stderr.write('merge_links matches single and multiple mode\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import sys
+
+import context
+from helpers.repetitions import Repetitions, relative_half_width
+
+
+def run(throughput, delay=50.0, fairness=1.0):
+    return {'throughput': throughput, '95percentile_bottleneck_delay': delay,
+            'overall_fairness': fairness}
+
+
+def test_relative_half_width():
+    # t quantile of 1 degree of freedom times a standard error of 1
+    assert abs(relative_half_width([9.0, 11.0]) - 1.2706) < 1e-9
+    assert relative_half_width([10.0, 10.0, 10.0]) == 0.0
+
+    # values around a zero mean are never precise enough, unless all are 0
+    assert relative_half_width([-1.0, 1.0]) == float('inf')
+    assert relative_half_width([0.0, 0.0]) == 0.0
+
+
+def test_min_and_max_runs():
+    # confidence intervals need at least two runs
+    repetitions = Repetitions(1, 1, 0.05)
+    assert repetitions.min_runs == 2 and repetitions.max_runs == 2
+
+    repetitions = Repetitions(3, 5, 0.05)
+    assert not repetitions.done([])
+    assert not repetitions.done([run(10.0)] * 2)
+    assert repetitions.done([run(10.0)] * 3)
+
+    # runs that vary too much are repeated up to max_runs
+    noisy = [run(10.0 + i % 2 * 5) for i in xrange(5)]
+    assert not repetitions.done(noisy[:3])
+    assert not repetitions.done(noisy[:4])
+    assert repetitions.done(noisy)
+
+
+def test_failed_runs():
+    repetitions = Repetitions(3, 5, 0.05)
+
+    # failed runs do not count towards min_runs, but towards max_runs
+    assert not repetitions.done([run(10.0), None, run(10.0)])
+    assert repetitions.done([run(10.0), None, run(10.0), run(10.0)])
+    assert repetitions.done([None] * 5)
+
+    # nor do metrics a run could not compute
+    nan = float('nan')
+    results = [run(10.0, fairness=f) for f in [nan, 0.5, 1.0]]
+    assert 'overall_fairness' in repetitions.half_widths(results)
+    assert 'overall_fairness' not in repetitions.half_widths(results[:2])
+    assert repetitions.done([run(10.0, fairness=nan)] * 3)
+
+    # runs without any metric are repeated until max_runs
+    no_metrics = [run(nan, delay=nan, fairness=nan)] * 3
+    assert repetitions.half_widths(no_metrics) == {}
+    assert not repetitions.done(no_metrics)
+    assert not repetitions.done([{'loss': 0.0}] * 4)
+    assert repetitions.done([{'loss': 0.0}] * 5)
+
+
+def test_zero_mean():
+    repetitions = Repetitions(2, 10, 0.05, metrics=['loss'])
+
+    assert repetitions.done([{'loss': 0.0}] * 2)
+    assert not repetitions.done([{'loss': 0.0}, {'loss': 0.0},
+                                 {'loss': 0.01}])
+    assert repetitions.half_widths([{'loss': -0.01}, {'loss': 0.01}]) == {
+        'loss': float('inf')}
+
+
+def main():
+    test_relative_half_width()
+    test_min_and_max_runs()
+    test_failed_runs()
+    test_zero_mean()
+    sys.stderr.write('repetitions stop once confidence intervals are narrow '
+                     'enough\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -31,10 +31,11 @@ def test_schemes(args):
 
         # run first to run
         cmd = [src, run_first, port]
+        first_start_time = time.time()
         first_proc = Popen(cmd, preexec_fn=os.setsid)
 
         # wait for 'run_first' to be ready
-        time.sleep(3)
+        utils.wait_until_ready(scheme, first_proc.pid, port, first_start_time)
 
         # run second to run
         cmd = [src, run_second, '127.0.0.1', port]
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+from os import path
+import sys
+
+import context
+sys.path.append(path.join(context.src_dir, 'experiments'))
+from sweep_planner import AdaptiveSweep, coarse_indices, result_metrics
+
+
+# loss steps from 0 to 0.5 between x = 5 and x = 6 on grid 'step', and is
+# flat on grid 'flat'
+def loss(point):
+    grid, x, y = point
+    if grid == 'step' and x >= 6:
+        return {'loss': 0.5}
+    return {'loss': 0.0}
+
+
+def run_sweep(sweep):
+    """evaluate the planned points until the sweep is done, and return the
+    points planned by each call"""
+    results = {}
+    rounds = []
+    points = sweep.initial_points()
+    while points:
+        rounds.append(points)
+        for point in points:
+            results[point] = loss(point)
+        points = sweep.refine(results)
+
+    return rounds
+
+
+def test_coarse_indices():
+    assert coarse_indices(9, 4) == [0, 4, 8]
+    assert coarse_indices(10, 4) == [0, 4, 8, 9]
+    assert coarse_indices(2, 4) == [0, 1]
+    assert coarse_indices(1, 4) == [0]
+
+
+def test_result_metrics():
+    rows = [{'loss': 0.1, 'throughput': 5.0, 'bottleneck_tput': 10.0},
+            {'loss': 0.3, 'throughput': 10.0, 'bottleneck_tput': 10.0,
+             'overall_fairness': float('nan')},
+            {'loss': None, 'throughput': None}]
+    metrics = result_metrics(rows)
+    assert sorted(metrics) == ['loss', 'utilization'], metrics
+    assert abs(metrics['loss'] - 0.2) < 1e-9
+    assert abs(metrics['utilization'] - 0.75) < 1e-9
+
+
+def test_refine_next_to_step():
+    sweep = AdaptiveSweep(['step', 'flat'], (9, 9), (4, 4))
+    rounds = run_sweep(sweep)
+
+    initial = set(rounds[0])
+    assert initial == set((grid, x, y) for grid in ['step', 'flat']
+                          for x in [0, 4, 8] for y in [0, 4, 8])
+
+    # only points next to the step are refined, bisecting from the coarse
+    # points 4 and 8 on each line of the coarse grid
+    refined = [point for points in rounds[1:] for point in points]
+    assert all(grid == 'step' and x in [5, 6] for grid, x, y in refined)
+    assert rounds[1:] == [[('step', 6, y) for y in [0, 4, 8]],
+                          [('step', 5, y) for y in [0, 4, 8]]], rounds
+
+
+def test_budget():
+    # the budget cuts off the coarse grid, in order
+    sweep = AdaptiveSweep(['step'], (9, 9), (4, 4), budget=4)
+    assert run_sweep(sweep) == [[('step', 0, 0), ('step', 0, 4),
+                                 ('step', 0, 8), ('step', 4, 0)]]
+
+    # and refinement once it is spent
+    sweep = AdaptiveSweep(['step'], (9, 9), (4, 4), budget=11)
+    rounds = run_sweep(sweep)
+    assert len(rounds[0]) == 9
+    assert rounds[1:] == [[('step', 6, 0), ('step', 6, 4)]], rounds
+    assert len(sweep.planned) == 11
+
+
+def main():
+    test_coarse_indices()
+    test_result_metrics()
+    test_refine_next_to_step()
+    test_budget()
+    sys.stderr.write('adaptive sweeps refine where results change\n')
+
+
+if __name__ == '__main__':
+    main()
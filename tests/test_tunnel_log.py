@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+from os import path
+import sys
+import shutil
+import random
+import tempfile
+
+import numpy as np
+
+import context
+from helpers.tunnel_log import (
+    open_log_writer, load_binary_log, load_text_log, write_binary_log,
+    is_binary_log, TunnelLog, MAX_RECORD_SIZE, MAX_RECORD_FLOW, ARRIVAL,
+    DEPARTURE, CAPACITY)
+
+
+def random_events(rng, num_events, flows):
+    """events of a merged tunnel log with flows flows and capacity events,
+    as (ts, event, size, delay, flow)"""
+    events = []
+    ts = 0.0
+    for _ in xrange(num_events):
+        ts += rng.expovariate(1.0)
+        event = rng.choice([ARRIVAL, DEPARTURE, CAPACITY])
+        if event == CAPACITY:
+            events.append((ts, event, 1500, None, 0))
+        else:
+            delay = None
+            if event == DEPARTURE:
+                delay = rng.uniform(0, 1000)
+            events.append((ts, event, rng.choice([52, 1500, MAX_RECORD_SIZE]),
+                           delay, rng.randint(1, flows)))
+
+    return events
+
+
+def write_log(log_path, init_ts, events, flows, binary):
+    log = open_log_writer(log_path, init_ts, flows=flows, binary=binary)
+    for event in events:
+        log.write(*event)
+    log.close()
+
+
+def assert_same_log(binary_log, text_log):
+    assert binary_log.init_ts == text_log.init_ts
+    for column in ['ts', 'event', 'size', 'flow']:
+        assert np.array_equal(getattr(binary_log, column),
+                              getattr(text_log, column)), column
+
+    # NaN for all events other than departures
+    assert np.array_equal(np.isnan(binary_log.delay),
+                          np.isnan(text_log.delay))
+    departure = binary_log.event == DEPARTURE
+    assert np.array_equal(binary_log.delay[departure],
+                          text_log.delay[departure])
+
+
+def test_binary_round_trip():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = random.Random(1)
+        init_ts = 1500000000000 + rng.uniform(0, 1000)
+        events = random_events(rng, 10000, MAX_RECORD_FLOW)
+
+        binary_path = path.join(tmp_dir, 'binary.log')
+        text_path = path.join(tmp_dir, 'text.log')
+        write_log(binary_path, init_ts, events, MAX_RECORD_FLOW, True)
+        write_log(text_path, init_ts, events, MAX_RECORD_FLOW, False)
+        assert is_binary_log(binary_path)
+        assert not is_binary_log(text_path)
+
+        # init timestamps of text logs are rounded to us
+        binary_log = load_binary_log(binary_path)
+        text_log = load_text_log(text_path)
+        assert binary_log.flows == MAX_RECORD_FLOW
+        assert binary_log.init_ts == init_ts
+        assert_same_log(binary_log._replace(init_ts=text_log.init_ts),
+                        text_log)
+
+        # and back through write_binary_log
+        rewritten_path = path.join(tmp_dir, 'rewritten.log')
+        write_binary_log(rewritten_path, text_log)
+        assert_same_log(load_binary_log(rewritten_path), text_log)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_write_binary_log_rounding():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = random.Random(2)
+        events = random_events(rng, 10000, MAX_RECORD_FLOW)
+        # halves of a us, which ts * 1000.0 rounds differently than '%.3f'
+        events += [(events[-1][0] + 0.0025 * i, DEPARTURE, 1500, 0.0025 * i, 1)
+                   for i in xrange(1, 100)]
+
+        # the unrounded columns of the events, as read from another log
+        ts, event, size, delay, flow = zip(*events)
+        tunnel_log = TunnelLog(
+            init_ts=0.0, flows=MAX_RECORD_FLOW, ts=np.array(ts),
+            event=np.array(event, dtype=np.int8), size=np.array(size),
+            delay=np.array([np.nan if d is None else d for d in delay]),
+            flow=np.array(flow))
+
+        written_path = path.join(tmp_dir, 'written.log')
+        rewritten_path = path.join(tmp_dir, 'rewritten.log')
+        write_log(written_path, 0.0, events, MAX_RECORD_FLOW, True)
+        write_binary_log(rewritten_path, tunnel_log)
+        with open(written_path, 'rb') as written:
+            with open(rewritten_path, 'rb') as rewritten:
+                assert written.read() == rewritten.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_binary_out_of_range():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        log_path = path.join(tmp_dir, 'binary.log')
+        for size, flow in [(MAX_RECORD_SIZE + 1, 1), (-1, 1),
+                           (1500, MAX_RECORD_FLOW + 1)]:
+            try:
+                write_log(log_path, 0, [(1.0, ARRIVAL, size, None, flow)],
+                          MAX_RECORD_FLOW, True)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(
+                    'size %s and flow %s were written to a binary log' %
+                    (size, flow))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_binary_round_trip()
+    test_write_binary_log_rounding()
+    test_binary_out_of_range()
+    sys.stderr.write('binary tunnel logs match text tunnel logs\n')
+
+
+if __name__ == '__main__':
+    main()